@@ -19,10 +19,10 @@ def add_indexes_to_database(db_path='database.db'):
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_user1_id ON chats(user1_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_user2_id ON chats(user2_id)")
     
-    # Индексы для таблицы messages
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)")
+    # Индексы для таблицы conversation_messages (личные, групповые и канальные сообщения)
+    # Выборка по беседе покрывается UNIQUE(conversation_id, seq)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_messages_sender ON conversation_messages(sender)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_messages_timestamp ON conversation_messages(timestamp)")
     
     # Индексы для таблицы channels
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_channels_name ON channels(name)")
@@ -54,16 +54,6 @@ def add_indexes_to_database(db_path='database.db'):
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_follower_id ON subscriptions(follower_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_following_id ON subscriptions(following_id)")
     
-    # Индексы для таблицы group_messages
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_group_id ON group_messages(group_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_sender ON group_messages(sender)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_timestamp ON group_messages(timestamp)")
-    
-    # Индексы для таблицы channel_messages
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_channel_id ON channel_messages(channel_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_sender ON channel_messages(sender)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_timestamp ON channel_messages(timestamp)")
-    
     # Индексы для таблицы user_sessions
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user_id ON user_sessions(user_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_logout_time ON user_sessions(logout_time)")
@@ -16,26 +16,12 @@ def add_search_indexes():
     with sqlite3.connect(DATABASE) as conn:
         cursor = conn.cursor()
         
-        # Индекс для поиска по содержимому личных сообщений
+        # Индекс для поиска по содержимому сообщений (личные чаты, группы и каналы)
         try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_content ON messages(message)")
-            print("[OK] Index for private messages content created")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_messages_content ON conversation_messages(message)")
+            print("[OK] Index for messages content created")
         except sqlite3.Error as e:
-            print(f"[ERROR] Error creating index for private messages: {e}")
-        
-        # Индекс для поиска по содержимому сообщений в группах
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_content ON group_messages(message)")
-            print("[OK] Index for group messages content created")
-        except sqlite3.Error as e:
-            print(f"[ERROR] Error creating index for group messages: {e}")
-            
-        # Индекс для поиска по содержимому сообщений в каналах
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_content ON channel_messages(message)")
-            print("[OK] Index for channel messages content created")
-        except sqlite3.Error as e:
-            print(f"[ERROR] Error creating index for channel messages: {e}")
+            print(f"[ERROR] Error creating index for messages: {e}")
             
         # Индекс для поиска по содержимому постов
         try:
@@ -46,22 +32,10 @@ def add_search_indexes():
             
         # Комбинированные индексы для более эффективного поиска
         try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_content_sender ON messages(message, sender)")
-            print("[OK] Combined index for private messages (content, sender) created")
-        except sqlite3.Error as e:
-            print(f"[ERROR] Error creating combined index for private messages: {e}")
-            
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_content_sender ON group_messages(message, sender)")
-            print("[OK] Combined index for group messages (content, sender) created")
-        except sqlite3.Error as e:
-            print(f"[ERROR] Error creating combined index for group messages: {e}")
-            
-        try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_content_sender ON channel_messages(message, sender)")
-            print("[OK] Combined index for channel messages (content, sender) created")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_messages_content_sender ON conversation_messages(message, sender)")
+            print("[OK] Combined index for messages (content, sender) created")
         except sqlite3.Error as e:
-            print(f"[ERROR] Error creating combined index for channel messages: {e}")
+            print(f"[ERROR] Error creating combined index for messages: {e}")
             
         try:
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_content_user ON posts(content, user_id)")
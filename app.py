@@ -1,35 +1,54 @@
 # app.py
 import os
+
+# Режим сервера Socket.IO: threading (по умолчанию) или gevent. Под gevent патчить
+# стандартную библиотеку нужно до импорта всего остального
+SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+if SOCKETIO_ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 import sqlite3
 import time
 from flask import Flask, render_template, request, session, redirect, url_for, jsonify, send_from_directory
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 from werkzeug.utils import secure_filename
 from utils import (
-    get_db_connection, init_db, hash_password, verify_password, get_user_by_username,
-    get_or_create_chat, get_messages, get_active_users, create_user, save_message,
-    mark_message_as_delivered, mark_message_as_read, get_unread_messages,
+    get_db_connection, init_db, hash_password, verify_password, get_user_by_username, set_user_avatar,
+    get_or_create_chat, find_chat, get_messages, create_user, save_message,
+    get_user_credentials,
     create_group, get_group_by_name, get_groups_for_user, add_user_to_group,
-    get_group_messages, save_group_message, delete_message, save_pinned_message,
+    get_group_messages, save_group_message, delete_own_message, edit_own_message, save_pinned_message,
     get_pinned_message, remove_pinned_message, delete_chat, delete_group, get_user_chats,
     follow_user, unfollow_user, is_following, get_followers, get_following,
-    create_post, get_posts_for_user, get_feed, like_post, unlike_post, is_liked,
-    add_comment, get_comments_for_post, repost, unrepost, is_reposted, get_reposts_for_user,
-    update_group_message_read, edit_post, delete_post, get_top_posts,
+    create_post, get_posts_for_user, get_feed_cached, like_post, unlike_post, reconcile_post_counters,
+    add_comment, get_comments_for_post, repost, unrepost, get_reposts_for_user,
+    edit_post, delete_post, get_top_posts,
     get_monthly_activity, get_followers_growth, get_posts_with_images_percentage,
-    add_reply, get_replies_for_comment, add_reaction, remove_reaction, get_reactions_for_post, is_reacted,
-    pin_post, unpin_post, is_pinned, get_pinned_posts, get_message_by_id,
-    get_channel_messages, save_channel_message, update_channel_message_read,
-    create_channel, get_channel_by_name, get_channels_for_user, add_user_to_channel,
-    remove_user_from_channel, create_channel_role, get_channel_members, get_user_channel_role,
+    add_reply, add_reaction, remove_reaction,
+    pin_post, unpin_post, get_message_by_id, get_conversation_message,
+    get_channel_messages, save_channel_message, next_history_cursor,
+    get_sync_token, get_changes_since, trim_change_log, mark_conversation_read, get_roster, post_message, update_user,
+    create_channel, get_channel_by_name, get_channels_for_user, add_user_to_channel, update_channel,
+    remove_user_from_channel, create_channel_role, set_channel_member_role, get_channel_members, get_user_channel_role,
     create_channel_invite, use_channel_invite, get_channel_invites, delete_channel_invite,
     add_profile_comment, get_profile_comments_for_user, add_message_comment, get_comments_for_message,
-    create_event, get_event_by_id, get_events_for_user, get_events_created_by_user,
+    create_event as save_event, get_event_by_id, get_events_for_user, get_events_created_by_user,
     add_event_participant, remove_event_participant, update_participant_status,
-    get_event_participants, get_upcoming_events
+    get_event_participants, get_upcoming_events, query_cache,
+    search_messages_global, search_posts_global, search_all_content,
+    search_messages_in_chat, search_messages_in_group, search_messages_in_channel
 )
+from presence import create_presence_store, PRESENCE_TTL
+from typing_state import TypingTracker
+from db_offload import enable_offload
+from app_logging import get_logger
+import redis_config
 import datetime
 
+log = get_logger('http')
+socket_log = get_logger('socket')
+
 app = Flask(__name__)
 app.secret_key = 'super-secret-key'
 app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
@@ -47,21 +66,163 @@ def allowed_file(filename):
 def allowed_audio_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in AUDIO_EXTENSIONS
 
-socketio = SocketIO(app, cors_allowed_origins="*", logger=False, engineio_logger=False, async_mode='threading')
+# Кластерный режим: с очередью сообщений (redis://...) emit'ы доходят до сокетов во всех воркерах
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+socketio = SocketIO(app, cors_allowed_origins="*", logger=False, engineio_logger=False, async_mode=SOCKETIO_ASYNC_MODE,
+                    message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+# Под gevent запросы к базе из utils выполняются в ограниченном пуле потоков ОС
+if SOCKETIO_ASYNC_MODE == 'gevent':
+    enable_offload()
+
+# Трекинг онлайна, sid и открытого чата (в кластерном режиме - общий для всех воркеров)
+presence = create_presence_store()
+
+
+# Комнаты для рассылки: личная комната пользователя (все его вкладки) и лента канала (все подписчики)
+def user_room(username):
+    return f"user_{username}"
+
+
+def channel_feed_room(channel_id):
+    return f"channel_feed_{channel_id}"
+
+
+def set_channel_subscription(username, channel_id, subscribed):
+    """Подписать/отписать подключённые устройства пользователя от ленты канала при изменении членства"""
+    remote = False
+    for sid in presence.sids_for(username):
+        if not socketio.server.manager.is_connected(sid, '/'):
+            remote = True
+        elif subscribed:
+            socketio.server.enter_room(sid, channel_feed_room(channel_id), namespace='/')
+        else:
+            socketio.server.leave_room(sid, channel_feed_room(channel_id), namespace='/')
+    if remote:
+        # Часть сокетов подключена к другим воркерам: клиенты сами запросят пересчёт своих лент
+        socketio.emit('channel_subscription', {'channel_id': channel_id, 'subscribed': subscribed},
+                      room=user_room(username))
+
+
+# Сокеты без heartbeat дольше PRESENCE_TTL убираются из онлайна фоновой задачей
+_presence_sweeper_started = False
+
 
-# Трекинг
-online_users = {}
-user_sids = {}
-user_chat_context = {}
+def _sweep_presence():
+    while True:
+        socketio.sleep(PRESENCE_TTL / 3)
+        try:
+            for username in presence.expire_stale():
+                socketio.emit('user_status_update', {'user': username, 'status': 'offline'})
+        except Exception:
+            socket_log.exception("Ошибка при очистке присутствия")
+
+
+def _ensure_presence_sweeper():
+    global _presence_sweeper_started
+    if not _presence_sweeper_started:
+        _presence_sweeper_started = True
+        socketio.start_background_task(_sweep_presence)
+
+
+# Индикатор «печатает»: комнате рассылается агрегированный кадр, а не каждое нажатие клавиш
+typing_tracker = TypingTracker()
+_typing_sweeper_started = False
+
+
+def _emit_typing_frame(event, frame, sender, skip_sid=None):
+    socketio.emit(event, dict(frame, sender=sender), room=frame['room'], skip_sid=skip_sid)
+
+
+def _sweep_typing():
+    # Набор без событий дольше TYPING_TIMEOUT завершается автоматически
+    while True:
+        socketio.sleep(1)
+        for frame in typing_tracker.expire():
+            _emit_typing_frame('stop_typing', frame, None)
+
+
+def _ensure_typing_sweeper():
+    global _typing_sweeper_started
+    if not _typing_sweeper_started:
+        _typing_sweeper_started = True
+        socketio.start_background_task(_sweep_typing)
+
+
+# Периодическая сверка счётчиков постов с лайками, комментариями и репостами (0 - отключена)
+POST_COUNTERS_RECONCILE_INTERVAL = int(os.environ.get('POST_COUNTERS_RECONCILE_INTERVAL', 3600))
+
+
+def _reconcile_post_counters():
+    while True:
+        socketio.sleep(POST_COUNTERS_RECONCILE_INTERVAL)
+        try:
+            # Небольшими пакетами, чтобы не занимать поток-писатель надолго
+            repaired, after_id = 0, 0
+            while after_id is not None:
+                fixed, after_id = reconcile_post_counters(after_id)
+                repaired += fixed
+            if repaired:
+                log.warning("Исправлены счётчики у %d постов", repaired)
+        except Exception:
+            log.exception("Ошибка при сверке счётчиков постов")
+
+
+if POST_COUNTERS_RECONCILE_INTERVAL > 0:
+    socketio.start_background_task(_reconcile_post_counters)
+
+
+@app.teardown_request
+def _flush_caches(exc=None):
+    # Сбросы кэшей, накопленные задачами записи, уходят в Redis в конце каждого HTTP-запроса
+    # и каждого события Socket.IO (обработчик события тоже выполняется в контексте запроса)
+    query_cache.flush()
+    if redis_config.feed_cache is not None:
+        redis_config.feed_cache.flush()
+
+
+# Как часто писать в журнал долю попаданий в кэш ленты, сек (0 - не писать)
+FEED_CACHE_STATS_INTERVAL = int(os.environ.get('FEED_CACHE_STATS_INTERVAL', 600))
+
+
+def _report_feed_cache():
+    while True:
+        socketio.sleep(FEED_CACHE_STATS_INTERVAL)
+        stats = redis_config.feed_cache.stats()
+        log.info("Кэш ленты: страницы %s (попаданий %d, промахов %d), посты %s (попаданий %d, промахов %d), "
+                 "ошибок %d, ждут отправки %d", stats['page_hit_rate'], stats['page_hits'], stats['page_misses'],
+                 stats['post_hit_rate'], stats['post_hits'], stats['post_misses'], stats['errors'], stats['pending'])
+
+
+if redis_config.feed_cache is not None and FEED_CACHE_STATS_INTERVAL > 0:
+    socketio.start_background_task(_report_feed_cache)
+
+# Как часто удалять из журнала изменений записи старше CHANGE_LOG_RETENTION_DAYS, сек (0 - не удалять)
+CHANGE_LOG_TRIM_INTERVAL = int(os.environ.get('CHANGE_LOG_TRIM_INTERVAL', 3600))
+
+
+def _trim_change_log():
+    while True:
+        socketio.sleep(CHANGE_LOG_TRIM_INTERVAL)
+        try:
+            removed = trim_change_log()
+        except Exception:
+            log.exception("Не удалось очистить журнал изменений")
+            continue
+        if removed:
+            log.info("Журнал изменений: удалено старых записей %d", removed)
+
+
+if CHANGE_LOG_TRIM_INTERVAL > 0:
+    socketio.start_background_task(_trim_change_log)
 
 init_db()
 
 
 @app.route('/')
 def index():
-    print(f"index called, session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("No session in index")
         return redirect(url_for('login'))
     user_id = session['user_id']
     username = session['username']
@@ -69,9 +230,8 @@ def index():
     user_chats = get_user_chats(user_id)
     user_groups = get_groups_for_user(user_id)
     user_channels = get_channels_for_user(user_id)
-    print(f"user_chats: {user_chats}")
-    print(f"user_groups: {user_groups}")
-    print(f"user_channels: {user_channels}")
+    log.debug("index: user_id=%s chats=%d groups=%d channels=%d",
+              user_id, len(user_chats), len(user_groups), len(user_channels))
     return render_template('index.html', username=username, user=user, user_chats=user_chats, user_groups=user_groups, user_channels=user_channels)
 
 
@@ -80,7 +240,7 @@ def login():
     if request.method == 'POST':
         username = request.form['username'].lower()
         password = request.form['password']
-        user = get_user_by_username(username)
+        user = get_user_credentials(username)
         if user and verify_password(password, user['password']):
             session['user_id'] = user['id']
             session['username'] = user['username']
@@ -113,9 +273,7 @@ def logout():
         username = session.get('username')
         # Очищаем онлайн статус при выходе
         if username:
-            online_users.pop(username, None)
-            user_sids.pop(username, None)
-            user_chat_context.pop(username, None)
+            presence.disconnect(username)
             # Уведомляем всех о выходе пользователя
             socketio.emit('user_status_update', {'user': username, 'status': 'offline'})
 
@@ -141,17 +299,20 @@ def chat_history(username):
         return jsonify({'messages': [], 'chat_id': None})
     other_user = get_user_by_username(username)
     if not other_user:
-        print(f"Other user {username} not found")
+        log.debug("Пользователь %s не найден", username)
         return jsonify({'messages': [], 'chat_id': None})
     chat_id = get_or_create_chat(session['user_id'], other_user['id'])
     
-    # Параметры пагинации
+    # Параметры пагинации: курсор (before_id/after_id) или номер страницы
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
     
-    messages = get_messages(chat_id, offset=(page-1)*per_page, limit=per_page)
-    print(f"Chat {chat_id} with {username} messages: {len(messages)}")
-    return jsonify({'messages': messages, 'chat_id': chat_id})
+    messages = get_messages(chat_id, offset=(page-1)*per_page, limit=per_page, before_id=before_id, after_id=after_id)
+    next_cursor = next_history_cursor(messages, per_page, before_id)
+    log.debug("История чата %s с %s: %d сообщений", chat_id, username, len(messages))
+    return jsonify({'messages': messages, 'chat_id': chat_id, 'next_cursor': next_cursor})
 
 
 @app.route('/group/<group_name>/history')
@@ -162,16 +323,19 @@ def group_history(group_name):
     if not group:
         return jsonify({'messages': [], 'pinned': None, 'group_id': None})
     
-    # Параметры пагинации
+    # Параметры пагинации: курсор (before_id/after_id) или номер страницы
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
     
-    messages = get_group_messages(group['id'], offset=(page-1)*per_page, limit=per_page)
+    messages = get_group_messages(group['id'], offset=(page-1)*per_page, limit=per_page, before_id=before_id, after_id=after_id)
+    next_cursor = next_history_cursor(messages, per_page, before_id)
     try:
         pinned = get_pinned_message(group['id'])
     except:
         pinned = None
-    return jsonify({'messages': messages, 'pinned': pinned, 'group_id': group['id']})
+    return jsonify({'messages': messages, 'pinned': pinned, 'group_id': group['id'], 'next_cursor': next_cursor})
 
 
 @app.route('/channel/<channel_name>/history')
@@ -182,13 +346,27 @@ def channel_history(channel_name):
     if not channel:
         return jsonify({'messages': [], 'pinned': None, 'channel_id': None})
     
-    # Параметры пагинации
+    # Параметры пагинации: курсор (before_id/after_id) или номер страницы
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
     
-    messages = get_channel_messages(channel['id'], offset=(page-1)*per_page, limit=per_page)
+    messages = get_channel_messages(channel['id'], offset=(page-1)*per_page, limit=per_page, before_id=before_id, after_id=after_id)
+    next_cursor = next_history_cursor(messages, per_page, before_id)
     pinned = None  # Каналы не имеют закрепленных сообщений пока
-    return jsonify({'messages': messages, 'pinned': pinned, 'channel_id': channel['id']})
+    return jsonify({'messages': messages, 'pinned': pinned, 'channel_id': channel['id'], 'next_cursor': next_cursor})
+
+
+@app.route('/sync')
+def sync():
+    """Изменения во всех беседах пользователя после токена since (без since - только текущий токен)"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Не авторизован'}), 401
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'changes': [], 'token': get_sync_token(), 'has_more': False})
+    return jsonify(get_changes_since(session['user_id'], since))
 
 
 # === Socket.IO ===
@@ -197,18 +375,63 @@ def channel_history(channel_name):
 def handle_connect():
     username = session.get('username')
     if username:
-        user_sids[username] = request.sid
-        online_users[username] = datetime.datetime.now()
+        _ensure_presence_sweeper()
+        came_online = presence.connect(username, request.sid)
+        join_room(user_room(username))
+        for channel in get_channels_for_user(session['user_id']):
+            join_room(channel_feed_room(channel['id']))
+        if came_online:
+            emit('user_status_update', {'user': username, 'status': 'online'}, broadcast=True)
+
+
+@socketio.on('heartbeat')
+def handle_heartbeat():
+    username = session.get('username')
+    if not username:
+        return
+    came_online, forgotten = presence.heartbeat(username, request.sid)
+    if came_online:
+        # Сокет успел истечь (например, после долгой паузы сети) и вернулся
         emit('user_status_update', {'user': username, 'status': 'online'}, broadcast=True)
+    if forgotten:
+        # Вместе с истёкшим сокетом забыт и открытый в нём чат: клиент присылает его заново
+        emit('resend_chat_context')
+
+
+@socketio.on('sync')
+def handle_sync(data):
+    user_id = session.get('user_id')
+    if not user_id:
+        return
+    since = (data or {}).get('since')
+    if since is None:
+        emit('sync_result', {'changes': [], 'token': get_sync_token(), 'has_more': False})
+    else:
+        emit('sync_result', get_changes_since(user_id, int(since)))
+
+
+@socketio.on('refresh_channel_feeds')
+def handle_refresh_channel_feeds():
+    """Привести комнаты лент каналов сокета в соответствие с текущими подписками"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return
+    wanted = {channel_feed_room(c['id']) for c in get_channels_for_user(user_id)}
+    for room in rooms():
+        if room.startswith('channel_feed_') and room not in wanted:
+            leave_room(room)
+    for room in wanted:
+        join_room(room)
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
     username = session.get('username')
-    if username:
-        online_users.pop(username, None)
-        user_sids.pop(username, None)
-        user_chat_context.pop(username, None)
+    if not username:
+        return
+    for frame in typing_tracker.stop_all(username):
+        _emit_typing_frame('stop_typing', frame, username, skip_sid=request.sid)
+    if presence.disconnect(username, request.sid):
         emit('user_status_update', {'user': username, 'status': 'offline'}, broadcast=True)
 
 
@@ -218,45 +441,33 @@ def handle_set_context(data):
     if not username:
         return
     new_room = data.get('room')
-    old_room = user_chat_context.get(username)
-    user_chat_context[username] = new_room
+    old_room = presence.set_context(username, request.sid, new_room)
 
     if new_room and new_room != old_room:
+        # Все непрочитанные сообщения отмечаются одной операцией и одним событием с диапазоном
+        # Курсор прочтения сдвигается только участнику беседы; личный чат не создаётся
+        up_to_id = data.get('up_to_id')
+        user_id = session.get('user_id')
+        read = None
         if new_room.startswith('group_'):
-            group_name = new_room.replace('group_', '')
-            group = get_group_by_name(group_name)
-            if group:
-                for msg in get_group_messages(group['id']):
-                    if msg['sender'] != username and not msg['is_read']:
-                        update_group_message_read(msg['id'], True)
-                        socketio.emit('message_status', {
-                            'msg_id': msg['id'],
-                            'status': 'read',
-                            'room': new_room
-                        }, room=new_room)
+            group = get_group_by_name(new_room.replace('group_', ''))
+            if group and any(m.user_id == user_id for m in get_roster('group', group['id'])):
+                read = mark_conversation_read('group', group['id'], username, up_to_id)
         elif new_room.startswith('channel_'):
-            channel_name = new_room.replace('channel_', '')
-            channel = get_channel_by_name(channel_name)
-            if channel:
-                for msg in get_channel_messages(channel['id']):
-                    if msg['sender'] != username and not msg['is_read']:
-                        update_channel_message_read(msg['id'], True)
-                        socketio.emit('message_status', {
-                            'msg_id': msg['id'],
-                            'status': 'read',
-                            'room': new_room
-                        }, room=new_room)
+            channel = get_channel_by_name(new_room.replace('channel_', ''))
+            if channel and any(m.user_id == user_id for m in get_roster('channel', channel['id'])):
+                read = mark_conversation_read('channel', channel['id'], username, up_to_id)
         else:
             parts = new_room.split('_')
             if len(parts) == 2:
-                sender = parts[0] if parts[1] == username else parts[1]
-                unread_msgs = get_unread_messages(username, sender)
-                for msg in unread_msgs:
-                    mark_message_as_read(msg['id'])
-                    socketio.emit('message_status', {
-                        'msg_id': msg['id'],
-                        'status': 'read'
-                    }, room=new_room)
+                user1 = get_user_by_username(parts[0])
+                user2 = get_user_by_username(parts[1])
+                if user1 and user2 and user_id in (user1['id'], user2['id']):
+                    chat_id = find_chat(user1['id'], user2['id'])
+                    if chat_id:
+                        read = mark_conversation_read('dm', chat_id, username, up_to_id)
+        if read:
+            socketio.emit('messages_read', dict(read, room=new_room, reader=username, status='read'), room=new_room)
 
 
 @socketio.on('join')
@@ -267,15 +478,21 @@ def on_join(data):
 
 @socketio.on('typing')
 def handle_typing(data):
-    room = data['room']
-    sender = data['sender']
-    emit('typing', {'sender': sender}, room=room, include_self=False)
+    sender = session.get('username')
+    if not sender:
+        return
+    _ensure_typing_sweeper()
+    frame = typing_tracker.start(data['room'], sender)
+    if frame:
+        _emit_typing_frame('typing', frame, sender, skip_sid=request.sid)
 
 
 @socketio.on('stop_typing')
 def handle_stop_typing(data):
-    room = data['room']
-    emit('stop_typing', {}, room=room, include_self=False)
+    sender = session.get('username')
+    frame = typing_tracker.stop(data['room'], sender)
+    if frame:
+        _emit_typing_frame('stop_typing', frame, sender, skip_sid=request.sid)
 
 
 @socketio.on('send_message')
@@ -286,7 +503,12 @@ def handle_message(data):
     parent_message_id = data.get('parent_message_id')
     message_type = data.get('message_type', 'text')
     audio_path = data.get('audio_path')
-    print(f"DEBUG: Handling send_message from {sender} in room {room}: {message}")
+    socket_log.debug("send_message от %s в %s", sender, room)
+
+    # Отправка сообщения завершает набор текста
+    typing_frame = typing_tracker.stop(room, sender)
+    if typing_frame:
+        _emit_typing_frame('stop_typing', typing_frame, sender, skip_sid=request.sid)
 
     if parent_message_id:
         parent_msg = get_message_by_id(parent_message_id)
@@ -297,7 +519,6 @@ def handle_message(data):
         parent_message = None
 
     if not room.startswith('channel_'):
-        print(f"DEBUG: Emitting receive_message to room {room} (broadcast)")
         socketio.emit('receive_message', {
             'msg': message, 'sender': sender, 'room': room,
             'parent_message_id': parent_message_id,
@@ -307,24 +528,27 @@ def handle_message(data):
             'audio_path': audio_path
         }, room=room)
 
+    # Сообщение сохраняется одной задачей записи (вместе с прочтением теми, у кого чат открыт);
+    # писатель объединяет задачи от одновременных отправителей в одну транзакцию, и
+    # подтверждение 'delivered' уходит только после её фиксации
     if room.startswith('group_'):
         group_name = room.replace('group_', '')
         group = get_group_by_name(group_name)
         if group:
-            msg_id = save_group_message(group['id'], sender, message, parent_message_id=parent_message_id, message_type=message_type, audio_path=audio_path)
+            # Обновить список чатов для всех участников группы (состав берётся из кэша, без запросов)
+            members = get_roster('group', group['id'])
+            watching = presence.viewers_of(room)
+            viewers = [m.username for m in members if m.username != sender and m.username in watching]
+            msg_id, reads = post_message('group', group['id'], sender, message, parent_message_id, message_type,
+                                         audio_path, readers=viewers)
             socketio.emit('message_status', {
                 'msg_id': msg_id,
                 'status': 'delivered'
             }, room=room)
-            # Обновить список чатов для всех участников группы
-            with get_db_connection() as conn:
-                members = conn.execute("SELECT user_id FROM group_members WHERE group_id = ?", (group['id'],)).fetchall()
-                for m in members:
-                    uid = m['user_id']
-                    uname = conn.execute("SELECT username FROM users WHERE id = ?", (uid,)).fetchone()['username']
-                    if user_chat_context.get(uname) == room:
-                        update_group_message_read(msg_id, True)
-                    socketio.emit('update_chat_list', room=user_sids.get(uname))
+            for reader, read in reads.items():
+                socketio.emit('messages_read', dict(read, room=room, reader=reader, status='read'), room=room)
+            for m in members:
+                socketio.emit('update_chat_list', room=user_room(m.username))
 
     else:
         parts = room.split('_')
@@ -334,29 +558,28 @@ def handle_message(data):
             user2 = get_user_by_username(u2)
             if user1 and user2:
                 chat_id = get_or_create_chat(user1['id'], user2['id'])
-                msg_id = save_message(chat_id, sender, message, parent_message_id, message_type, audio_path)
-                mark_message_as_delivered(msg_id)
+                # Если получатель в этом чате, сообщение сразу сохраняется прочитанным им
+                recipient = u2 if u1 == sender else u1
+                recipient_viewing = recipient in presence.viewers_of(room)
+                msg_id, reads = post_message('dm', chat_id, sender, message, parent_message_id, message_type, audio_path,
+                                             status='delivered', readers=(recipient,) if recipient_viewing else ())
                 socketio.emit('message_status', {
                     'msg_id': msg_id,
                     'status': 'delivered'
                 }, room=room)
-
-                # Если получатель в этом чате, отметить сообщение как прочитанное
-                recipient = u2 if u1 == sender else u1
-                if user_chat_context.get(recipient) == room:
-                    mark_message_as_read(msg_id)
+                if recipient in reads:
+                    socketio.emit('messages_read', dict(reads[recipient], room=room, reader=recipient, status='read'), room=room)
 
                 # Обновить список чатов для отправителя и получателя
-                socketio.emit('update_chat_list', room=user_sids.get(sender))
-                socketio.emit('update_chat_list', room=user_sids.get(recipient))
+                socketio.emit('update_chat_list', room=user_room(sender))
+                socketio.emit('update_chat_list', room=user_room(recipient))
 
-                if recipient in user_sids:
-                    recipient_sid = user_sids[recipient]
-                    if user_chat_context.get(recipient) != room:
-                        socketio.emit('push_notification', {
-                            'sender': sender,
-                            'message': message
-                        }, room=recipient_sid)
+                if not recipient_viewing and presence.is_online(recipient):
+                    socketio.emit('push_notification', {
+                        'sender': sender,
+                        'message': message,
+                        'room': room
+                    }, room=user_room(recipient))
 
     if room.startswith('channel_'):
         channel_name = room.replace('channel_', '')
@@ -364,7 +587,6 @@ def handle_message(data):
         if channel:
             user_role = get_user_channel_role(session.get('user_id'), channel['id'])
             if user_role == 'Admin':
-                print(f"DEBUG: Emitting receive_message to channel room {room} (broadcast)")
                 socketio.emit('receive_message', {
                     'msg': message, 'sender': sender, 'room': room,
                     'parent_message_id': parent_message_id,
@@ -373,26 +595,21 @@ def handle_message(data):
                     'message_type': message_type,
                     'audio_path': audio_path
                 }, room=room)
-                msg_id = save_channel_message(channel['id'], sender, message, parent_message_id=parent_message_id, message_type=message_type, audio_path=audio_path)
+                msg_id, _ = post_message('channel', channel['id'], sender, message, parent_message_id, message_type, audio_path)
                 socketio.emit('message_status', {
                     'msg_id': msg_id,
                     'status': 'delivered'
                 }, room=room)
-                # Уведомить всех участников о новом сообщении
-                with get_db_connection() as conn:
-                    members = conn.execute("SELECT user_id FROM channel_members WHERE channel_id = ?", (channel['id'],)).fetchall()
-                    for m in members:
-                        uid = m['user_id']
-                        uname = conn.execute("SELECT username FROM users WHERE id = ?", (uid,)).fetchone()['username']
-                        if uname != sender:  # Не уведомлять отправителя
-                            recipient_sid = user_sids.get(uname)
-                            if recipient_sid:
-                                if user_chat_context.get(uname) != room:
-                                    socketio.emit('push_notification', {
-                                        'sender': sender,
-                                        'message': message
-                                    }, room=recipient_sid)
-                        socketio.emit('update_chat_list', room=user_sids.get(uname))
+                # Уведомить всех подписчиков одной рассылкой в ленту канала: пакет сериализуется один раз.
+                # Пропускаются все сокеты отправителя (другие его устройства тоже), а тех, кто сейчас
+                # смотрит канал, отфильтровывает клиент по полю room
+                feed = channel_feed_room(channel['id'])
+                socketio.emit('push_notification', {
+                    'sender': sender,
+                    'message': message,
+                    'room': room
+                }, room=feed, skip_sid=list(presence.sids_for(sender) | {request.sid}))
+                socketio.emit('update_chat_list', room=feed)
             else:
                 emit('error', {'msg': 'Только администраторы могут отправлять сообщения в канале'})
         else:
@@ -416,38 +633,34 @@ def handle_create_group(data):
     emit('group_created', {'name': group_name}, broadcast=True)
 
 
+def conversation_for_room(room):
+    """Беседа (kind, ref_id) по имени комнаты Socket.IO или None (личный чат не создаётся)"""
+    if room.startswith('group_'):
+        group = get_group_by_name(room.replace('group_', ''))
+        return ('group', group['id']) if group else None
+    if room.startswith('channel_'):
+        channel = get_channel_by_name(room.replace('channel_', ''))
+        return ('channel', channel['id']) if channel else None
+    parts = room.split('_')
+    if len(parts) != 2:
+        return None
+    user1 = get_user_by_username(parts[0])
+    user2 = get_user_by_username(parts[1])
+    if not user1 or not user2:
+        return None
+    chat_id = find_chat(user1['id'], user2['id'])
+    return ('dm', chat_id) if chat_id else None
+
+
 @socketio.on('delete_message')
 def handle_delete_message(data):
     msg_id = data['msg_id']
     room = data['room']
     sender = session.get('username')
 
-    # Проверяем: это его сообщение?
-    if room.startswith('group_'):
-        msg = next((m for m in get_group_messages(get_group_by_name(room.replace('group_', ''))['id']) if m['id'] == msg_id), None)
-        is_group = True
-    elif room.startswith('channel_'):
-        channel_name = room.replace('channel_', '')
-        channel = get_channel_by_name(channel_name)
-        if channel:
-            msg = next((m for m in get_channel_messages(channel['id']) if m['id'] == msg_id), None)
-            is_group = False  # Для delete_message, канал не group
-        else:
-            msg = None
-    else:
-        parts = room.split('_')
-        chat_id = get_or_create_chat(get_user_by_username(parts[0])['id'], get_user_by_username(parts[1])['id'])
-        msg = next((m for m in get_messages(chat_id) if m['id'] == msg_id), None)
-        is_group = False
-
-    if msg and msg['sender'] == sender:
-        if room.startswith('channel_'):
-            # Для каналов удаляем из channel_messages
-            with get_db_connection() as conn:
-                conn.execute("DELETE FROM channel_messages WHERE id = ?", (msg_id,))
-                conn.commit()
-        else:
-            delete_message(msg_id, is_group)
+    # Удаляется только своё сообщение из этой беседы: проверка и удаление в одной задаче записи
+    conversation = conversation_for_room(room)
+    if conversation and delete_own_message(msg_id, sender, *conversation):
         emit('message_deleted', {'msg_id': msg_id}, room=room)
 
 
@@ -458,32 +671,9 @@ def handle_edit_message(data):
     room = data['room']
     sender = session.get('username')
 
-    # Проверяем: это его сообщение?
-    if room.startswith('group_'):
-        msg = next((m for m in get_group_messages(get_group_by_name(room.replace('group_', ''))['id']) if m['id'] == msg_id), None)
-        if msg and msg['sender'] == sender:
-            with get_db_connection() as conn:
-                conn.execute("UPDATE group_messages SET message = ?, edited = 1 WHERE id = ?", (new_msg, msg_id))
-                conn.commit()
-    elif room.startswith('channel_'):
-        channel_name = room.replace('channel_', '')
-        channel = get_channel_by_name(channel_name)
-        if channel:
-            msg = next((m for m in get_channel_messages(channel['id']) if m['id'] == msg_id), None)
-            if msg and msg['sender'] == sender:
-                with get_db_connection() as conn:
-                    conn.execute("UPDATE channel_messages SET message = ?, edited = 1 WHERE id = ?", (new_msg, msg_id))
-                    conn.commit()
-    else:
-        parts = room.split('_')
-        chat_id = get_or_create_chat(get_user_by_username(parts[0])['id'], get_user_by_username(parts[1])['id'])
-        msg = next((m for m in get_messages(chat_id) if m['id'] == msg_id), None)
-        if msg and msg['sender'] == sender:
-            with get_db_connection() as conn:
-                conn.execute("UPDATE messages SET message = ?, edited = 1 WHERE id = ?", (new_msg, msg_id))
-                conn.commit()
-
-    if msg and msg['sender'] == sender:
+    # Правится только своё сообщение из этой беседы: UPDATE ... WHERE id = ? AND sender = ?
+    conversation = conversation_for_room(room)
+    if conversation and edit_own_message(msg_id, sender, new_msg, *conversation):
         emit('message_edited', {'msg_id': msg_id, 'new_msg': new_msg}, room=room)
 
 
@@ -491,12 +681,12 @@ def handle_edit_message(data):
 def handle_pin_message(data):
     group_name = data['group']
     msg_id = data['msg_id']
-    sender = session.get('username')
-    group_id = get_group_by_name(group_name)['id']
-    save_pinned_message(group_id, msg_id)
-    msg = next((m for m in get_group_messages(group_id) if m['id'] == msg_id), None)
-    msg_text = msg['message'] if msg else 'Сообщение'
-    emit('pinned_message', {'msg': msg_text, 'group': group_name}, broadcast=True)
+    group = get_group_by_name(group_name)
+    msg = get_conversation_message(msg_id, 'group', group['id']) if group else None
+    if not msg:
+        return
+    save_pinned_message(group['id'], msg_id)
+    emit('pinned_message', {'msg': msg['message'], 'group': group_name}, broadcast=True)
 
 
 @socketio.on('unpin_message')
@@ -509,15 +699,13 @@ def handle_unpin_message(data):
 @socketio.on('new_chat')
 def handle_new_chat(data):
     other_user = data['with']
-    if other_user in user_sids:
-        socketio.emit('new_chat', {'with': session['username']}, room=user_sids[other_user])
+    socketio.emit('new_chat', {'with': session['username']}, room=user_room(other_user))
 
 
 @socketio.on('delete_chat_socket')
 def handle_delete_chat_socket(data):
     other_user = data['with']
-    if other_user in user_sids:
-        socketio.emit('chat_deleted', {'with': session['username']}, room=user_sids[other_user])
+    socketio.emit('chat_deleted', {'with': session['username']}, room=user_room(other_user))
 
 
 
@@ -533,7 +721,7 @@ def profile():
     if not user:
         session.clear()
         return redirect(url_for('login'))
-    print(f"DEBUG: Profile for {username}, avatar: {user.get('avatar')}")
+    log.debug("Профиль %s, аватар: %s", username, user['avatar'])
     # Преобразовать registration_date в datetime объект
     user_dict = dict(user)
     if user_dict.get('registration_date'):
@@ -545,7 +733,7 @@ def profile():
     following = get_following(session['user_id'])
     posts = get_posts_for_user(session['user_id'])
     reposts = get_reposts_for_user(session['user_id'])
-    feed = get_feed(session['user_id'])
+    feed = get_feed_cached(session['user_id'])
     return render_template('profile.html', user=user_dict, is_owner=is_owner, is_following=is_following_user, followers=followers, following=following, posts=posts, reposts=reposts, feed=feed, timestamp=timestamp)
 
 
@@ -580,9 +768,7 @@ def update_username():
     if get_user_by_username(new_username):
         return jsonify({'success': False, 'error': 'Имя занято'})
     
-    with get_db_connection() as conn:
-        conn.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, session['user_id']))
-        conn.commit()
+    update_user(session['user_id'], username=new_username)
     
     session['username'] = new_username
     return jsonify({'success': True, 'username': new_username})
@@ -595,16 +781,14 @@ def update_password():
     old_password = request.form['old_password']
     new_password = request.form['new_password']
     
-    user = get_user_by_username(session['username'])
+    user = get_user_credentials(session['username'])
     if not verify_password(old_password, user['password']):
         return jsonify({'success': False, 'error': 'Старый пароль неверен'})
     
     if len(new_password) < 6:
         return jsonify({'success': False, 'error': 'Пароль должен быть не менее 6 символов'})
     
-    with get_db_connection() as conn:
-        conn.execute("UPDATE users SET password = ? WHERE id = ?", (hash_password(new_password), session['user_id']))
-        conn.commit()
+    update_user(session['user_id'], password=hash_password(new_password))
     
     return jsonify({'success': True})
 
@@ -630,22 +814,13 @@ def update_profile():
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             file.save(filepath)
             banner_photo = filename
-    print(f"DEBUG: update_profile - banner_photo in files: {'banner_photo' in request.files}, banner_photo: {banner_photo}, banner_color: {banner_color}")
-
-    # Build dynamic UPDATE query
-    sql = "UPDATE users SET city = ?, bio_short = ?, country = ?, languages = ?, bio_full = ?, hobbies = ?, status = ?, banner_color = ?"
-    params = (city, bio_short, country, languages, bio_full, hobbies, status, banner_color)
+    log.debug("update_profile: banner_photo=%s banner_color=%s", banner_photo, banner_color)
 
+    fields = dict(city=city, bio_short=bio_short, country=country, languages=languages, bio_full=bio_full,
+                  hobbies=hobbies, status=status, banner_color=banner_color)
     if banner_photo is not None:
-        sql += ", banner_photo = ?"
-        params += (banner_photo,)
-
-    sql += " WHERE id = ?"
-    params += (session['user_id'],)
-
-    with get_db_connection() as conn:
-        conn.execute(sql, params)
-        conn.commit()
+        fields['banner_photo'] = banner_photo
+    update_user(session['user_id'], **fields)
 
     return jsonify({'success': True})
 
@@ -657,7 +832,7 @@ def user_online_status(username):
 
     # ЕДИНСТВЕННЫЙ способ определить онлайн статус - проверка подключения через Socket.IO
     # Активные сессии в базе данных не учитываются, так как они могут оставаться после выхода
-    if username in online_users:
+    if presence.is_online(username):
         return jsonify({'online': True, 'last_seen': None})
 
     # Если пользователь не подключен через Socket.IO, он оффлайн
@@ -683,7 +858,11 @@ def get_stats(username):
 
     with get_db_connection() as conn:
         # Messages count
-        msg_count = conn.execute("SELECT COUNT(*) FROM messages WHERE sender = ?", (username,)).fetchone()[0]
+        msg_count = conn.execute("""
+            SELECT COUNT(*) FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'dm'
+            WHERE m.sender = ?
+        """, (username,)).fetchone()[0]
 
         # Likes count
         likes_count = conn.execute("SELECT COUNT(*) FROM likes WHERE user_id = ?", (user_id,)).fetchone()[0]
@@ -702,7 +881,9 @@ def get_stats(username):
         # Peak hour
         peak_hour_data = conn.execute("""
             SELECT strftime('%H', timestamp) as hour, COUNT(*) as count
-            FROM messages WHERE sender = ?
+            FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'dm'
+            WHERE m.sender = ?
             GROUP BY hour ORDER BY count DESC LIMIT 1
         """, (username,)).fetchone()
         peak_hour = peak_hour_data['hour'] if peak_hour_data else None
@@ -710,7 +891,9 @@ def get_stats(username):
         # Peak day
         peak_day_data = conn.execute("""
             SELECT strftime('%w', timestamp) as day, COUNT(*) as count
-            FROM messages WHERE sender = ?
+            FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'dm'
+            WHERE m.sender = ?
             GROUP BY day ORDER BY count DESC LIMIT 1
         """, (username,)).fetchone()
         days = ['Воскресенье', 'Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота']
@@ -737,7 +920,7 @@ def user_stats(username):
         total_posts = conn.execute("SELECT COUNT(*) FROM posts WHERE user_id = ?", (user_id,)).fetchone()[0]
 
         # Total likes received
-        total_likes = conn.execute("SELECT COUNT(*) FROM likes WHERE post_id IN (SELECT id FROM posts WHERE user_id = ?)", (user_id,)).fetchone()[0]
+        total_likes = conn.execute("SELECT COALESCE(SUM(likes_count), 0) FROM posts WHERE user_id = ?", (user_id,)).fetchone()[0]
 
         # Total reposts
         total_reposts = conn.execute("SELECT COUNT(*) FROM reposts WHERE user_id = ?", (user_id,)).fetchone()[0]
@@ -801,60 +984,28 @@ def user_detailed_stats(username):
         }
     })
 
+_FEED_FIELDS = ('id', 'username', 'content', 'image_url', 'created_at', 'likes_count', 'comments_count',
+                'reposts_count', 'is_liked', 'is_reposted', 'is_reacted', 'avatar', 'comments', 'reactions')
+
+
 @app.route('/feed_data')
 def feed_data():
-    print(f"feed_data called, session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("No user_id in session")
         return jsonify({'feed': []})
     user_id = session['user_id']
-    print(f"Getting feed for user_id: {user_id}")
     
     # Параметры пагинации
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
     
     try:
-        feed = get_feed(user_id, offset=(page-1)*per_page, limit=per_page)
-        print(f"Feed length: {len(feed)}")
-        feed_data = []
-        for p in feed:
-            print(f"Processing post {p['id']} by {p['username']}")
-            user_info = get_user_by_username(p['username'])
-            avatar = user_info['avatar'] if user_info else None
-            # Получить последние 3 комментария
-            comments = get_comments_for_post(p['id'])[:3]
-            # Получить реакции для поста
-            reactions = get_reactions_for_post(p['id'])
-            # Группировать реакции по эмодзи
-            reactions_grouped = {}
-            for r in reactions:
-                emoji = r['emoji']
-                if emoji not in reactions_grouped:
-                    reactions_grouped[emoji] = []
-                reactions_grouped[emoji].append({'username': r['username'], 'user_id': r['user_id']})
-            feed_data.append({
-                'id': p['id'],
-                'username': p['username'],
-                'content': p['content'],
-                'image_url': p['image_url'],
-                'created_at': p['created_at'],
-                'likes_count': p['likes_count'],
-                'comments_count': p['comments_count'],
-                'reposts_count': p['reposts_count'],
-                'is_liked': is_liked(user_id, p['id']),
-                'is_reposted': is_reposted(user_id, p['id']),
-                'is_reacted': is_reacted(user_id, p['id']),
-                'avatar': avatar,
-                'comments': comments,
-                'reactions': reactions_grouped
-            })
-        print(f"Returning feed_data with {len(feed_data)} items")
+        feed = get_feed_cached(user_id, offset=(page-1)*per_page, limit=per_page)
+        # Страница уже дополнена аватарами, комментариями, реакциями и отметками зрителя
+        feed_data = [{key: p[key] for key in _FEED_FIELDS} for p in feed]
+        log.debug("feed_data: user_id=%s, %d постов", user_id, len(feed_data))
         return jsonify({'feed': feed_data})
     except Exception as e:
-        print(f"Error in feed_data: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка в feed_data")
         return jsonify({'error': str(e)}), 500
 
 
@@ -862,7 +1013,7 @@ def feed_data():
 def feed_page():
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    feed_posts = get_feed(session['user_id'])
+    feed_posts = get_feed_cached(session['user_id'])
     return render_template('feed.html', feed=feed_posts)
 
 
@@ -878,7 +1029,9 @@ def user_activity_data(username):
         # Активность по дням недели (0=воскресенье, 6=суббота)
         daily_data = conn.execute("""
             SELECT strftime('%w', timestamp) as day, COUNT(*) as count
-            FROM messages WHERE sender = ?
+            FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'dm'
+            WHERE m.sender = ?
             GROUP BY day ORDER BY day
         """, (username,)).fetchall()
 
@@ -895,7 +1048,9 @@ def user_activity_data(username):
         # Активность по часам
         hourly_data = conn.execute("""
             SELECT strftime('%H', timestamp) as hour, COUNT(*) as count
-            FROM messages WHERE sender = ?
+            FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'dm'
+            WHERE m.sender = ?
             GROUP BY hour ORDER BY hour
         """, (username,)).fetchall()
 
@@ -928,55 +1083,36 @@ def get_audio(filename):
 
 @app.route('/upload_avatar', methods=['POST'])
 def upload_avatar():
-    print(f"DEBUG: upload_avatar called, method: {request.method}, headers: {dict(request.headers)}")
-    print(f"DEBUG: session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("DEBUG: No user_id in session, returning error")
         return jsonify({'success': False, 'error': 'Не авторизован'})
 
-    print(f"DEBUG: request.files keys: {list(request.files.keys())}")
     if 'avatar' not in request.files:
-        print("DEBUG: 'avatar' not in request.files, files: {request.files}")
         return jsonify({'success': False, 'error': 'Файл не найден'})
 
     file = request.files['avatar']
-    print(f"DEBUG: file object: {file}, filename: {file.filename}, content_type: {file.content_type}, content_length: {file.content_length}")
     if file.filename == '':
-        print("DEBUG: file.filename is empty")
         return jsonify({'success': False, 'error': 'Файл не выбран'})
 
-    print(f"DEBUG: checking allowed_file for {file.filename}")
     if file and allowed_file(file.filename):
         filename = secure_filename(f"{session['user_id']}_avatar_{int(time.time() * 1000)}_{file.filename}")
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        print(f"DEBUG: generated filename: {filename}, full path: {filepath}")
-        print(f"DEBUG: uploads folder exists: {os.path.exists(app.config['UPLOAD_FOLDER'])}, is writable: {os.access(app.config['UPLOAD_FOLDER'], os.W_OK)}")
         try:
             file.save(filepath)
-            print(f"DEBUG: Avatar saved successfully to {filepath}")
-            print(f"DEBUG: file exists after save: {os.path.exists(filepath)}, size: {os.path.getsize(filepath) if os.path.exists(filepath) else 'N/A'}")
-        except Exception as e:
-            print(f"DEBUG: Error saving file: {e}, type: {type(e)}")
+        except Exception:
+            log.exception("Не удалось сохранить аватар в %s", filepath)
             return jsonify({'success': False, 'error': 'Ошибка сохранения файла'})
 
         # Update DB
         try:
-            with get_db_connection() as conn:
-                print(f"DEBUG: updating DB for user {session['user_id']} with avatar {filename}")
-                conn.execute("UPDATE users SET avatar = ? WHERE id = ?", (filename, session['user_id']))
-                conn.commit()
-                print(f"DEBUG: Avatar updated in DB successfully")
-                # Verify update
-                updated = conn.execute("SELECT avatar FROM users WHERE id = ?", (session['user_id'],)).fetchone()
-                print(f"DEBUG: verified avatar in DB: {updated['avatar'] if updated else 'None'}")
-        except Exception as e:
-            print(f"DEBUG: Error updating DB: {e}, type: {type(e)}")
+            set_user_avatar(session['user_id'], filename)
+        except Exception:
+            log.exception("Не удалось сохранить аватар пользователя %s в базе", session['user_id'])
             return jsonify({'success': False, 'error': 'Ошибка обновления базы данных'})
 
-        print(f"DEBUG: upload_avatar completed successfully, returning filename: {filename}")
+        log.debug("Аватар пользователя %s: %s", session['user_id'], filename)
         return jsonify({'success': True, 'filename': filename})
     else:
-        print("DEBUG: File not allowed, filename: {file.filename}, allowed: {allowed_file(file.filename)}")
+        log.debug("Недопустимый файл аватара: %s", file.filename)
         return jsonify({'success': False, 'error': 'Недопустимый файл'})
 
 @app.route('/delete_avatar', methods=['POST'])
@@ -997,59 +1133,45 @@ def delete_avatar():
                 os.remove(filepath)
 
         # Обновляем базу данных
-        with get_db_connection() as conn:
-            conn.execute("UPDATE users SET avatar = NULL WHERE id = ?", (session['user_id'],))
-            conn.commit()
+        set_user_avatar(session['user_id'], None)
 
         return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error deleting avatar: {e}")
+    except Exception:
+        log.exception("Ошибка при удалении аватара")
         return jsonify({'success': False, 'error': 'Ошибка при удалении аватара'})
 
 
 @app.route('/upload_voice', methods=['POST'])
 def upload_voice():
-    print("DEBUG: upload_voice called")
-    print(f"DEBUG: session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("DEBUG: No session user_id")
         return jsonify({'success': False, 'error': 'Не авторизован'})
 
     user_id = request.form.get('user_id')
     target_id = request.form.get('target_id')
     message_type = request.form.get('message_type')
-    print(f"DEBUG: user_id: {user_id}, target_id: {target_id}, message_type: {message_type}")
 
     if not user_id or not target_id or message_type != 'voice':
-        print("DEBUG: Invalid parameters")
         return jsonify({'success': False, 'error': 'Неверные параметры'})
 
     if 'file' not in request.files:
-        print("DEBUG: No file in request.files")
         return jsonify({'success': False, 'error': 'Файл не найден'})
 
     file = request.files['file']
-    print(f"DEBUG: file.filename: {file.filename}")
     if file.filename == '':
-        print("DEBUG: Empty filename")
         return jsonify({'success': False, 'error': 'Файл не выбран'})
 
-    print(f"DEBUG: allowed_audio_file check: {allowed_audio_file(file.filename)}")
     if file and allowed_audio_file(file.filename):
         filename = secure_filename(f"{session['user_id']}_{int(time.time() * 1000)}_{file.filename}")
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'audio', filename)
-        print(f"DEBUG: Saving to {filepath}")
         try:
             file.save(filepath)
-            print(f"DEBUG: File saved successfully, size: {os.path.getsize(filepath) if os.path.exists(filepath) else 'N/A'}")
-        except Exception as e:
-            print(f"DEBUG: Error saving file: {e}")
+        except Exception:
+            log.exception("Не удалось сохранить голосовое сообщение в %s", filepath)
             return jsonify({'success': False, 'error': 'Ошибка сохранения файла'})
         audio_path = f"audio/{filename}"
-        print(f"DEBUG: Returning success with audio_path: {audio_path}")
+        log.debug("Голосовое сообщение сохранено: %s", audio_path)
         return jsonify({'success': True, 'audio_path': audio_path})
     else:
-        print("DEBUG: Invalid file")
         return jsonify({'success': False, 'error': 'Недопустимый файл'})
 
 @app.route('/upload_banner', methods=['POST'])
@@ -1070,9 +1192,7 @@ def upload_banner():
         file.save(filepath)
 
         # Update DB
-        with get_db_connection() as conn:
-            conn.execute("UPDATE users SET banner_photo = ? WHERE id = ?", (filename, session['user_id']))
-            conn.commit()
+        update_user(session['user_id'], banner_photo=filename)
 
         return jsonify({'success': True, 'filename': filename})
     else:
@@ -1291,16 +1411,12 @@ def forward_message_route():
         return jsonify({'success': False, 'error': 'Не авторизован'})
     message_id = int(request.form.get('message_id'))
     recipient = request.form.get('recipient', '').strip()
-    print(f"Forwarding message {message_id} to {recipient}")
     if not recipient:
         return jsonify({'success': False, 'error': 'Получатель обязателен'})
 
     # Получить сообщение
     with get_db_connection() as conn:
-        msg = conn.execute("SELECT * FROM messages WHERE id = ?", (message_id,)).fetchone() or \
-              conn.execute("SELECT * FROM group_messages WHERE id = ?", (message_id,)).fetchone() or \
-              conn.execute("SELECT * FROM channel_messages WHERE id = ?", (message_id,)).fetchone()
-        print(f"Retrieved message: {dict(msg) if msg else None}")
+        msg = conn.execute("SELECT * FROM conversation_messages WHERE id = ?", (message_id,)).fetchone()
         if not msg:
             return jsonify({'success': False, 'error': 'Сообщение не найдено'})
 
@@ -1308,14 +1424,12 @@ def forward_message_route():
         user_recipient = conn.execute("SELECT id FROM users WHERE username = ?", (recipient,)).fetchone()
         group_recipient = conn.execute("SELECT id FROM groups WHERE name = ?", (recipient,)).fetchone()
         channel_recipient = conn.execute("SELECT id FROM channels WHERE name = ?", (recipient,)).fetchone()
-        print(f"user_recipient: {dict(user_recipient) if user_recipient else None}, group_recipient: {dict(group_recipient) if group_recipient else None}, channel_recipient: {dict(channel_recipient) if channel_recipient else None}")
 
     if user_recipient:
         chat_id = get_or_create_chat(session['user_id'], user_recipient['id'])
-        print(f"Created chat_id: {chat_id}")
         # Пересылаем как обычное сообщение с parent_message_id для отображения оригинального отправителя
         msg_id = save_message(chat_id, session['username'], msg['message'], parent_message_id=message_id)
-        print(f"Forwarded to user chat {chat_id}, new msg_id {msg_id}")
+        log.debug("Сообщение %s переслано в чат %s: %s", message_id, chat_id, msg_id)
         # Уведомить через socket с данными для отображения
         room = f"{min(session['username'], recipient)}_{max(session['username'], recipient)}"
         socketio.emit('receive_message', {
@@ -1332,12 +1446,11 @@ def forward_message_route():
         # Проверить членство
         with get_db_connection() as conn:
             member = conn.execute("SELECT * FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, session['user_id'])).fetchone()
-        print(f"Member check: {dict(member) if member else None}")
         if not member:
             return jsonify({'success': False, 'error': 'Вы не в этой группе'})
         # Пересылаем как обычное сообщение с parent_message_id
         msg_id = save_group_message(group_id, session['username'], msg['message'], parent_message_id=message_id)
-        print(f"Forwarded to group {group_id}, new msg_id {msg_id}")
+        log.debug("Сообщение %s переслано в группу %s: %s", message_id, group_id, msg_id)
         # Уведомить через socket
         room = f"group_{recipient}"
         socketio.emit('receive_message', {
@@ -1354,12 +1467,11 @@ def forward_message_route():
         # Проверить членство
         with get_db_connection() as conn:
             member = conn.execute("SELECT * FROM channel_members WHERE channel_id = ? AND user_id = ?", (channel_id, session['user_id'])).fetchone()
-        print(f"Channel member check: {dict(member) if member else None}")
         if not member:
             return jsonify({'success': False, 'error': 'Вы не в этом канале'})
         # Пересылаем как обычное сообщение с parent_message_id
         msg_id = save_channel_message(channel_id, session['username'], msg['message'], parent_message_id=message_id)
-        print(f"Forwarded to channel {channel_id}, new msg_id {msg_id}")
+        log.debug("Сообщение %s переслано в канал %s: %s", message_id, channel_id, msg_id)
         # Уведомить через socket
         room = f"channel_{recipient}"
         socketio.emit('receive_message', {
@@ -1414,7 +1526,7 @@ def delete_chat_route(chat_id):
     other_user_id = chat['user2_id'] if session['user_id'] == chat['user1_id'] else chat['user1_id']
     with get_db_connection() as conn:
         other_username = conn.execute("SELECT username FROM users WHERE id = ?", (other_user_id,)).fetchone()['username']
-    socketio.emit('chat_deleted', {'with': session['username']}, room=user_sids.get(other_username, None))
+    socketio.emit('chat_deleted', {'with': session['username']}, room=user_room(other_username))
     return jsonify({'success': True})
 
 
@@ -1441,7 +1553,7 @@ def chat_list():
     user_chats = get_user_chats(user_id)
     user_groups = get_groups_for_user(user_id)
     user_channels = get_channels_for_user(user_id)
-    print(f"chat_list for user_id {user_id}: channels {user_channels}")
+    log.debug("chat_list: user_id=%s, %d каналов", user_id, len(user_channels))
     return jsonify({'user_chats': user_chats, 'user_groups': user_groups, 'user_channels': user_channels})
 
 @app.route('/create_group', methods=['POST'])
@@ -1462,12 +1574,9 @@ def create_group_route():
 
 @app.route('/search')
 def search():
-    print(f"search called, session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("No session in search")
         return jsonify({'users': [], 'groups': [], 'channels': []})
     query = request.args.get('q', '').strip()
-    print(f"Query: '{query}'")
     if not query:
         return jsonify({'users': [], 'groups': [], 'channels': []})
     try:
@@ -1475,12 +1584,10 @@ def search():
             users = conn.execute("SELECT id, username, avatar FROM users WHERE LOWER(username) LIKE LOWER(?) AND id != ?", (f'%{query}%', session['user_id'])).fetchall()
             groups = conn.execute("SELECT id, name FROM groups WHERE LOWER(name) LIKE LOWER(?)", (f'%{query}%',)).fetchall()
             channels = conn.execute("SELECT id, name FROM channels WHERE LOWER(name) LIKE LOWER(?)", (f'%{query}%',)).fetchall()
-            print(f"Found users: {[dict(u) for u in users]}, groups: {[dict(g) for g in groups]}, channels: {[dict(c) for c in channels]}")
+            log.debug("Поиск %r: %d пользователей, %d групп, %d каналов", query, len(users), len(groups), len(channels))
         return jsonify({'users': [dict(u) for u in users], 'groups': [dict(g) for g in groups], 'channels': [dict(c) for c in channels]})
     except Exception as e:
-        print(f"Error in search: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка поиска")
         return jsonify({'error': str(e)}), 500
 
 
@@ -1489,9 +1596,7 @@ def advanced_search():
     """
     Расширенный поиск по содержимому сообщений и постов
     """
-    print(f"advanced_search called, session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("No session in advanced_search")
         return jsonify({'error': 'Not authorized'}), 401
     
     query = request.args.get('q', '').strip()
@@ -1500,7 +1605,7 @@ def advanced_search():
     limit = request.args.get('limit', 50, type=int)
     offset = request.args.get('offset', 0, type=int)
     
-    print(f"Advanced search - Query: '{query}', Type: {search_type}, Case sensitive: {case_sensitive}")
+    log.debug("Расширенный поиск %r: тип %s, с учётом регистра: %s", query, search_type, case_sensitive)
     
     if not query:
         return jsonify({
@@ -1540,9 +1645,7 @@ def advanced_search():
             return jsonify(results)
             
     except Exception as e:
-        print(f"Error in advanced_search: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка расширенного поиска")
         return jsonify({'error': str(e)}), 500
 
 
@@ -1551,9 +1654,7 @@ def search_in_chat(chat_partner):
     """
     Локальный поиск по сообщениям в конкретном чате
     """
-    print(f"search_in_chat called for partner: {chat_partner}, session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("No session in search_in_chat")
         return jsonify({'error': 'Not authorized'}), 401
     
     query = request.args.get('q', '').strip()
@@ -1573,9 +1674,7 @@ def search_in_chat(chat_partner):
             'chat_partner': chat_partner
         })
     except Exception as e:
-        print(f"Error in search_in_chat: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка поиска в чате с %s", chat_partner)
         return jsonify({'error': str(e)}), 500
 
 
@@ -1584,9 +1683,7 @@ def search_in_group(group_name):
     """
     Локальный поиск по сообщениям в конкретной группе
     """
-    print(f"search_in_group called for group: {group_name}, session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("No session in search_in_group")
         return jsonify({'error': 'Not authorized'}), 401
     
     query = request.args.get('q', '').strip()
@@ -1606,9 +1703,7 @@ def search_in_group(group_name):
             'group_name': group_name
         })
     except Exception as e:
-        print(f"Error in search_in_group: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка поиска в группе %s", group_name)
         return jsonify({'error': str(e)}), 500
 
 
@@ -1617,9 +1712,7 @@ def search_in_channel(channel_name):
     """
     Локальный поиск по сообщениям в конкретном канале
     """
-    print(f"search_in_channel called for channel: {channel_name}, session user_id: {session.get('user_id')}")
     if 'user_id' not in session:
-        print("No session in search_in_channel")
         return jsonify({'error': 'Not authorized'}), 401
     
     query = request.args.get('q', '').strip()
@@ -1639,9 +1732,7 @@ def search_in_channel(channel_name):
             'channel_name': channel_name
         })
     except Exception as e:
-        print(f"Error in search_in_channel: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка поиска в канале %s", channel_name)
         return jsonify({'error': str(e)}), 500
 
 
@@ -1660,6 +1751,7 @@ def create_channel_route():
         return jsonify({'success': False, 'error': 'Канал с таким названием уже существует'})
     try:
         channel_id = create_channel(channel_name, session['username'], description, is_private)
+        set_channel_subscription(session['username'], channel_id, True)
         socketio.emit('channel_created', {'name': channel_name})
         return jsonify({'success': True, 'channel_id': channel_id})
     except Exception as e:
@@ -1695,6 +1787,7 @@ def add_member_to_channel_route():
             return jsonify({'success': False, 'error': 'Нет прав'})
     try:
         add_user_to_channel(channel['id'], member['id'])
+        set_channel_subscription(member['username'], channel['id'], True)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -1721,6 +1814,7 @@ def remove_member_from_channel_route():
             return jsonify({'success': False, 'error': 'Нет прав'})
     try:
         remove_user_from_channel(channel['id'], member['id'])
+        set_channel_subscription(member['username'], channel['id'], False)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -1779,9 +1873,7 @@ def assign_role_to_member_route():
             return jsonify({'success': False, 'error': 'Нет прав'})
     try:
         # Обновить role_id для участника
-        with get_db_connection() as conn:
-            conn.execute("UPDATE channel_members SET role_id = ? WHERE channel_id = ? AND user_id = ?", (role['id'], channel['id'], member['id']))
-            conn.commit()
+        set_channel_member_role(channel['id'], member['id'], role['id'])
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -1789,42 +1881,37 @@ def assign_role_to_member_route():
 
 @app.route('/create_channel_invite', methods=['POST'])
 def create_channel_invite_route():
-    print("DEBUG: create_channel_invite called")
-    print(f"DEBUG: Request method: {request.method}, form data: {dict(request.form)}")
     if 'user_id' not in session:
-        print("DEBUG: No user_id in session")
         return jsonify({'success': False, 'error': 'Не авторизован'})
     channel_name = request.form.get('channel_name', '').strip()
     expires_days = request.form.get('expires_days')
     max_uses = request.form.get('max_uses')
-    print(f"DEBUG: expires_days={expires_days}, max_uses={max_uses}")
     if not channel_name:
         return jsonify({'success': False, 'error': 'Название канала обязательно'})
     channel = get_channel_by_name(channel_name)
     if not channel:
-        print(f"DEBUG: Channel {channel_name} not found")
+        log.debug("Канал %s не найден", channel_name)
         return jsonify({'success': False, 'error': 'Канал не найден'})
     # Проверить права
     with get_db_connection() as conn:
         user_role = conn.execute("SELECT cr.role_name FROM channel_members cm JOIN channel_roles cr ON cm.role_id = cr.id WHERE cm.channel_id = ? AND cm.user_id = ?", (channel['id'], session['user_id'])).fetchone()
         if not user_role or user_role['role_name'] != 'Admin':
-            print(f"DEBUG: No admin rights for user {session['user_id']}")
+            log.debug("Нет прав администратора у пользователя %s", session['user_id'])
             return jsonify({'success': False, 'error': 'Нет прав'})
     try:
         expires_at = None
         if expires_days:
             expires_at = datetime.datetime.now() + datetime.timedelta(days=int(expires_days))
-            print(f"DEBUG: Calculated expires_at: {expires_at}")
         invite_code = create_channel_invite(channel['id'], session['user_id'], expires_at, int(max_uses) if max_uses else None)
         # Получить новый инвайт для возврата
         with get_db_connection() as conn:
             new_invite = conn.execute("SELECT * FROM channel_invites WHERE invite_code = ?", (invite_code,)).fetchone()
             invite_data = dict(new_invite)
             invite_data['created_by_username'] = conn.execute("SELECT username FROM users WHERE id = ?", (invite_data['created_by'],)).fetchone()['username']
-        print(f"DEBUG: Invite created successfully: {invite_code}, invite_data keys: {list(invite_data.keys())}")
+        log.debug("Приглашение %s создано", invite_code)
         return jsonify({'success': True, 'invite_code': invite_code, 'invite': invite_data})
     except Exception as e:
-        print(f"DEBUG: Exception in create_channel_invite: {e}")
+        log.exception("Ошибка при создании приглашения в канал %s", channel_name)
         return jsonify({'success': False, 'error': str(e)})
 
 
@@ -1941,23 +2028,17 @@ def get_user_channel_role_route(channel_name):
 
 @app.route('/channel/<channel_name>/settings')
 def channel_settings(channel_name):
-    print(f"channel_settings called with channel_name: {repr(channel_name)}")
-    print(f"channel_name type: {type(channel_name)}, len: {len(channel_name)}")
     if 'user_id' not in session:
         return redirect(url_for('login'))
     channel = get_channel_by_name(channel_name)
-    print(f"get_channel_by_name returned: {channel}")
     if not channel:
-        print(f"Channel not found for name: {repr(channel_name)}")
+        log.debug("Канал %r не найден", channel_name)
         return "Канал не найден", 404
     # Проверить, что пользователь участник и имеет права админа
     with get_db_connection() as conn:
-        member_check = conn.execute("SELECT * FROM channel_members WHERE channel_id = ? AND user_id = ?", (channel['id'], session['user_id'])).fetchone()
-        print(f"Member check raw: {dict(member_check) if member_check else None}")
         member_role = conn.execute("SELECT cr.role_name FROM channel_members cm JOIN channel_roles cr ON cm.role_id = cr.id WHERE cm.channel_id = ? AND cm.user_id = ?", (channel['id'], session['user_id'])).fetchone()
-        print(f"Channel {channel_name} member role check: {dict(member_role) if member_role else None}")
         if not member_role or member_role['role_name'] != 'Admin':
-            print(f"No access to {channel_name}: member_role={member_role}")
+            log.debug("Нет доступа к настройкам канала %s", channel_name)
             return "Нет доступа", 403
     members = get_channel_members(channel['id'])
     invites = get_channel_invites(channel['id'])
@@ -1982,27 +2063,24 @@ def channel_members(channel_name):
         if not member_role or member_role['role_name'] != 'Admin':
             return "Нет доступа", 403
     members = get_channel_members(channel['id'])
-    print(f"channel_members: members = {members}")
     return render_template('channel_management.html', channel=channel, members=members, type='members')
 
 
 @app.route('/channel/<channel_name>/invites')
 def channel_invites(channel_name):
-    print(f"DEBUG: Accessing invites for channel {channel_name}")
     if 'user_id' not in session:
         return redirect(url_for('login'))
     channel = get_channel_by_name(channel_name)
     if not channel:
-        print(f"DEBUG: Channel {channel_name} not found")
+        log.debug("Канал %s не найден", channel_name)
         return "Канал не найден", 404
     # Проверить, что пользователь участник и имеет права админа
     with get_db_connection() as conn:
         member = conn.execute("SELECT role_id FROM channel_members WHERE channel_id = ? AND user_id = ?", (channel['id'], session['user_id'])).fetchone()
         if not member or member['role_id'] != 1:  # 1 - Admin
-            print(f"DEBUG: No admin access for user {session['user_id']} in channel {channel_name}")
+            log.debug("Нет прав администратора у пользователя %s в канале %s", session['user_id'], channel_name)
             return "Нет доступа", 403
     invites = get_channel_invites(channel['id'])
-    print(f"DEBUG: Invites for render: {invites}")
     members = get_channel_members(channel['id'])
     # Добавить имя создателя для каждого инвайта
     for invite in invites:
@@ -2033,9 +2111,7 @@ def update_channel_settings(channel_name):
     if name != channel['name']:
         if get_channel_by_name(name):
             return jsonify({'success': False, 'error': 'Канал с таким названием уже существует'})
-    with get_db_connection() as conn:
-        conn.execute("UPDATE channels SET name = ?, description = ?, is_private = ? WHERE id = ?", (name, description, is_private, channel['id']))
-        conn.commit()
+    update_channel(channel['id'], name, description, is_private)
     return redirect(url_for('channel_settings', channel_name=name))
 
 
@@ -2070,13 +2146,11 @@ def handle_event_invite(data):
     add_event_participant(event_id, invitee_user['id'], 'invited')
     
     # Отправить уведомление приглашенному пользователю
-    invitee_sid = user_sids.get(username)
-    if invitee_sid:
-        emit('event_invitation', {
-            'event_id': event_id,
-            'event_title': event['title'],
-            'inviter': inviter_username
-        }, room=invitee_sid)
+    emit('event_invitation', {
+        'event_id': event_id,
+        'event_title': event['title'],
+        'inviter': inviter_username
+    }, room=user_room(username))
     
     emit('event_invite_sent', {
         'event_id': event_id,
@@ -2113,7 +2187,7 @@ def create_event():
         event_date = request.form['event_date']
         location = request.form['location']
         
-        event_id = create_event(title, description, event_date, location, session['user_id'])
+        event_id = save_event(title, description, event_date, location, session['user_id'])
         
         # Добавить создателя как подтвержденного участника
         add_event_participant(event_id, session['user_id'], 'confirmed')
@@ -2218,4 +2292,8 @@ def invite_to_event(event_id):
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    if SOCKETIO_ASYNC_MODE == 'gevent':
+        # Сервер gevent (pywsgi + gevent-websocket): одно соединение - один greenlet, а не поток
+        socketio.run(app, host='0.0.0.0', port=port)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=True)
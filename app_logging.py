@@ -0,0 +1,183 @@
+# app_logging.py
+"""
+Журналирование по подсистемам вместо отладочного print().
+
+Каждый модуль берёт свой логгер get_logger('<подсистема>'); уровень задаётся
+общим LOG_LEVEL и отдельно для подсистем через LOG_LEVELS. Записи не пишутся
+в поток вызывающего: обработчик кладёт их в очередь, а вывод в stderr делает
+отдельный поток (под gevent - поток ОС, как и писатель базы). Если очередь
+переполнена, запись отбрасывается, а не блокирует запрос.
+
+Повторяющиеся записи горячих путей ограничиваются по частоте: не больше
+LOG_RATE_LIMIT записей в секунду на один шаблон сообщения, число пропущенных
+дописывается к следующей пропущенной записи.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from _queue import SimpleQueue
+
+from db_offload import gevent_patched, start_native_thread
+
+# Общий уровень и уровни подсистем, например LOG_LEVELS="socket=DEBUG,db=WARNING"
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+# Сколько записей с одним шаблоном выводить в секунду (0 - без ограничения)
+LOG_RATE_LIMIT = float(os.environ.get('LOG_RATE_LIMIT', 20))
+# Сколько записей может ждать вывода; лишние отбрасываются
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+ROOT_LOGGER = 'chat'
+
+_STOP = object()
+_MAX_BUCKETS = 4096
+
+
+def parse_levels(spec):
+    """'socket=DEBUG,db=WARNING' -> {'socket': 10, 'db': 30}"""
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Не больше rate записей в секунду на пару (логгер, шаблон сообщения).
+
+    Блокировок нет: фильтр вызывается в потоке запроса, а неточность счёта
+    при гонке не важна.
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        self._buckets = {}  # ключ -> [токены, время пополнения, пропущено]
+        self.suppressed = 0
+
+    def filter(self, record, now=None):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        key = (record.name, record.msg)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= _MAX_BUCKETS:
+                self._buckets.clear()  # шаблоны с подставленными значениями не должны копиться
+            bucket = self._buckets[key] = [self.rate, now, 0]
+        bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            self.suppressed += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f"{record.msg} (пропущено похожих записей: {bucket[2]})"
+            bucket[2] = 0
+        return True
+
+
+class _StderrHandler(logging.StreamHandler):
+    # Текущий sys.stderr на момент вывода, а не на момент создания обработчика
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Кладёт записи в очередь; вывод выполняет отдельный поток.
+
+    :param target: обработчик, которому поток передаёт записи
+    :param max_queue: сколько записей может ждать вывода
+    """
+
+    def __init__(self, target, max_queue=LOG_QUEUE_SIZE):
+        # Очередь из C-модуля _queue gevent не подменяет
+        super().__init__(SimpleQueue())
+        self.target = target
+        self.max_queue = max(1, max_queue)
+        self.dropped = 0
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._done = False
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return
+        self._ensure_started()
+        self.queue.put(record)
+
+    def _ensure_started(self):
+        if not self._started:
+            with self._start_lock:
+                if not self._started:
+                    if gevent_patched():
+                        start_native_thread(self._loop)
+                    else:
+                        threading.Thread(target=self._loop, name='log-writer', daemon=True).start()
+                    self._started = True
+
+    def _loop(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            self.target.handle(record)
+        self._done = True
+
+    def flush_and_stop(self, timeout=1.0):
+        """Дождаться вывода накопленных записей (вызывается при завершении процесса)"""
+        if not self._started or self._done:
+            return
+        self.queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        while not self._done and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+_handler = None
+_handler_lock = threading.Lock()
+
+
+def _configure():
+    global _handler
+    with _handler_lock:
+        if _handler is not None:
+            return
+        target = _StderrHandler()
+        target.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler = QueuedHandler(target)
+        handler.addFilter(RateLimitFilter())
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(handler)
+        root.propagate = False
+        for subsystem, level in parse_levels(LOG_LEVELS).items():
+            logging.getLogger(f'{ROOT_LOGGER}.{subsystem}').setLevel(level)
+        atexit.register(handler.flush_and_stop)
+        _handler = handler
+
+
+def get_logger(subsystem):
+    """Логгер подсистемы ('http', 'socket', 'db', ...)"""
+    _configure()
+    return logging.getLogger(f'{ROOT_LOGGER}.{subsystem}')
+
+
+def logging_stats():
+    _configure()
+    limiter = next(f for f in _handler.filters if isinstance(f, RateLimitFilter))
+    return {'queued': _handler.queue.qsize(), 'dropped': _handler.dropped, 'suppressed': limiter.suppressed}
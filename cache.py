@@ -0,0 +1,326 @@
+# cache.py
+"""
+Двухуровневый кэш результатов чтения из базы.
+
+Функция чтения оборачивается декоратором реестра:
+
+    @query_cache.cached('channel_members', tags=lambda members, channel_id: [f'channel:{channel_id}:members'])
+    def get_channel_members(channel_id): ...
+
+- L1 - память процесса: LRU со сроком жизни CACHE_L1_TTL и пределом объёма
+  CACHE_L1_MAX_BYTES. Значения хранятся в виде JSON: каждый вызов получает
+  свою копию, а объём считается по длине строки.
+- L2 - Redis (CACHE_REDIS_URL), общий для всех процессов. Без адреса или пока
+  Redis недоступен кэш работает только в памяти процесса.
+- Отсутствие результата (None) тоже кэшируется, на срок CACHE_NEGATIVE_TTL.
+- Одновременные промахи по одному ключу загружают значение один раз,
+  остальные вызовы ждут и берут результат из L1.
+- Сброс по тегам: запись помечается тегами ('user:42', 'channel:7:members'),
+  invalidate('user:42') сбрасывает все записи с этим тегом. В памяти процесса
+  записи удаляются сразу, в Redis у тега есть счётчик версии: запись хранит
+  версии своих тегов и при расхождении считается отсутствующей.
+- Теги записи часто известны только после загрузки (id найденной строки),
+  поэтому перед загрузкой снимается общий счётчик сбросов cache:epoch: каждая
+  отправка сбросов сначала увеличивает его, потом версии тегов. Если за время
+  загрузки счётчик изменился, результат в Redis не записывается - иначе
+  устаревшая строка сохранилась бы с уже увеличенными версиями тегов.
+
+Записи L1 других процессов сбросом не затрагиваются и живут не дольше
+CACHE_L1_TTL. Поэтому при нескольких воркерах (задана очередь сообщений
+Socket.IO) функции, объявленные с l1=False (данные для входа и проверок прав:
+строки пользователей, участники и роли каналов), не хранятся в L1 и читаются
+из Redis или из базы. Сокеты Redis используются только из потока цикла событий, как и
+у кэша ленты: под gevent пул потоков и поток-писатель работают только с L1, а
+увеличения версий тегов копятся в очереди и отправляются flush().
+"""
+import functools
+import json
+import os
+import threading
+import time
+from _queue import SimpleQueue, Empty
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import redis
+
+import redis_config
+from app_logging import get_logger
+from db_offload import on_hub_thread
+
+log = get_logger('cache')
+
+# Сколько секунд запись живёт в памяти процесса
+CACHE_L1_TTL = float(os.environ.get('CACHE_L1_TTL', 60))
+# Предельный объём L1 в байтах (по длине JSON значений); давно не использованные записи вытесняются
+CACHE_L1_MAX_BYTES = int(os.environ.get('CACHE_L1_MAX_BYTES', 32 * 1024 * 1024))
+# Сколько секунд запись живёт в Redis
+CACHE_L2_TTL = float(os.environ.get('CACHE_L2_TTL', 600))
+# Сколько секунд хранится отсутствие результата (в обоих уровнях)
+CACHE_NEGATIVE_TTL = float(os.environ.get('CACHE_NEGATIVE_TTL', 30))
+
+_MISSING = object()
+_EPOCH_KEY = "cache:epoch"
+
+
+def _tag_key(tag):
+    return f"cache:tag:{tag}"
+
+
+class QueryCache:
+    """
+    Реестр кэшируемых функций чтения с общим L1 и необязательным L2 в Redis.
+
+    :param client: клиент Redis с decode_responses=True или None (только L1)
+    :param l1_ttl: срок жизни записи в памяти процесса, сек
+    :param l2_ttl: срок жизни записи в Redis, сек
+    :param negative_ttl: срок жизни закэшированного None, сек
+    :param max_bytes: предельный объём L1
+    :param cluster: несколько процессов - функции с l1=False не используют L1
+    """
+
+    def __init__(self, client=None, l1_ttl=CACHE_L1_TTL, l2_ttl=CACHE_L2_TTL,
+                 negative_ttl=CACHE_NEGATIVE_TTL, max_bytes=CACHE_L1_MAX_BYTES, cluster=False):
+        self.client = client
+        self.cluster = cluster
+        self.l1_ttl = l1_ttl
+        self.l2_ttl = l2_ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max(1, max_bytes)
+        self.functions = {}
+        self._shared_only = set()  # пространства имён с l1=False
+        self._entries = OrderedDict()  # (namespace, key) -> (json, истекает, теги)
+        self._tags = {}  # тег -> ключи записей
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._flights = {}  # ключ -> [блокировка загрузки, число ждущих]
+        # Растёт при каждом сбросе: загрузка, начатая раньше, не попадает в кэш
+        self._invalidations = 0
+        self._pending = SimpleQueue()
+        self._unsent = []
+        self._down_until = 0.0
+        self.l1_hits = self.l2_hits = self.misses = 0
+        self.coalesced = self.evictions = self.errors = 0
+        self.skipped = 0  # результаты, не записанные в L2 из-за сброса во время загрузки
+
+    # === Регистрация функций ===
+
+    def cached(self, namespace, key=None, tags=None, l1=True):
+        """
+        Декоратор: результат функции кэшируется по её аргументам.
+
+        :param key: key(*args) -> строка ключа (по умолчанию аргументы через ':')
+        :param tags: tags(result, *args) -> теги записи (result может быть None)
+        :param l1: False - в кластерном режиме не хранить результат в памяти процесса
+        """
+        if not l1:
+            self._shared_only.add(namespace)
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                return self.get(namespace, key(*args) if key else ':'.join(map(str, args)),
+                                lambda: func(*args), lambda result: tags(result, *args) if tags else ())
+            wrapper.uncached = func
+            self.functions[namespace] = wrapper
+            return wrapper
+        return decorator
+
+    # === Чтение ===
+
+    def get(self, namespace, key, load, tags=lambda result: ()):
+        """Значение из L1, L2 или load(); tags(result) -> теги новой записи"""
+        full_key = (namespace, key)
+        use_l1 = not (self.cluster and namespace in self._shared_only)
+        raw = self._l1_get(full_key) if use_l1 else _MISSING
+        if raw is not _MISSING:
+            self.l1_hits += 1
+            return json.loads(raw)
+        with self._flight(full_key) as waited:
+            if waited and use_l1:
+                raw = self._l1_get(full_key)
+                if raw is not _MISSING:
+                    self.coalesced += 1
+                    return json.loads(raw)
+            return self._load(full_key, load, tags, use_l1)
+
+    @contextmanager
+    def _flight(self, full_key):
+        # Одна загрузка на ключ: остальные вызовы ждут её окончания
+        with self._lock:
+            flight = self._flights.get(full_key)
+            if flight is None:
+                flight = self._flights[full_key] = [threading.Lock(), 0]
+            flight[1] += 1
+        waited = not flight[0].acquire(blocking=False)
+        if waited:
+            flight[0].acquire()
+        try:
+            yield waited
+        finally:
+            flight[0].release()
+            with self._lock:
+                flight[1] -= 1
+                if not flight[1]:
+                    del self._flights[full_key]
+
+    def _load(self, full_key, load, tags, use_l1=True):
+        with self._lock:
+            version = self._invalidations
+        redis_key = f"cache:{full_key[0]}:{full_key[1]}"
+        use_l2 = self._l2_usable()
+        if use_l2:
+            self.flush()
+            try:
+                stored, epoch = self._l2_get(redis_key)
+            except redis.RedisError as e:
+                self._failed(e)
+                use_l2, stored = False, None
+            if stored is not None:
+                self.l2_hits += 1
+                result = stored['value']
+                if use_l1:
+                    self._l1_put(full_key, version, json.dumps(result), result is None, list(stored['tags']))
+                return result
+
+        self.misses += 1
+        result = load()
+        result_tags = list(tags(result))
+        if self._l1_put(full_key, version, json.dumps(result), result is None, result_tags, use_l1) and use_l2:
+            try:
+                # Счётчик и версии читаются одной командой: между ними не может пройти сброс
+                current_epoch, *versions = self.client.mget([_EPOCH_KEY] + [_tag_key(tag) for tag in result_tags])
+                if current_epoch != epoch:
+                    self.skipped += 1  # теги могли быть сброшены во время загрузки
+                    return result
+                ttl = self.negative_ttl if result is None else self.l2_ttl
+                self.client.set(redis_key, json.dumps({'value': result, 'tags': dict(zip(result_tags, versions))}),
+                                px=max(1, int(ttl * 1000)))
+            except redis.RedisError as e:
+                self._failed(e)
+        return result
+
+    def _l2_get(self, redis_key):
+        """(запись или None, счётчик сбросов на момент чтения)"""
+        raw, epoch = self.client.mget([redis_key, _EPOCH_KEY])
+        if raw is None:
+            return None, epoch
+        stored = json.loads(raw)
+        tags = stored['tags']
+        if tags and self.client.mget([_tag_key(tag) for tag in tags]) != list(tags.values()):
+            return None, epoch  # тег сброшен после записи
+        return stored, epoch
+
+    # === L1 ===
+
+    def _l1_get(self, full_key):
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is None:
+                return _MISSING
+            if entry[1] <= time.monotonic():
+                self._remove(full_key)
+                return _MISSING
+            self._entries.move_to_end(full_key)
+            return entry[0]
+
+    def _l1_put(self, full_key, version, raw, negative, tags, store=True):
+        """Сохранить запись, если после начала загрузки не было сбросов (store=False - только проверка)"""
+        with self._lock:
+            if self._invalidations != version:
+                return False
+            self._remove(full_key)
+            if not store or len(raw) > self.max_bytes:
+                return True
+            expires = time.monotonic() + (self.negative_ttl if negative else self.l1_ttl)
+            self._entries[full_key] = (raw, expires, tags)
+            self._bytes += len(raw)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(full_key)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def _remove(self, full_key):
+        entry = self._entries.pop(full_key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry[0])
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(full_key)
+                if not keys:
+                    del self._tags[tag]
+
+    # === Сброс ===
+
+    def invalidate(self, *tags):
+        """Сбросить записи с любым из тегов (из любого потока)"""
+        with self._lock:
+            self._invalidations += 1
+            for tag in tags:
+                for full_key in list(self._tags.get(tag, ())):
+                    self._remove(full_key)
+        if self.client is not None and tags:
+            self._pending.put(tags)
+
+    def flush(self):
+        """Отправить накопленные сбросы тегов в Redis (из потока цикла событий)"""
+        if self.client is None:
+            return
+        batch, self._unsent = self._unsent, []
+        while True:
+            try:
+                batch.append(self._pending.get_nowait())
+            except Empty:
+                break
+        if not batch:
+            return
+        if self._l2_usable():
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                pipe.incr(_EPOCH_KEY)  # до версий тегов: см. _load
+                for tag in {tag for tags in batch for tag in tags}:
+                    pipe.incr(_tag_key(tag))
+                pipe.execute()
+                return
+            except redis.RedisError as e:
+                self._failed(e)
+        if len(batch) > redis_config.CACHE_PENDING_LIMIT:
+            log.warning("Отброшено %d сбросов кэша запросов", len(batch) - redis_config.CACHE_PENDING_LIMIT)
+            batch = batch[-redis_config.CACHE_PENDING_LIMIT:]
+        self._unsent = batch + self._unsent
+
+    def clear(self):
+        """Очистить L1 (записи в Redis истекают сами)"""
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    # === Redis ===
+
+    def _l2_usable(self):
+        return self.client is not None and time.monotonic() >= self._down_until and on_hub_thread()
+
+    def _failed(self, error):
+        self.errors += 1
+        self._down_until = time.monotonic() + redis_config.CACHE_RETRY_AFTER
+        log.warning("Redis недоступен, кэш запросов работает только в памяти %s с: %s",
+                    redis_config.CACHE_RETRY_AFTER, error)
+
+    def stats(self):
+        with self._lock:
+            entries, size = len(self._entries), self._bytes
+        return {'entries': entries, 'bytes': size, 'l1_hits': self.l1_hits, 'l2_hits': self.l2_hits,
+                'misses': self.misses, 'coalesced': self.coalesced, 'evictions': self.evictions,
+                'errors': self.errors, 'skipped': self.skipped, 'pending': self._pending.qsize() + len(self._unsent)}
+
+
+def create_query_cache(url=redis_config.CACHE_REDIS_URL):
+    """Кэш запросов: L1 и, если задан адрес Redis, L2"""
+    return QueryCache(redis_config.connect(url) if url else None,
+                      cluster=bool(os.environ.get('SOCKETIO_MESSAGE_QUEUE')))
@@ -0,0 +1,41 @@
+"""
+Общие фикстуры тестов.
+
+Каждый тест работает со своей временной базой: utils.DATABASE подменяется на
+файл в tmp_path и после теста возвращается, кэши в памяти сбрасываются, а
+потоки-писатели останавливаются. Ни порядок модулей, ни запуск одного файла
+не трогают database.db из репозитория.
+"""
+import os
+import tempfile
+
+import pytest
+
+import db_writer
+import redis_config
+import utils
+
+
+def _clear_caches():
+    utils.roster_cache.clear()
+    utils.history_buffer.clear()
+    utils.query_cache.clear()
+
+
+def pytest_configure(config):
+    # Импорт app и скрипты вроде create_test.py обращаются к базе ещё при сборке тестов:
+    # до первой фикстуры база тоже временная
+    utils.DATABASE = os.path.join(tempfile.mkdtemp(), 'collect.db')
+    utils.init_db()
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    """Временная база с применёнными миграциями (в ней уже есть пользователи test1 и test2)"""
+    path = str(tmp_path / 'test.db')
+    monkeypatch.setattr(utils, 'DATABASE', path)
+    monkeypatch.setattr(redis_config, 'feed_cache', None)
+    utils.init_db()
+    yield path
+    db_writer.stop_all_writers()
+    _clear_caches()
@@ -0,0 +1,92 @@
+# db_offload.py
+"""
+Вынос блокирующих вызовов sqlite3 из цикла событий gevent.
+
+Под gevent все соединения Socket.IO обслуживаются greenlet'ами одного потока
+ОС. Модуль sqlite3 ничего не знает о gevent: пока идёт запрос, цикл событий
+стоит и остальные клиенты ждут. Поэтому функции работы с базой, вызванные из
+цикла событий, выполняются в ограниченном пуле настоящих потоков ОС, а
+greenlet просто ждёт результат. Без monkey-patching (режим threading) функции
+вызываются напрямую.
+"""
+import functools
+import os
+
+from db_pool import POOL_SIZE
+
+# Сколько потоков ОС выполняют запросы к базе (больше размера пула соединений смысла нет)
+DB_OFFLOAD_THREADS = int(os.environ.get('DB_OFFLOAD_THREADS', POOL_SIZE))
+
+_pool = None
+_hub_thread = None
+
+
+def _native(module, name):
+    """Оригинальная (не подменённая gevent) функция модуля"""
+    try:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    except ImportError:
+        import importlib
+        return getattr(importlib.import_module(module), name)
+
+
+def gevent_patched():
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched('threading')
+    except ImportError:
+        return False
+
+
+def native_thread_ident():
+    """Идентификатор потока ОС (под gevent threading.get_ident отдаёт id greenlet'а)"""
+    return _native('_thread', 'get_ident')()
+
+
+def start_native_thread(target, *args):
+    """Запустить функцию в настоящем потоке ОС, даже если threading подменён gevent"""
+    return _native('_thread', 'start_new_thread')(target, args)
+
+
+def enable_offload(threads=DB_OFFLOAD_THREADS):
+    """
+    Включить вынос запросов в пул потоков (вызывается после monkey.patch_all()).
+
+    Выносятся только вызовы из потока, где работает цикл событий; в потоках пула
+    и в потоке-писателе функции по-прежнему выполняются напрямую.
+    """
+    global _pool, _hub_thread
+    if _pool is None and gevent_patched():
+        from gevent.threadpool import ThreadPool
+        _pool = ThreadPool(max(1, threads))
+        _hub_thread = native_thread_ident()
+    return _pool is not None
+
+
+def run_blocking(fn, *args, **kwargs):
+    """Выполнить fn в пуле потоков, если вызов пришёл из цикла событий"""
+    if _pool is None or native_thread_ident() != _hub_thread:
+        return fn(*args, **kwargs)
+    return _pool.apply(fn, args, kwargs)
+
+
+def on_hub_thread():
+    """Вызов пришёл из потока цикла событий gevent (без gevent - из любого потока)"""
+    if not gevent_patched():
+        return True
+    return native_thread_ident() == _hub_thread
+
+
+def offloaded(fn):
+    """Декоратор: функция работы с базой не блокирует цикл событий gevent"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return run_blocking(fn, *args, **kwargs)
+    return wrapper
+
+
+def offload_stats():
+    if _pool is None:
+        return {'enabled': False}
+    return {'enabled': True, 'threads': _pool.maxsize, 'pending': len(_pool)}
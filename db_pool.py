@@ -0,0 +1,238 @@
+# db_pool.py
+"""
+Пул долгоживущих соединений SQLite.
+
+Соединение открывается и настраивается (row_factory, PRAGMA) один раз, а затем
+переиспользуется. Внутри одного потока (или greenlet'а под gevent) вложенные
+вызовы get_db_connection() получают то же самое соединение, поэтому функции
+из utils.py, вызывающие друг друга, не занимают несколько соединений сразу.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Настройки пула (можно переопределить через переменные окружения)
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTH_CHECK_INTERVAL', 30))
+
+# Профиль хранения: WAL позволяет читателям не блокироваться писателем,
+# synchronous=NORMAL в режиме WAL безопасен для целостности базы
+JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL')
+SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 64 * 1024))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+
+# PRAGMA, которые применяются к каждому новому соединению
+CONNECTION_PRAGMAS = (
+    f"synchronous = {SYNCHRONOUS}",
+    f"mmap_size = {MMAP_SIZE}",
+    f"cache_size = -{CACHE_SIZE_KB}",
+    f"busy_timeout = {BUSY_TIMEOUT_MS}",
+    "temp_store = MEMORY",
+)
+
+
+def configure_connection(conn):
+    """Применить row_factory и PRAGMA профиля хранения к соединению"""
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
+
+def apply_storage_profile(database):
+    """
+    Включить режим журнала профиля хранения (выполняется один раз при старте).
+
+    journal_mode сохраняется в самом файле базы, поэтому достаточно одного
+    соединения; возвращает фактически установленный режим.
+    """
+    conn = sqlite3.connect(database, timeout=BUSY_TIMEOUT_MS / 1000)
+    try:
+        return conn.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+class PoolTimeoutError(RuntimeError):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+def _make_local():
+    """
+    Хранилище «текущего» соединения.
+
+    Под gevent с monkey-patching несколько greenlet'ов делят один поток ОС,
+    поэтому соединение привязывается к greenlet'у, а не к потоку.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.local import local
+            return local()
+    except ImportError:
+        pass
+    return threading.local()
+
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений к одному файлу базы данных.
+
+    :param database: путь к файлу SQLite
+    :param size: максимальное количество открытых соединений
+    :param timeout: сколько секунд ждать свободное соединение
+    :param health_check_interval: через сколько секунд простоя проверять соединение перед выдачей
+    """
+
+    def __init__(self, database, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.database = database
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []  # [(conn, время возврата в пул)]
+        self._created = 0
+        self._cond = threading.Condition()
+        self._local = _make_local()
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        return configure_connection(conn)
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("Пул соединений закрыт")
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    conn, released_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(f"Нет свободных соединений к {self.database} ({self.size} занято)")
+                self._cond.wait(remaining)
+
+        if conn is not None:
+            if time.monotonic() - released_at < self.health_check_interval or self._is_healthy(conn):
+                return conn
+            # Соединение «умерло» за время простоя - заменяем новым
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, conn):
+        # Незакоммиченные изменения отбрасываются, как и при закрытии соединения
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._created -= 1
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Выдать соединение на время блока with (повторно входимо в пределах потока)"""
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+
+        conn = self._checkout()
+        local.conn = conn
+        local.depth = 1
+        try:
+            yield conn
+        finally:
+            local.conn = None
+            local.depth = 0
+            self._checkin(conn)
+
+    def stats(self):
+        with self._cond:
+            return {'size': self.size, 'open': self._created, 'idle': len(self._idle)}
+
+    def close(self):
+        """Закрыть все простаивающие соединения; занятые закроются при возврате"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database):
+    """Пул для указанного файла базы данных (создаётся при первом обращении)"""
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(database)
+            if pool is None:
+                pool = ConnectionPool(database)
+                _pools[database] = pool
+    return pool
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,210 @@
+# db_writer.py
+"""
+Единственный поток-писатель для SQLite.
+
+SQLite допускает только одного писателя одновременно, поэтому все изменения
+из utils.py выполняются в одном потоке: задачи, накопившиеся в очереди,
+применяются внутри одной транзакции (group commit). Каждая задача работает в
+своей точке сохранения (SAVEPOINT), так что ошибка в одной задаче откатывает
+только её изменения, а не весь пакет.
+"""
+import os
+import sqlite3
+import threading
+import time
+from _queue import SimpleQueue, Empty
+from concurrent.futures import Future
+
+from db_offload import gevent_patched, native_thread_ident, start_native_thread
+from db_pool import configure_connection
+from app_logging import get_logger
+
+# Максимальное количество задач в одной транзакции
+WRITER_MAX_BATCH = int(os.environ.get('DB_WRITER_MAX_BATCH', 256))
+# Сколько миллисекунд после первой задачи ждать следующие, чтобы собрать пакет побольше
+# (0 - брать только то, что уже накопилось в очереди)
+WRITER_LINGER_MS = float(os.environ.get('DB_WRITER_LINGER_MS', 0))
+# Писатель можно отключить (DB_WRITER=0): тогда запись идёт через пул соединений
+WRITER_ENABLED = os.environ.get('DB_WRITER', '1') != '0'
+
+_STOP = object()
+
+log = get_logger('writer')
+
+
+class _Job:
+    __slots__ = ('fn', 'args', 'kwargs', 'future')
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class DatabaseWriter:
+    """
+    Поток, последовательно применяющий задачи записи.
+
+    Задача - функция вида fn(conn, *args, **kwargs); результат функции
+    возвращается вызывающему только после фиксации транзакции.
+    """
+
+    def __init__(self, database, max_batch=WRITER_MAX_BATCH, linger_ms=WRITER_LINGER_MS):
+        self.database = database
+        self.max_batch = max(1, max_batch)
+        self.linger = max(0.0, linger_ms) / 1000
+        # Очередь из C-модуля _queue gevent не подменяет: писатель под gevent работает в потоке ОС
+        self._queue = SimpleQueue()
+        self._thread_ident = None
+        self._stopped = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._job_callbacks = None
+        self.batches = 0
+        self.jobs = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None)
+        configure_connection(conn)
+        return conn
+
+    def _ensure_started(self):
+        if not self._started:
+            with self._start_lock:
+                if not self._started:
+                    if gevent_patched():
+                        # Под gevent threading.Thread - это greenlet: запись заблокировала бы цикл событий
+                        start_native_thread(self._loop)
+                    else:
+                        threading.Thread(target=self._loop, name=f'db-writer:{self.database}', daemon=True).start()
+                    self._started = True
+
+    def in_writer_thread(self):
+        return native_thread_ident() == self._thread_ident
+
+    def submit(self, fn, *args, **kwargs):
+        """Поставить задачу в очередь; возвращает concurrent.futures.Future"""
+        self._ensure_started()
+        job = _Job(fn, args, kwargs)
+        self._queue.put(job)
+        return job.future
+
+    def run(self, fn, *args, **kwargs):
+        """Выполнить задачу и дождаться фиксации транзакции"""
+        if self.in_writer_thread():
+            # Вложенный вызов из другой задачи - выполняется в её транзакции
+            return fn(self._conn, *args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    def after_commit(self, callback):
+        """
+        Вызвать callback после фиксации транзакции текущей задачи (например, для сброса кэша).
+
+        Если задача откатится, callback не вызывается; вне потока-писателя он вызывается сразу.
+        """
+        if self.in_writer_thread() and self._job_callbacks is not None:
+            self._job_callbacks.append(callback)
+        else:
+            callback()
+
+    def stop(self, timeout=None):
+        if self._started:
+            self._queue.put(_STOP)
+            self._stopped.wait(timeout)
+
+    def _loop(self):
+        self._thread_ident = native_thread_ident()
+        self._conn = self._connect()
+        try:
+            while True:
+                job = self._queue.get()
+                if job is _STOP:
+                    return
+                batch = [job]
+                stopping = False
+                deadline = time.monotonic() + self.linger
+                while len(batch) < self.max_batch:
+                    try:
+                        remaining = deadline - time.monotonic()
+                        job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except Empty:
+                        break
+                    if job is _STOP:
+                        stopping = True
+                        break
+                    batch.append(job)
+                self._apply_batch(batch)
+                if stopping:
+                    return
+        finally:
+            self._conn.close()
+            self._stopped.set()
+
+    def _apply_batch(self, batch):
+        conn = self._conn
+        outcomes = []
+        callbacks = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                conn.execute("SAVEPOINT job")
+                self._job_callbacks = []
+                try:
+                    result = job.fn(conn, *job.args, **job.kwargs)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    outcomes.append((job, None, e))
+                else:
+                    conn.execute("RELEASE job")
+                    outcomes.append((job, result, None))
+                    callbacks.extend(self._job_callbacks)
+                finally:
+                    self._job_callbacks = None
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            # Транзакция целиком не удалась (например, база заблокирована другим процессом)
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.jobs += len(batch)
+        # Колбэки выполняются до того, как вызывающие получат результат
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                log.exception("Ошибка в after_commit")
+        for job, result, error in outcomes:
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(database):
+    """Поток-писатель для указанного файла базы данных"""
+    writer = _writers.get(database)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(database)
+            if writer is None:
+                writer = DatabaseWriter(database)
+                _writers[database] = writer
+    return writer
+
+
+def stop_all_writers(timeout=None):
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.stop(timeout)
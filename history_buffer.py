@@ -0,0 +1,216 @@
+# history_buffer.py
+"""
+Кольцевой буфер последних сообщений каждой беседы в памяти.
+
+Для каждой беседы хранятся последние HISTORY_BUFFER_SIZE сообщений в том же
+виде, в каком их отдаёт история (с родительским сообщением, аватаром автора и
+состоянием прочтения). Страница истории отдаётся из памяти, если буфер целиком
+её покрывает: вся беседа помещается в буфер или курсор указывает внутрь него.
+
+Новые сообщения, правки, удаления и прочтения применяются к буферу на месте
+после фиксации транзакции. Холодные беседы вытесняются (LRU), когда суммарный
+объём буферов превышает HISTORY_BUFFER_BYTES.
+
+Буфер видит только изменения, сделанные в своём процессе. Когда приложение
+запущено несколькими воркерами (задана очередь сообщений Socket.IO), он по
+умолчанию выключен (HISTORY_BUFFER_SIZE=0) и история читается из базы.
+"""
+import os
+import threading
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+
+# Сколько последних сообщений держать для одной беседы (0 - буфер выключен)
+HISTORY_BUFFER_SIZE = int(os.environ.get('HISTORY_BUFFER_SIZE', 0 if os.environ.get('SOCKETIO_MESSAGE_QUEUE') else 100))
+# Общий бюджет памяти на все буферы (оценка по размеру полей)
+HISTORY_BUFFER_BYTES = int(os.environ.get('HISTORY_BUFFER_BYTES', 32 * 1024 * 1024))
+
+_ROW_OVERHEAD = 400  # словарь, ключи и числа одного сообщения
+# Сколько счётчиков поколений держать до сброса (сброс меняет эпоху и отменяет идущие загрузки)
+_MAX_GENERATIONS = 10000
+
+
+def _row_size(row):
+    return _ROW_OVERHEAD + sum(len(v) for v in row.values() if isinstance(v, str))
+
+
+class _Ring:
+    __slots__ = ('ids', 'rows', 'complete', 'size')
+
+    def __init__(self, rows, complete):
+        self.rows = list(rows)
+        self.ids = [r['id'] for r in self.rows]
+        # complete: в буфере вся беседа с самого начала
+        self.complete = complete
+        self.size = sum(_row_size(r) for r in self.rows)
+
+
+class HistoryBuffer:
+    """
+    Буферы истории по ключу беседы (kind, ref_id).
+
+    :param capacity: сообщений на беседу (0 - буфер выключен)
+    :param max_bytes: общий бюджет памяти
+    """
+
+    def __init__(self, capacity=HISTORY_BUFFER_SIZE, max_bytes=HISTORY_BUFFER_BYTES):
+        self.enabled = capacity > 0
+        self.capacity = max(1, capacity)
+        self.max_bytes = max_bytes
+        self._rings = OrderedDict()
+        self._bytes = 0
+        # Поколение ключа растёт при каждом изменении: загрузка, начатая раньше, не попадёт в буфер
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # --- чтение ---
+
+    def get_page(self, key, offset=0, limit=50, before_id=None, after_id=None):
+        """Страница истории из памяти (копии строк) или None, если буфер её не покрывает"""
+        with self._lock:
+            ring = self._rings.get(key)
+            page = self._slice(ring, offset, limit, before_id, after_id) if ring else None
+            if page is None:
+                self.misses += 1
+                return None
+            self._rings.move_to_end(key)
+            self.hits += 1
+            return [dict(r) for r in page]
+
+    @staticmethod
+    def _slice(ring, offset, limit, before_id, after_id):
+        if before_id is not None:
+            end = bisect_left(ring.ids, before_id)
+            if end < limit and not ring.complete:
+                return None
+            return ring.rows[max(0, end - limit):end]
+        if after_id is not None:
+            if not ring.complete and (not ring.ids or after_id < ring.ids[0]):
+                return None
+            start = bisect_right(ring.ids, after_id)
+            return ring.rows[start:start + limit]
+        if not ring.complete:
+            return None
+        return ring.rows[offset:offset + limit]
+
+    @classmethod
+    def page_of(cls, rows, complete, offset=0, limit=50, before_id=None, after_id=None):
+        """Страница из загруженных последних сообщений по тем же правилам, что get_page"""
+        page = cls._slice(_Ring(rows, complete), offset, limit, before_id, after_id)
+        return None if page is None else [dict(r) for r in page]
+
+    def cached(self, key):
+        with self._lock:
+            return key in self._rings
+
+    # --- заполнение ---
+
+    def generation(self, key):
+        """Снимок версии ключа; передаётся в fill() после загрузки из базы"""
+        with self._lock:
+            return (self._epoch, self._generations.get(key, 0))
+
+    def fill(self, key, rows, complete, generation):
+        """Положить загруженные последние сообщения, если ключ не менялся с момента снимка"""
+        with self._lock:
+            if not self.enabled or (self._epoch, self._generations.get(key, 0)) != generation:
+                return False
+            self._drop(key)
+            ring = _Ring(rows[-self.capacity:], complete and len(rows) <= self.capacity)
+            self._rings[key] = ring
+            self._bytes += ring.size
+            self._evict()
+            return True
+
+    # --- изменения (вызываются после фиксации транзакции) ---
+
+    def _touch(self, key):
+        if len(self._generations) >= _MAX_GENERATIONS:
+            self._generations.clear()
+            self._epoch += 1
+        self._generations[key] = self._generations.get(key, 0) + 1
+        return self._rings.get(key)
+
+    def append(self, key, row):
+        with self._lock:
+            ring = self._touch(key)
+            if ring is None:
+                return
+            pos = bisect_left(ring.ids, row['id'])
+            if pos < len(ring.ids) and ring.ids[pos] == row['id']:
+                return
+            ring.ids.insert(pos, row['id'])
+            ring.rows.insert(pos, dict(row))
+            ring.size += _row_size(row)
+            self._bytes += _row_size(row)
+            while len(ring.rows) > self.capacity:
+                ring.ids.pop(0)
+                dropped = ring.rows.pop(0)
+                ring.size -= _row_size(dropped)
+                self._bytes -= _row_size(dropped)
+                ring.complete = False
+            self._evict()
+
+    def update(self, key, fields, where):
+        """Обновить поля строк беседы, для которых where(row) истинно"""
+        with self._lock:
+            ring = self._touch(key)
+            if ring is not None:
+                self._update_ring(ring, fields, where)
+
+    def update_all(self, fields, where):
+        """Обновить строки во всех беседах (например, новый аватар автора)"""
+        with self._lock:
+            self._epoch += 1
+            for ring in self._rings.values():
+                self._update_ring(ring, fields, where)
+
+    def _update_ring(self, ring, fields, where):
+        for row in ring.rows:
+            if where(row):
+                old = _row_size(row)
+                row.update(fields(row) if callable(fields) else fields)
+                ring.size += _row_size(row) - old
+                self._bytes += _row_size(row) - old
+
+    def remove(self, key, msg_id):
+        with self._lock:
+            ring = self._touch(key)
+            if ring is None:
+                return
+            pos = bisect_left(ring.ids, msg_id)
+            if pos < len(ring.ids) and ring.ids[pos] == msg_id:
+                ring.ids.pop(pos)
+                row = ring.rows.pop(pos)
+                ring.size -= _row_size(row)
+                self._bytes -= _row_size(row)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._touch(key)
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._rings.clear()
+            self._bytes = 0
+
+    # --- служебное ---
+
+    def _drop(self, key):
+        ring = self._rings.pop(key, None)
+        if ring is not None:
+            self._bytes -= ring.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._rings) > 1:
+            _, ring = self._rings.popitem(last=False)
+            self._bytes -= ring.size
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rings), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,791 @@
+# migrations.py
+"""
+Версионированные миграции схемы базы данных.
+
+Номер применённой миграции хранится в PRAGMA user_version, поэтому при старте
+приложения достаточно прочитать одно число и выполнить только недостающие шаги.
+Каждая миграция применяется в отдельной транзакции вместе с повышением версии.
+"""
+import sqlite3
+
+from db_pool import configure_connection, BUSY_TIMEOUT_MS
+from app_logging import get_logger
+
+log = get_logger('migrations')
+
+# Реестр миграций: [(версия, описание, функция(conn))]
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Зарегистрировать функцию как миграцию с указанным номером версии"""
+    def decorator(func):
+        if any(v == version for v, _, _ in MIGRATIONS):
+            raise ValueError(f"Миграция {version} уже зарегистрирована")
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def latest_version():
+    return max((v for v, _, _ in MIGRATIONS), default=0)
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(database):
+    """
+    Применить все миграции с версией больше текущей.
+
+    :param database: путь к файлу SQLite
+    :return: список номеров применённых миграций
+    """
+    conn = sqlite3.connect(database, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    configure_connection(conn)
+    applied = []
+    try:
+        # Быстрый путь: схема актуальна - ничего не блокируем
+        if current_version(conn) >= latest_version():
+            return applied
+        for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Другой процесс мог применить миграцию, пока мы ждали блокировку
+                if current_version(conn) >= version:
+                    conn.execute("COMMIT")
+                    continue
+                func(conn)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+            log.info("Применена миграция %s: %s", version, description)
+    finally:
+        conn.close()
+    return applied
+
+
+def _hash(password):
+    from utils import hash_password
+    return hash_password(password)
+
+
+@migration(1, "Базовая схема")
+def _baseline_schema(conn):
+    # === Таблица пользователей ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            registration_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            city TEXT,
+            bio_short TEXT,
+            country TEXT,
+            languages TEXT,
+            bio_full TEXT,
+            hobbies TEXT,
+            avatar TEXT,
+            status TEXT,
+            banner_photo TEXT,
+            banner_color TEXT
+        )
+    """)
+
+    # === Таблица чатов ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER,
+            user2_id INTEGER,
+            UNIQUE(user1_id, user2_id)
+        )
+    """)
+
+    # === Таблица личных сообщений ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            sender TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'sent',  -- sent, delivered, read
+            parent_message_id INTEGER REFERENCES messages(id),
+            edited BOOLEAN DEFAULT FALSE
+        )
+    """)
+
+    # === ГРУППЫ ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            creator TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            pinned_msg_id INTEGER,
+            description TEXT
+        )
+    """)
+
+    # === Участники групп ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS group_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER,
+            user_id INTEGER,
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(group_id, user_id)
+        )
+    """)
+
+    # === Сообщения в группах ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS group_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER,
+            sender TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_read BOOLEAN DEFAULT FALSE,
+            edited BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (group_id) REFERENCES groups (id)
+        )
+    """)
+
+    # === Подписки ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            follower_id INTEGER,
+            following_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(follower_id, following_id),
+            FOREIGN KEY (follower_id) REFERENCES users (id),
+            FOREIGN KEY (following_id) REFERENCES users (id)
+        )
+    """)
+
+    # === Посты ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            content TEXT NOT NULL,
+            image_url TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+
+    # === Лайки ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS likes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            post_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, post_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (post_id) REFERENCES posts (id)
+        )
+    """)
+
+    # === Комментарии ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            post_id INTEGER,
+            content TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (post_id) REFERENCES posts (id)
+        )
+    """)
+
+    # === Комментарии к сообщениям ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER,
+            user_id INTEGER,
+            content TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (message_id) REFERENCES messages (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+
+    # === Комментарии к профилям ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS profile_comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            profile_user_id INTEGER,
+            content TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (profile_user_id) REFERENCES users (id)
+        )
+    """)
+
+    # === Репосты ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reposts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            original_post_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, original_post_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (original_post_id) REFERENCES posts (id)
+        )
+    """)
+
+    # === Реакции ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            post_id INTEGER,
+            emoji TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, post_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (post_id) REFERENCES posts (id)
+        )
+    """)
+
+    # === Ответы на комментарии ===
+    try:
+        conn.execute("ALTER TABLE comments ADD COLUMN parent_comment_id INTEGER REFERENCES comments(id)")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE messages ADD COLUMN parent_message_id INTEGER REFERENCES messages(id)")
+    except sqlite3.OperationalError:
+        pass
+
+    # === Сообщения в каналах ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER,
+            sender TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_read BOOLEAN DEFAULT FALSE,
+            edited BOOLEAN DEFAULT FALSE,
+            parent_message_id INTEGER REFERENCES channel_messages(id),
+            FOREIGN KEY (channel_id) REFERENCES channels (id)
+        )
+    """)
+
+    try:
+        conn.execute("ALTER TABLE group_messages ADD COLUMN parent_message_id INTEGER REFERENCES group_messages(id)")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE messages ADD COLUMN edited BOOLEAN DEFAULT FALSE")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE group_messages ADD COLUMN edited BOOLEAN DEFAULT FALSE")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE channel_messages ADD COLUMN parent_message_id INTEGER REFERENCES channel_messages(id)")
+    except sqlite3.OperationalError:
+        pass
+
+    # === Добавление полей для голосовых сообщений ===
+    try:
+        conn.execute("ALTER TABLE messages ADD COLUMN message_type VARCHAR DEFAULT 'text'")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE messages ADD COLUMN audio_path VARCHAR")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE group_messages ADD COLUMN message_type VARCHAR DEFAULT 'text'")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE group_messages ADD COLUMN audio_path VARCHAR")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE channel_messages ADD COLUMN message_type VARCHAR DEFAULT 'text'")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE channel_messages ADD COLUMN audio_path VARCHAR")
+    except sqlite3.OperationalError:
+        pass
+
+    # === Закрепленные посты ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pinned_posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            post_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, post_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (post_id) REFERENCES posts (id)
+        )
+    """)
+
+    # === Сессии пользователей ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            login_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            logout_time DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+
+    # === Каналы ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            creator TEXT NOT NULL,
+            description TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_private BOOLEAN DEFAULT FALSE
+        )
+    """)
+
+    # === Участники каналов ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER,
+            user_id INTEGER,
+            role_id INTEGER,
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (channel_id) REFERENCES channels (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (role_id) REFERENCES channel_roles (id),
+            UNIQUE(channel_id, user_id)
+        )
+    """)
+
+    # === Приглашения в каналы ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_invites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER,
+            invite_code TEXT UNIQUE NOT NULL,
+            created_by INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME,
+            max_uses INTEGER DEFAULT NULL,
+            uses INTEGER DEFAULT 0,
+            FOREIGN KEY (channel_id) REFERENCES channels (id),
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        )
+    """)
+
+    # === Роли в каналах ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_roles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER,
+            role_name TEXT NOT NULL,
+            permissions TEXT,
+            FOREIGN KEY (channel_id) REFERENCES channels (id),
+            UNIQUE(channel_id, role_name)
+        )
+    """)
+
+    # === Мероприятия ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            event_date DATETIME,
+            location TEXT,
+            creator_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (creator_id) REFERENCES users (id)
+        )
+    """)
+
+    # === Участники мероприятий ===
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_participants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'invited',  -- invited, confirmed, declined
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (event_id) REFERENCES events (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(event_id, user_id)
+        )
+    """)
+
+
+    # Добавить колонки если не существуют
+    try:
+        conn.execute("ALTER TABLE groups ADD COLUMN pinned_msg_id INTEGER")
+    except sqlite3.OperationalError:
+        pass  # Колонка уже существует
+
+    try:
+        conn.execute("ALTER TABLE groups ADD COLUMN description TEXT")
+    except sqlite3.OperationalError:
+        pass  # Колонка уже существует
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN registration_date DATETIME DEFAULT CURRENT_TIMESTAMP")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN city TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN bio_short TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN country TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN languages TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN bio_full TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN hobbies TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN avatar TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN status TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN banner_photo TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE users ADD COLUMN banner_color TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        conn.execute("ALTER TABLE channel_invites ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP")
+    except sqlite3.OperationalError:
+        pass
+
+    # Добавить тестовых пользователей
+    conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('test1', _hash('pass1'), 'Москва', 'Привет'))
+    conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('test2', _hash('pass2'), 'СПб', 'Хай'))
+    conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('user1', _hash('pass1'), 'Екатеринбург', 'Тест'))
+    conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('user2', _hash('pass2'), 'Казань', 'Привет всем'))
+    conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('alex', _hash('pass1'), 'Новосибирск', 'Разработчик'))
+    conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('maria', _hash('pass2'), 'Владивосток', 'Дизайнер'))
+
+    # Обновить usernames на lower
+    conn.execute("UPDATE users SET username = LOWER(username)")
+
+
+@migration(2, "Индексы для частых запросов")
+def _common_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_user1_id ON chats(user1_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_user2_id ON chats(user2_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channels_name ON channels(name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_members_channel_id ON channel_members(channel_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_members_user_id ON channel_members(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_groups_name ON groups(name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_members_group_id ON group_members(group_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_members_user_id ON group_members(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_user_id ON posts(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts(created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_likes_user_id ON likes(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_likes_post_id ON likes(post_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_user_id ON comments(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_id ON comments(post_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_follower_id ON subscriptions(follower_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_following_id ON subscriptions(following_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_group_id ON group_messages(group_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_sender ON group_messages(sender)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_timestamp ON group_messages(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_channel_id ON channel_messages(channel_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_sender ON channel_messages(sender)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_messages_timestamp ON channel_messages(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user_id ON user_sessions(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_logout_time ON user_sessions(logout_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_invites_channel_id ON channel_invites(channel_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_invites_invite_code ON channel_invites(invite_code)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_roles_channel_id ON channel_roles(channel_id)")
+
+
+def _copy_legacy_messages(conn, table, kind, ref_column, read_column):
+    """Перенести сообщения из старой таблицы в conversation_messages; возвращает {старый id: новый id}"""
+    id_map = {}
+    parents = []
+    rows = conn.execute(f"SELECT * FROM {table} ORDER BY id").fetchall()
+    for row in rows:
+        conn.execute("INSERT OR IGNORE INTO conversations (kind, ref_id) VALUES (?, ?)", (kind, row[ref_column]))
+        conversation_id = conn.execute(
+            "SELECT id FROM conversations WHERE kind = ? AND ref_id = ?", (kind, row[ref_column])
+        ).fetchone()['id']
+        conn.execute("UPDATE conversations SET last_seq = last_seq + 1 WHERE id = ?", (conversation_id,))
+        seq = conn.execute("SELECT last_seq FROM conversations WHERE id = ?", (conversation_id,)).fetchone()['last_seq']
+        status = row['status'] if read_column == 'status' else ('read' if row['is_read'] else 'sent')
+        is_read = row['is_read'] if read_column == 'is_read' else row['status'] == 'read'
+        cursor = conn.execute("""
+            INSERT INTO conversation_messages
+                (conversation_id, seq, sender, message, timestamp, status, is_read, edited, message_type, audio_path)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (conversation_id, seq, row['sender'], row['message'], row['timestamp'], status, is_read,
+              row['edited'], row['message_type'], row['audio_path']))
+        id_map[row['id']] = cursor.lastrowid
+        if row['parent_message_id'] is not None:
+            parents.append((cursor.lastrowid, row['parent_message_id']))
+    # Ответы ссылались на id в той же таблице
+    for new_id, old_parent_id in parents:
+        conn.execute("UPDATE conversation_messages SET parent_message_id = ? WHERE id = ?",
+                     (id_map.get(old_parent_id), new_id))
+    return id_map
+
+
+@migration(3, "Единое хранилище сообщений для личных чатов, групп и каналов")
+def _unified_conversations(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,  -- dm, group, channel
+            ref_id INTEGER NOT NULL,  -- chats.id / groups.id / channels.id
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(kind, ref_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'sent',  -- sent, delivered, read (личные чаты)
+            is_read BOOLEAN DEFAULT FALSE,  -- группы и каналы
+            parent_message_id INTEGER REFERENCES conversation_messages(id),
+            edited BOOLEAN DEFAULT FALSE,
+            message_type VARCHAR DEFAULT 'text',
+            audio_path VARCHAR,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+            UNIQUE(conversation_id, seq)
+        )
+    """)
+    # История читается по (conversation_id, seq) - это покрывает уникальный индекс выше
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversation_messages_sender ON conversation_messages(sender)")
+
+    # Беседы для всех существующих чатов, групп и каналов (в том числе без сообщений)
+    conn.execute("INSERT OR IGNORE INTO conversations (kind, ref_id) SELECT 'dm', id FROM chats")
+    conn.execute("INSERT OR IGNORE INTO conversations (kind, ref_id) SELECT 'group', id FROM groups")
+    conn.execute("INSERT OR IGNORE INTO conversations (kind, ref_id) SELECT 'channel', id FROM channels")
+
+    dm_ids = _copy_legacy_messages(conn, 'messages', 'dm', 'chat_id', 'status')
+    group_ids = _copy_legacy_messages(conn, 'group_messages', 'group', 'group_id', 'is_read')
+    _copy_legacy_messages(conn, 'channel_messages', 'channel', 'channel_id', 'is_read')
+
+    # Перенумеровать ссылки на сообщения из других таблиц
+    for row in conn.execute("SELECT id, pinned_msg_id FROM groups WHERE pinned_msg_id IS NOT NULL").fetchall():
+        conn.execute("UPDATE groups SET pinned_msg_id = ? WHERE id = ?", (group_ids.get(row['pinned_msg_id']), row['id']))
+    for row in conn.execute("SELECT id, message_id FROM message_comments").fetchall():
+        conn.execute("UPDATE message_comments SET message_id = ? WHERE id = ?", (dm_ids.get(row['message_id']), row['id']))
+
+    conn.execute("DROP TABLE messages")
+    conn.execute("DROP TABLE group_messages")
+    conn.execute("DROP TABLE channel_messages")
+
+
+@migration(4, "Индекс (conversation_id, id) для курсорной пагинации истории")
+def _history_cursor_index(conn):
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversation_messages_conversation_id
+        ON conversation_messages(conversation_id, id)
+    """)
+
+
+@migration(5, "Журнал изменений для дельта-синхронизации клиентов")
+def _change_log(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER,  -- изменение видно всем участникам беседы
+            user_id INTEGER,  -- изменение адресовано конкретному пользователю
+            kind TEXT NOT NULL,  -- message, edit, delete, read, membership
+            payload TEXT NOT NULL,  -- JSON
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_conversation_id ON change_log(conversation_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_user_id ON change_log(user_id, id)")
+
+
+
+@migration(6, "Сводка списка чатов conversation_summary")
+def _conversation_summary(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summary (
+            user_id INTEGER NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            last_message TEXT,
+            last_time DATETIME,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, conversation_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversation_summary_conversation_id ON conversation_summary(conversation_id)")
+    # Заполнение по существующим сообщениям: непрочитанное в личных чатах - по статусу, в группах и каналах - по is_read
+    members = {
+        'dm': "SELECT c.id as ref_id, u.id as user_id, u.username FROM chats c JOIN users u ON u.id IN (c.user1_id, c.user2_id)",
+        'group': "SELECT gm.group_id as ref_id, u.id as user_id, u.username FROM group_members gm JOIN users u ON u.id = gm.user_id",
+        'channel': "SELECT cm.channel_id as ref_id, u.id as user_id, u.username FROM channel_members cm JOIN users u ON u.id = cm.user_id",
+    }
+    unread = {'dm': "x.status != 'read'", 'group': "x.is_read = 0", 'channel': "x.is_read = 0"}
+    for kind in members:
+        conn.execute(f"""
+            INSERT OR IGNORE INTO conversation_summary (user_id, conversation_id, last_message, last_time, unread_count)
+            SELECT m.user_id, cv.id,
+                   (SELECT message FROM conversation_messages WHERE conversation_id = cv.id ORDER BY seq DESC LIMIT 1),
+                   (SELECT timestamp FROM conversation_messages WHERE conversation_id = cv.id ORDER BY seq DESC LIMIT 1),
+                   (SELECT COUNT(*) FROM conversation_messages x
+                    WHERE x.conversation_id = cv.id AND x.sender != m.username AND {unread[kind]})
+            FROM ({members[kind]}) m
+            JOIN conversations cv ON cv.kind = '{kind}' AND cv.ref_id = m.ref_id
+            WHERE EXISTS (SELECT 1 FROM conversation_messages WHERE conversation_id = cv.id)
+        """)
+
+
+@migration(7, "Курсоры прочтения read_cursor вместо флагов прочтения в сообщениях")
+def _read_cursors(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS read_cursor (
+            user_id INTEGER NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, conversation_id)
+        ) WITHOUT ROWID
+    """)
+    # Проверка «прочитано ли сообщение кем-то, кроме автора» идёт по этому индексу
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_read_cursor_conversation ON read_cursor(conversation_id, last_read_id)")
+
+    # Начальные курсоры - последнее чужое сообщение, отмеченное прочитанным старыми флагами
+    members = {
+        'dm': ("SELECT c.id as ref_id, u.id as user_id, u.username FROM chats c JOIN users u ON u.id IN (c.user1_id, c.user2_id)",
+               "x.status = 'read'"),
+        'group': ("SELECT gm.group_id as ref_id, u.id as user_id, u.username FROM group_members gm JOIN users u ON u.id = gm.user_id",
+                  "x.is_read = 1"),
+        'channel': ("SELECT cm.channel_id as ref_id, u.id as user_id, u.username FROM channel_members cm JOIN users u ON u.id = cm.user_id",
+                    "x.is_read = 1"),
+    }
+    for kind, (members_sql, read_condition) in members.items():
+        conn.execute(f"""
+            INSERT OR IGNORE INTO read_cursor (user_id, conversation_id, last_read_id)
+            SELECT user_id, conversation_id, last_read_id FROM (
+                SELECT m.user_id, cv.id as conversation_id,
+                       (SELECT MAX(x.id) FROM conversation_messages x
+                        WHERE x.conversation_id = cv.id AND x.sender != m.username AND {read_condition}) as last_read_id
+                FROM ({members_sql}) m
+                JOIN conversations cv ON cv.kind = '{kind}' AND cv.ref_id = m.ref_id
+            ) WHERE last_read_id IS NOT NULL
+        """)
+    conn.execute("""
+        UPDATE conversation_summary SET unread_count = (
+            SELECT COUNT(*) FROM conversation_messages x
+            WHERE x.conversation_id = conversation_summary.conversation_id
+              AND x.sender != (SELECT username FROM users WHERE id = conversation_summary.user_id)
+              AND x.id > COALESCE((SELECT last_read_id FROM read_cursor rc
+                                   WHERE rc.user_id = conversation_summary.user_id
+                                     AND rc.conversation_id = conversation_summary.conversation_id), 0)
+        )
+    """)
+
+
+@migration(8, "Материализованная лента timeline (рассылка постов при записи)")
+def _timeline(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS timeline (
+            user_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (user_id, post_id)
+        ) WITHOUT ROWID
+    """)
+    # Страница ленты - один проход по этому индексу; второй нужен для удаления поста
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timeline_user_time ON timeline(user_id, created_at, post_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timeline_post_id ON timeline(post_id)")
+    # Авторы с большим числом подписчиков: их посты не рассылаются, а подмешиваются при чтении
+    conn.execute("CREATE TABLE IF NOT EXISTS timeline_pull (user_id INTEGER PRIMARY KEY)")
+
+    conn.execute("INSERT OR IGNORE INTO timeline (user_id, post_id, created_at) SELECT user_id, id, created_at FROM posts")
+    conn.execute("""
+        INSERT OR IGNORE INTO timeline (user_id, post_id, created_at)
+        SELECT s.follower_id, p.id, p.created_at FROM subscriptions s JOIN posts p ON p.user_id = s.following_id
+    """)
+
+
+@migration(9, "Счётчики лайков, комментариев и репостов в posts")
+def _post_counters(conn):
+    for column in ('likes_count', 'comments_count', 'reposts_count'):
+        conn.execute(f"ALTER TABLE posts ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        UPDATE posts SET
+            likes_count = (SELECT COUNT(*) FROM likes WHERE post_id = posts.id),
+            comments_count = (SELECT COUNT(*) FROM comments WHERE post_id = posts.id),
+            reposts_count = (SELECT COUNT(*) FROM reposts WHERE original_post_id = posts.id)
+    """)
+    # Топ постов пользователя по лайкам
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_user_likes ON posts(user_id, likes_count)")
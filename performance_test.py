@@ -6,8 +6,11 @@
 import sqlite3
 import time
 
+import utils
+
 def test_performance():
-    conn = sqlite3.connect('database.db')
+    # База приложения (под pytest - временная база из conftest.py)
+    conn = sqlite3.connect(utils.DATABASE)
     cursor = conn.cursor()
 
     print("Тестирование производительности запросов:")
@@ -21,7 +24,11 @@ def test_performance():
     
     # Тестирование получения сообщений чата
     start_time = time.time()
-    cursor.execute("SELECT * FROM messages WHERE chat_id = 1 ORDER BY timestamp")  # Использует индексы idx_messages_chat_id и idx_messages_timestamp
+    cursor.execute("""
+        SELECT m.* FROM conversations c
+        JOIN conversation_messages m ON m.conversation_id = c.id
+        WHERE c.kind = 'dm' AND c.ref_id = 1 ORDER BY m.seq
+    """)  # Использует UNIQUE(kind, ref_id) и UNIQUE(conversation_id, seq)
     result = cursor.fetchall()
     end_time = time.time()
     print(f"Получение сообщений чата: {end_time - start_time:.6f} секунд")
@@ -45,4 +52,5 @@ def test_performance():
     print("\nТестирование завершено. Индексы значительно ускоряют выполнение частых запросов.")
 
 if __name__ == "__main__":
+    utils.init_db()  # таблицы conversations и conversation_messages появляются миграциями
     test_performance()
\ No newline at end of file
@@ -0,0 +1,301 @@
+# presence.py
+"""
+Реестр присутствия: какие сокеты (sid) открыты у пользователя, какой чат
+открыт в каждом из них и когда от сокета последний раз приходил heartbeat.
+
+У пользователя может быть несколько устройств или вкладок, поэтому всё
+хранится по sid, а пользователь онлайн, пока жив хотя бы один его сокет.
+Сокет, от которого давно не было heartbeat (например, воркер упал, не успев
+обработать disconnect), считается отключённым и убирается expire_stale().
+
+В одном процессе реестр живёт в памяти (LocalPresence) и разбит на шарды со
+своими блокировками, чтобы потоки обработчиков не ждали друг друга. Когда
+приложение запущено несколькими воркерами, те же данные хранятся в Redis
+(RedisPresence) и видны всем воркерам.
+"""
+import os
+import threading
+import time
+
+# Redis для присутствия; по умолчанию тот же, что и очередь сообщений Socket.IO
+PRESENCE_REDIS_URL = os.environ.get('PRESENCE_REDIS_URL') or os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+PRESENCE_PREFIX = os.environ.get('PRESENCE_PREFIX', 'presence')
+# Через сколько секунд без heartbeat сокет считается отключённым
+PRESENCE_TTL = float(os.environ.get('PRESENCE_TTL', 90))
+# Количество шардов реестра в памяти
+PRESENCE_SHARDS = int(os.environ.get('PRESENCE_SHARDS', 16))
+
+
+class _Shard:
+    __slots__ = ('lock', 'data')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+
+class LocalPresence:
+    """
+    Присутствие в памяти процесса (один воркер).
+
+    Шарды пользователей хранят {username: {sid: [последний heartbeat, открытый чат]}},
+    шарды комнат - обратный индекс {room: {sid: username}} для viewers_of().
+    Блокировки берутся в одном порядке: шард пользователя, затем шард комнаты.
+    """
+
+    def __init__(self, shards=PRESENCE_SHARDS, ttl=PRESENCE_TTL):
+        self.ttl = ttl
+        self._users = [_Shard() for _ in range(max(1, shards))]
+        self._rooms = [_Shard() for _ in range(max(1, shards))]
+
+    def _user_shard(self, username):
+        return self._users[hash(username) % len(self._users)]
+
+    def _room_shard(self, room):
+        return self._rooms[hash(room) % len(self._rooms)]
+
+    def _index_room(self, room, sid, username):
+        shard = self._room_shard(room)
+        with shard.lock:
+            if username is None:
+                viewers = shard.data.get(room)
+                if viewers is not None:
+                    viewers.pop(sid, None)
+                    if not viewers:
+                        del shard.data[room]
+            else:
+                shard.data.setdefault(room, {})[sid] = username
+
+    def connect(self, username, sid, now=None):
+        """Зарегистрировать сокет; возвращает True, если пользователь только что стал онлайн"""
+        return self.heartbeat(username, sid, now)[0]
+
+    def heartbeat(self, username, sid, now=None):
+        """
+        Продлить жизнь сокета (и вернуть в онлайн, если он успел истечь).
+
+        Возвращает (стал онлайн, сокет был забыт). Забытый сокет уже убран
+        expire_stale() вместе с открытым чатом и регистрируется заново без него:
+        клиент должен снова прислать свой контекст.
+        """
+        now = time.time() if now is None else now
+        shard = self._user_shard(username)
+        with shard.lock:
+            sessions = shard.data.setdefault(username, {})
+            was_online = any(now - seen < self.ttl for seen, _ in sessions.values())
+            known = sid in sessions
+            if known:
+                sessions[sid][0] = now
+            else:
+                sessions[sid] = [now, None]
+        return not was_online, not known
+
+    def disconnect(self, username, sid=None):
+        """
+        Убрать сокет sid (или все сокеты пользователя при выходе из аккаунта).
+
+        Возвращает True, если у пользователя не осталось сокетов и он ушёл в оффлайн.
+        """
+        return self._drop(username, sid)
+
+    def _drop(self, username, sid, older_than=None):
+        shard = self._user_shard(username)
+        with shard.lock:
+            sessions = shard.data.get(username)
+            if not sessions or (sid is not None and sid not in sessions):
+                return False
+            if older_than is not None and sessions[sid][0] >= older_than:
+                return False  # heartbeat успел прийти после проверки
+            removed = {s: sessions.pop(s)[1] for s in ([sid] if sid is not None else list(sessions))}
+            gone = not sessions
+            if gone:
+                del shard.data[username]
+            for s, room in removed.items():
+                if room:
+                    self._index_room(room, s, None)
+        return gone
+
+    def is_online(self, username, now=None):
+        now = time.time() if now is None else now
+        shard = self._user_shard(username)
+        with shard.lock:
+            sessions = shard.data.get(username)
+            return bool(sessions) and any(now - seen < self.ttl for seen, _ in sessions.values())
+
+    def sids_for(self, username, now=None):
+        """Живые сокеты пользователя"""
+        now = time.time() if now is None else now
+        shard = self._user_shard(username)
+        with shard.lock:
+            sessions = shard.data.get(username) or {}
+            return {sid for sid, (seen, _) in sessions.items() if now - seen < self.ttl}
+
+    def set_context(self, username, sid, room):
+        """Запомнить чат, открытый в сокете sid, и вернуть предыдущий"""
+        room = room or None
+        shard = self._user_shard(username)
+        with shard.lock:
+            session = (shard.data.get(username) or {}).get(sid)
+            if session is None:
+                return None
+            old_room, session[1] = session[1], room
+            if old_room != room:
+                if old_room:
+                    self._index_room(old_room, sid, None)
+                if room:
+                    self._index_room(room, sid, username)
+        return old_room
+
+    def viewers_of(self, room):
+        """Пользователи, у которых чат room открыт хотя бы на одном устройстве"""
+        shard = self._room_shard(room)
+        with shard.lock:
+            return set((shard.data.get(room) or {}).values())
+
+    def expire_stale(self, now=None):
+        """Убрать сокеты без heartbeat дольше ttl; возвращает пользователей, ушедших в оффлайн"""
+        now = time.time() if now is None else now
+        stale = []
+        for shard in self._users:
+            with shard.lock:
+                for username, sessions in shard.data.items():
+                    stale += [(username, sid) for sid, (seen, _) in sessions.items() if now - seen >= self.ttl]
+        return [username for username, sid in stale if self._drop(username, sid, older_than=now - self.ttl)]
+
+    def online_count(self):
+        total = 0
+        for shard in self._users:
+            with shard.lock:
+                total += len(shard.data)
+        return total
+
+
+class RedisPresence:
+    """
+    Присутствие в Redis, общее для всех воркеров.
+
+    <prefix>:user:<username> - хеш sid -> время последнего heartbeat
+    <prefix>:ctx:<username>  - хеш sid -> открытый чат
+    <prefix>:room:<room>     - хеш sid -> username (обратный индекс для viewers_of)
+    <prefix>:hb              - сортированное множество sid по времени heartbeat
+    <prefix>:owner           - хеш sid -> username (для expire_stale)
+    """
+
+    def __init__(self, client, prefix=PRESENCE_PREFIX, ttl=PRESENCE_TTL):
+        self.redis = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self._heartbeats = f"{prefix}:hb"
+        self._owners = f"{prefix}:owner"
+
+    def _user_key(self, username):
+        return f"{self.prefix}:user:{username}"
+
+    def _ctx_key(self, username):
+        return f"{self.prefix}:ctx:{username}"
+
+    def _room_key(self, room):
+        return f"{self.prefix}:room:{room}"
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _fresh_sids(self, username, now):
+        seen = self.redis.hgetall(self._user_key(username))
+        return {self._decode(sid) for sid, ts in seen.items() if now - float(ts) < self.ttl}
+
+    def connect(self, username, sid, now=None):
+        return self.heartbeat(username, sid, now)[0]
+
+    def heartbeat(self, username, sid, now=None):
+        """См. LocalPresence.heartbeat"""
+        now = time.time() if now is None else now
+        seen = {self._decode(s): float(ts) for s, ts in self.redis.hgetall(self._user_key(username)).items()}
+        was_online = any(now - ts < self.ttl for ts in seen.values())
+        pipe = self.redis.pipeline()
+        pipe.hset(self._user_key(username), sid, now)
+        pipe.zadd(self._heartbeats, {sid: now})
+        pipe.hset(self._owners, sid, username)
+        pipe.execute()
+        return not was_online, sid not in seen
+
+    def disconnect(self, username, sid=None):
+        """См. LocalPresence.disconnect; проверка и удаление выполняются атомарно (WATCH)"""
+        return self._drop(username, sid)
+
+    def _drop(self, username, sid, older_than=None):
+        user_key, ctx_key = self._user_key(username), self._ctx_key(username)
+
+        def remove(pipe):
+            seen = {self._decode(s): float(ts) for s, ts in pipe.hgetall(user_key).items()}
+            sids = [sid] if sid is not None else list(seen)
+            if not seen or not set(sids) <= seen.keys():
+                return False
+            if older_than is not None and seen[sid] >= older_than:
+                return False
+            rooms = [self._decode(r) for r in pipe.hmget(ctx_key, sids)]
+            pipe.multi()
+            for s, room in zip(sids, rooms):
+                if room:
+                    pipe.hdel(self._room_key(room), s)
+            pipe.hdel(user_key, *sids)
+            pipe.hdel(ctx_key, *sids)
+            pipe.zrem(self._heartbeats, *sids)
+            pipe.hdel(self._owners, *sids)
+            return len(seen) == len(sids)
+
+        return bool(self.redis.transaction(remove, user_key, value_from_callable=True))
+
+    def is_online(self, username, now=None):
+        return bool(self.sids_for(username, now))
+
+    def sids_for(self, username, now=None):
+        return self._fresh_sids(username, time.time() if now is None else now)
+
+    def set_context(self, username, sid, room):
+        room = room or None
+        user_key, ctx_key = self._user_key(username), self._ctx_key(username)
+
+        # Под WATCH: одновременный disconnect не оставит sid в индексе комнаты
+        def update(pipe):
+            if not pipe.hexists(user_key, sid):
+                return None
+            old_room = self._decode(pipe.hget(ctx_key, sid))
+            pipe.multi()
+            if old_room and old_room != room:
+                pipe.hdel(self._room_key(old_room), sid)
+            if room:
+                pipe.hset(ctx_key, sid, room)
+                pipe.hset(self._room_key(room), sid, username)
+            else:
+                pipe.hdel(ctx_key, sid)
+            return old_room
+
+        return self.redis.transaction(update, user_key, value_from_callable=True)
+
+    def viewers_of(self, room):
+        return {self._decode(u) for u in self.redis.hvals(self._room_key(room))}
+
+    def expire_stale(self, now=None):
+        now = time.time() if now is None else now
+        stale = [self._decode(s) for s in self.redis.zrangebyscore(self._heartbeats, '-inf', now - self.ttl)]
+        gone = []
+        for sid in stale:
+            username = self._decode(self.redis.hget(self._owners, sid))
+            if username is None:
+                self.redis.zrem(self._heartbeats, sid)
+            elif self._drop(username, sid, older_than=now - self.ttl):
+                gone.append(username)
+        return gone
+
+    def online_count(self):
+        return len({self._decode(u) for u in self.redis.hvals(self._owners)})
+
+
+def create_presence_store(url=PRESENCE_REDIS_URL):
+    """Реестр присутствия: Redis, если задан адрес, иначе память процесса"""
+    if not url:
+        return LocalPresence()
+    import redis
+    return RedisPresence(redis.Redis.from_url(url))
@@ -1,102 +1,226 @@
-import redis
-from datetime import timedelta
+# redis_config.py
+"""
+Подключение к Redis и кэш страниц ленты (кэш результатов запросов - в cache.py).
 
-# Подключение к Redis
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+Кэш ленты включается адресом CACHE_REDIS_URL; без него лента читается из базы.
+Сброс никогда не ищет ключи по шаблону (KEYS), вместо этого растут счётчики поколений:
 
-# TTL для разных типов данных
-PROFILE_TTL = timedelta(hours=2)      # Профили пользователей
-MESSAGES_TTL = timedelta(minutes=30)  # Сообщения чатов
-MEMBERS_TTL = timedelta(hours=1)      # Участники каналов
-FEED_TTL = timedelta(minutes=15)      # Лента постов
+- feed:gen:<user_id> - поколение ленты пользователя. Его увеличивают новый
+  пост в ленте, подписка и отписка: страницы прежнего поколения больше не
+  находятся и истекают по FEED_PAGE_TTL.
+- feed:page:<user_id>:<поколение>:<offset>:<limit> - id постов страницы и
+  поколения больших авторов из подписок (их посты не рассылаются по лентам,
+  а подмешиваются при чтении), с которыми страница собрана.
+- feed:post:<post_id>:<версия> - общие для всех зрителей данные поста: автор,
+  текст, счётчики, первые комментарии и реакции. Версию feed:pv:<post_id>
+  увеличивают правка и удаление поста, лайк, комментарий, репост и реакция.
 
-import redis
+Отметки зрителя (лайк, репост, реакция) в кэш не попадают и считаются при каждом чтении.
+
+Сброс запрашивается задачами записи после фиксации, а там (поток-писатель,
+пул потоков под gevent) сокеты Redis использовать нельзя: сбросы копятся в
+очереди и отправляются одним конвейером из потока запроса - перед чтением
+ленты и после каждого HTTP-запроса. Если Redis недоступен, лента читается из
+базы, а неотправленные сбросы ждут восстановления.
+"""
 import json
-from datetime import timedelta
-
-# Подключение к Redis
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
-
-# TTL для разных типов данных
-PROFILE_TTL = timedelta(hours=2)      # Профили пользователей
-MESSAGES_TTL = timedelta(minutes=30)  # Сообщения чатов
-MEMBERS_TTL = timedelta(hours=1)      # Участники каналов
-FEED_TTL = timedelta(minutes=15)      # Лента постов
-
-def get_user_profile_cached(user_id):
-    cache_key = f"user_profile:{user_id}"
-    cached_data = redis_client.get(cache_key)
-    
-    if cached_data:
-        return json.loads(cached_data)
-    
-    # Загрузка из базы данных
-    profile = get_user_profile_from_db(user_id)
-    
-    # Сохранение в кэш
-    redis_client.setex(cache_key, int(PROFILE_TTL.total_seconds()), json.dumps(profile))
-    return profile
-
-def invalidate_user_profile_cache(user_id):
-    cache_key = f"user_profile:{user_id}"
-    redis_client.delete(cache_key)
-
-def get_chat_messages_cached(chat_id, page=1, per_page=20):
-    cache_key = f"chat_messages:{chat_id}:page_{page}_{per_page}"
-    cached_data = redis_client.get(cache_key)
-    
-    if cached_data:
-        return json.loads(cached_data)
-    
-    # Загрузка из базы данных
-    messages = get_chat_messages_from_db(chat_id, page, per_page)
-    
-    # Сохранение в кэш
-    redis_client.setex(cache_key, int(MESSAGES_TTL.total_seconds()), json.dumps(messages))
-    return messages
-
-def invalidate_chat_messages_cache(chat_id):
-    # Удаление всех страниц кэша для этого чата
-    pattern = f"chat_messages:{chat_id}:page_*"
-    keys_to_delete = redis_client.keys(pattern)
-    if keys_to_delete:
-        redis_client.delete(*keys_to_delete)
-
-def get_channel_members_cached(channel_id):
-    cache_key = f"channel_members:{channel_id}"
-    cached_data = redis_client.get(cache_key)
-    
-    if cached_data:
-        return json.loads(cached_data)
-    
-    # Загрузка из базы данных
-    members = get_channel_members_from_db(channel_id)
-    
-    # Сохранение в кэш
-    redis_client.setex(cache_key, int(MEMBERS_TTL.total_seconds()), json.dumps(members))
-    return members
-
-def invalidate_channel_members_cache(channel_id):
-    cache_key = f"channel_members:{channel_id}"
-    redis_client.delete(cache_key)
-
-def get_feed_cached(user_id, page=1, per_page=20):
-    cache_key = f"feed:{user_id}:page_{page}_{per_page}"
-    cached_data = redis_client.get(cache_key)
-    
-    if cached_data:
-        return json.loads(cached_data)
-    
-    # Загрузка из базы данных
-    feed = get_feed_from_db(user_id, page, per_page)
-    
-    # Сохранение в кэш
-    redis_client.setex(cache_key, int(FEED_TTL.total_seconds()), json.dumps(feed))
-    return feed
-
-def invalidate_feed_cache(user_id):
-    # Удаление всех страниц кэша ленты для этого пользователя
-    pattern = f"feed:{user_id}:page_*"
-    keys_to_delete = redis_client.keys(pattern)
-    if keys_to_delete:
-        redis_client.delete(*keys_to_delete)
+import os
+import time
+from _queue import SimpleQueue, Empty
+
+import redis
+
+from app_logging import get_logger
+
+log = get_logger('cache')
+
+# Адрес Redis для кэшей, например redis://localhost:6379/0 (пусто - кэш ленты выключен, кэш запросов только в памяти)
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', '')
+# Тайм-аут операций с Redis в секундах: недоступный кэш не должен задерживать запрос
+CACHE_REDIS_TIMEOUT = float(os.environ.get('CACHE_REDIS_TIMEOUT', 0.25))
+# Сколько секунд не обращаться к Redis после ошибки
+CACHE_RETRY_AFTER = float(os.environ.get('CACHE_RETRY_AFTER', 5))
+# Сколько неотправленных сбросов хранить, пока Redis недоступен (дальше устаревание ограничено TTL)
+CACHE_PENDING_LIMIT = int(os.environ.get('CACHE_PENDING_LIMIT', 100000))
+
+
+def connect(url):
+    return redis.Redis.from_url(url, decode_responses=True, socket_timeout=CACHE_REDIS_TIMEOUT,
+                                socket_connect_timeout=CACHE_REDIS_TIMEOUT)
+
+
+# Лента: список id страницы и общие данные поста
+FEED_PAGE_TTL = int(os.environ.get('FEED_PAGE_TTL', 900))
+FEED_POST_TTL = int(os.environ.get('FEED_POST_TTL', 900))
+
+# === Кэш ленты ===
+
+def _gen_key(user_id):
+    return f"feed:gen:{user_id}"
+
+
+def _version_key(post_id):
+    return f"feed:pv:{post_id}"
+
+
+def _hit_rate(hits, misses):
+    return round(hits / (hits + misses), 3) if hits + misses else None
+
+
+class FeedCache:
+    """
+    Страницы ленты в Redis: списки id по поколениям и общие данные постов по версиям.
+
+    :param client: клиент Redis с decode_responses=True
+    :param page_ttl: сколько секунд хранить список id страницы
+    :param post_ttl: сколько секунд хранить общие данные поста
+    """
+
+    def __init__(self, client, page_ttl=FEED_PAGE_TTL, post_ttl=FEED_POST_TTL):
+        self.client = client
+        self.page_ttl = page_ttl
+        self.post_ttl = post_ttl
+        # Очередь из C-модуля _queue gevent не подменяет: в неё пишут поток-писатель и пул
+        self._pending = SimpleQueue()
+        self._unsent = []
+        self._down_until = 0.0
+        self.page_hits = self.page_misses = 0
+        self.post_hits = self.post_misses = 0
+        self.errors = 0
+
+    def _available(self):
+        return time.monotonic() >= self._down_until
+
+    def _failed(self, error):
+        self.errors += 1
+        self._down_until = time.monotonic() + CACHE_RETRY_AFTER
+        log.warning("Redis недоступен, лента читается из базы %s с: %s", CACHE_RETRY_AFTER, error)
+
+    def invalidate(self, user_ids=(), post_ids=()):
+        """Запомнить сброс лент и постов (из любого потока); отправляет его flush()"""
+        if user_ids or post_ids:
+            self._pending.put((tuple(user_ids), tuple(post_ids)))
+
+    def flush(self):
+        """Отправить накопленные сбросы одним конвейером (только из потока запроса)"""
+        batch, self._unsent = self._unsent, []
+        while True:
+            try:
+                batch.append(self._pending.get_nowait())
+            except Empty:
+                break
+        if not batch:
+            return
+        if self._available():
+            users = {user_id for user_ids, _ in batch for user_id in user_ids}
+            posts = {post_id for _, post_ids in batch for post_id in post_ids}
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for user_id in users:
+                    pipe.incr(_gen_key(user_id))
+                for post_id in posts:
+                    pipe.incr(_version_key(post_id))
+                pipe.execute()
+                return
+            except redis.RedisError as e:
+                self._failed(e)
+        if len(batch) > CACHE_PENDING_LIMIT:
+            log.warning("Отброшено %d сбросов кэша ленты", len(batch) - CACHE_PENDING_LIMIT)
+            batch = batch[-CACHE_PENDING_LIMIT:]
+        self._unsent = batch + self._unsent
+
+    def page(self, user_id, offset, limit, load_ids, load_pull_authors):
+        """
+        id постов страницы ленты.
+
+        :param load_ids: load_ids() -> id постов страницы из базы
+        :param load_pull_authors: load_pull_authors() -> id больших авторов из подписок
+        """
+        if not self._available():
+            return load_ids()
+        try:
+            generation = self.client.get(_gen_key(user_id)) or '0'
+            key = f"feed:page:{user_id}:{generation}:{offset}:{limit}"
+            cached = self.client.get(key)
+            if cached is not None:
+                page = json.loads(cached)
+                authors = page['authors']
+                if not authors or self.client.mget([_gen_key(a) for a in authors]) == list(authors.values()):
+                    self.page_hits += 1
+                    return page['ids']
+        except redis.RedisError as e:
+            self._failed(e)
+            return load_ids()
+
+        self.page_misses += 1
+        # Поколения больших авторов читаются до страницы: их новый пост после этого сменит ключ
+        authors = load_pull_authors()
+        try:
+            generations = self.client.mget([_gen_key(a) for a in authors]) if authors else []
+        except redis.RedisError as e:
+            self._failed(e)
+            return load_ids()
+        ids = load_ids()
+        page = {'ids': ids, 'authors': {str(a): g for a, g in zip(authors, generations)}}
+        try:
+            self.client.set(key, json.dumps(page), ex=self.page_ttl)
+        except redis.RedisError as e:
+            self._failed(e)
+        return ids
+
+    def posts(self, ids, load):
+        """
+        Общие данные постов {id: пост}.
+
+        :param load: load(ids) -> {id: пост} для постов, которых нет в кэше
+        """
+        if not ids:
+            return {}
+        if not self._available():
+            return load(ids)
+        try:
+            versions = self.client.mget([_version_key(post_id) for post_id in ids])
+            keys = {post_id: f"feed:post:{post_id}:{version or 0}" for post_id, version in zip(ids, versions)}
+            cached = self.client.mget(list(keys.values()))
+        except redis.RedisError as e:
+            self._failed(e)
+            return load(ids)
+
+        posts = {post_id: json.loads(raw) for post_id, raw in zip(keys, cached) if raw is not None}
+        missing = [post_id for post_id in keys if post_id not in posts]
+        self.post_hits += len(posts)
+        self.post_misses += len(missing)
+        if missing:
+            loaded = load(missing)
+            posts.update(loaded)
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for post_id, post in loaded.items():
+                    pipe.set(keys[post_id], json.dumps(post), ex=self.post_ttl)
+                pipe.execute()
+            except redis.RedisError as e:
+                self._failed(e)
+        return posts
+
+    def stats(self):
+        return {
+            'page_hits': self.page_hits, 'page_misses': self.page_misses,
+            'page_hit_rate': _hit_rate(self.page_hits, self.page_misses),
+            'post_hits': self.post_hits, 'post_misses': self.post_misses,
+            'post_hit_rate': _hit_rate(self.post_hits, self.post_misses),
+            'errors': self.errors, 'pending': self._pending.qsize() + len(self._unsent),
+        }
+
+
+def create_feed_cache(url=CACHE_REDIS_URL):
+    """Кэш ленты, если задан адрес Redis, иначе None (лента читается из базы)"""
+    return FeedCache(connect(url)) if url else None
+
+
+feed_cache = create_feed_cache()
+
+
+def invalidate_feed_cache(user_ids=(), post_ids=()):
+    """Сбросить ленты пользователей и данные постов (без кэша ленты ничего не делает)"""
+    if feed_cache is not None:
+        feed_cache.invalidate(user_ids, post_ids)
@@ -0,0 +1,82 @@
+# roster.py
+"""
+Кэш составов бесед: участники группы, канала или личного чата.
+
+Рассылка уведомлений о новом сообщении обходит всех участников беседы; состав
+загружается одним запросом с JOIN и дальше берётся из памяти, пока его не
+сбросят изменения членства (add/remove участника, удаление беседы).
+
+Сброс виден только в своём процессе, а устаревший состав пропускает новых
+участников и отправляет сообщения вышедшим. Поэтому при нескольких воркерах
+(задана очередь сообщений Socket.IO) кэш по умолчанию выключен
+(ROSTER_CACHE_SIZE=0) и состав загружается при каждой рассылке.
+"""
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+# Сколько составов бесед держать в памяти (самые давно использованные вытесняются; 0 - кэш выключен)
+ROSTER_CACHE_SIZE = int(os.environ.get('ROSTER_CACHE_SIZE', 0 if os.environ.get('SOCKETIO_MESSAGE_QUEUE') else 1024))
+
+Member = namedtuple('Member', 'user_id username')
+
+# Сколько счётчиков поколений держать до сброса (сброс меняет эпоху и отменяет идущие загрузки)
+_MAX_GENERATIONS = 10000
+
+
+class RosterCache:
+    """
+    LRU-кэш составов бесед.
+
+    :param loader: функция loader(kind, ref_id) -> последовательность Member
+    :param max_entries: максимальное количество бесед в кэше (0 - кэш выключен)
+    """
+
+    def __init__(self, loader, max_entries=ROSTER_CACHE_SIZE):
+        self._loader = loader
+        self.max_entries = max(0, max_entries)
+        self._entries = OrderedDict()
+        # Поколение ключа растёт при сбросе: загрузка, начатая до сброса, не попадёт в кэш
+        self._generations = {}
+        self._epoch = 0  # растёт при полной очистке
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, ref_id):
+        key = (kind, ref_id)
+        with self._lock:
+            members = self._entries.get(key)
+            if members is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return members
+            self.misses += 1
+            generation = (self._epoch, self._generations.get(key, 0))
+
+        members = tuple(self._loader(kind, ref_id))
+        with self._lock:
+            if (self._epoch, self._generations.get(key, 0)) == generation:
+                self._entries[key] = members
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return members
+
+    def invalidate(self, kind, ref_id):
+        key = (kind, ref_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._generations) >= _MAX_GENERATIONS:
+                self._generations.clear()
+                self._epoch += 1
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,60 @@
+"""
+Тестирование журналирования: уровни подсистем, ограничение частоты и очередь
+"""
+import logging
+
+from app_logging import RateLimitFilter, QueuedHandler, parse_levels
+
+
+def _record(msg, *args, name='chat.socket'):
+    return logging.LogRecord(name, logging.DEBUG, __file__, 0, msg, args, None)
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_subsystem_levels_are_parsed():
+    assert parse_levels('socket=DEBUG, db=warning,,http=') == {'socket': logging.DEBUG, 'db': logging.WARNING}
+    print("[OK] Уровни подсистем разбираются из LOG_LEVELS")
+
+
+def test_repeated_records_are_rate_limited():
+    limiter = RateLimitFilter(rate=2)
+    passed = [limiter.filter(_record("send_message от %s", i), now=0) for i in range(10)]
+    assert passed == [True, True] + [False] * 8
+    # Другой шаблон ограничивается отдельно
+    assert limiter.filter(_record("Поиск %r", 'q'), now=0)
+
+    # Через секунду записи снова проходят, к первой дописывается число пропущенных
+    record = _record("send_message от %s", 'test1')
+    assert limiter.filter(record, now=1.0)
+    assert record.getMessage() == "send_message от test1 (пропущено похожих записей: 8)"
+    assert limiter.suppressed == 8
+    print("[OK] Повторяющиеся записи ограничиваются по частоте")
+
+
+def test_full_queue_drops_instead_of_blocking():
+    target = _ListHandler()
+    handler = QueuedHandler(target, max_queue=3)
+    handler._started = True  # поток вывода не запущен: очередь только наполняется
+    for i in range(5):
+        handler.handle(_record("запись %s", i))
+    assert handler.queue.qsize() == 3 and handler.dropped == 2
+
+    handler._started = False
+    handler._ensure_started()
+    handler.flush_and_stop()
+    assert target.messages == ['запись 0', 'запись 1', 'запись 2']
+    print("[OK] Переполненная очередь отбрасывает записи, поток выводит накопленные")
+
+
+if __name__ == "__main__":
+    test_subsystem_levels_are_parsed()
+    test_repeated_records_are_rate_limited()
+    test_full_queue_drops_instead_of_blocking()
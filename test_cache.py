@@ -0,0 +1,244 @@
+"""
+Тестирование двухуровневого кэша запросов (память процесса + Redis)
+"""
+import sys
+import threading
+import time
+
+import pytest
+
+import utils
+from cache import QueryCache
+
+
+def _counting(rows):
+    # Функция чтения, которая запоминает свои вызовы
+    loads = []
+
+    def load(kind, name):
+        loads.append(name)
+        return rows.get((kind, name))
+    return load, loads
+
+
+def _name_cache(cache, load):
+    return cache.cached('names', tags=lambda row, kind, name: [f'{kind}-name:{name}'] + (
+        [f"{kind}:{row['id']}"] if row else []))(load)
+
+
+def test_rows_and_misses_are_cached():
+    rows = {('user', 'test1'): {'id': 1, 'username': 'test1'}}
+    load, loads = _counting(rows)
+    cache = QueryCache()
+    get = _name_cache(cache, load)
+    assert get('user', 'test1')['id'] == 1
+    assert get('user', 'test1')['id'] == 1
+    assert get('user', 'нет') is None
+    assert get('user', 'нет') is None  # отсутствие тоже в кэше
+    assert loads == ['test1', 'нет']
+
+    # Каждый вызов получает свою копию значения
+    get('user', 'test1')['username'] = 'испорчено'
+    assert get('user', 'test1')['username'] == 'test1'
+
+    # Переименование: сброс по id находит старое имя, новое перестаёт быть «отсутствующим»
+    rows[('user', 'нет')] = rows.pop(('user', 'test1'))
+    cache.invalidate('user:1', 'user-name:нет')
+    assert get('user', 'test1') is None and get('user', 'нет')['id'] == 1
+    stats = cache.stats()
+    assert (stats['entries'], stats['l1_hits'], stats['misses']) == (2, 4, 4)
+    print("[OK] Строки и отсутствие имени кэшируются, сброс по тегам находит старое имя")
+
+
+def test_invalidation_during_load_is_not_cached():
+    cache = QueryCache()
+
+    def load():
+        # Строка изменилась, пока шла загрузка, а её имя ещё не было в кэше
+        cache.invalidate('channel:7')
+        return {'id': 7, 'name': 'новости'}
+
+    cache.get('channel', 'новости', load, lambda row: [f"channel:{row['id']}"])
+    assert cache.stats()['entries'] == 0
+    print("[OK] Загрузка, пересёкшаяся со сбросом, не попадает в кэш")
+
+
+def test_concurrent_misses_load_once():
+    cache = QueryCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        time.sleep(0.05)
+        return ['участник']
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('members', '1', load))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1 and results == [['участник']] * 8
+    assert cache.stats()['coalesced'] == 7
+    print("[OK] Одновременные промахи по ключу загружают значение один раз")
+
+
+def test_memory_cap_evicts_least_recently_used():
+    cache = QueryCache(max_bytes=30)
+    for key in ('a', 'b', 'c'):
+        cache.get('row', key, lambda: 'x' * 8)  # 10 байт JSON
+    cache.get('row', 'a', lambda: pytest.fail("запись 'a' должна быть в кэше"))
+    cache.get('row', 'd', lambda: 'x' * 8)
+    assert cache.stats()['bytes'] == 30 and cache.stats()['evictions'] == 1
+    assert cache.get('row', 'b', lambda: 'заново') == 'заново'  # вытеснена давно не использованная
+    print("[OK] Объём L1 ограничен, вытесняются давно не использованные записи")
+
+
+def test_redis_tier_is_shared_and_invalidated_by_tags():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    # Три процесса с общим Redis
+    first, second, third = (QueryCache(fakeredis.FakeRedis(server=server, decode_responses=True)) for _ in range(3))
+    rows = {('user', 'test1'): {'id': 1, 'username': 'test1'}}
+    load, loads = _counting(rows)
+
+    assert _name_cache(first, load)('user', 'test1')['id'] == 1
+    assert _name_cache(second, load)('user', 'test1')['id'] == 1
+    assert _name_cache(second, load)('user', 'нет') is None
+    assert loads == ['test1', 'нет'] and second.stats()['l2_hits'] == 1
+
+    # Сброс по тегу в одном процессе: версия тега в Redis растёт, запись в L2 больше не действует
+    rows[('user', 'test1')] = {'id': 1, 'username': 'test1', 'city': 'Москва'}
+    first.invalidate('user:1')
+    first.flush()
+    assert _name_cache(third, load)('user', 'test1')['city'] == 'Москва'
+    assert loads == ['test1', 'нет', 'test1']
+    print("[OK] Redis общий для процессов, сброс по тегу действует во всех")
+
+
+def test_invalidation_in_other_process_during_load_skips_redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    first, second, third = (QueryCache(fakeredis.FakeRedis(server=server, decode_responses=True)) for _ in range(3))
+    rows = {'role': 'Admin'}
+
+    def load():
+        # Роль прочитана, и тут другой процесс меняет её и отправляет сброс
+        role = rows['role']
+        rows['role'] = 'Member'
+        second.invalidate('channel:1:members')
+        second.flush()
+        return role
+
+    assert first.get('role', '1', load, lambda role: ['channel:1:members']) == 'Admin'
+    assert first.stats()['skipped'] == 1
+    # Устаревшая роль не попала в Redis с новой версией тега
+    assert third.get('role', '1', lambda: rows['role'], lambda role: ['channel:1:members']) == 'Member'
+    print("[OK] Сброс в другом процессе во время загрузки не даёт записать устаревший результат в Redis")
+
+
+def test_unavailable_redis_degrades_to_memory():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    server.connected = False
+    cache = QueryCache(fakeredis.FakeRedis(server=server, decode_responses=True))
+    load, loads = _counting({('group', 'g'): {'id': 3}})
+    get = _name_cache(cache, load)
+    assert get('group', 'g') == {'id': 3} and get('group', 'g') == {'id': 3}
+    assert loads == ['g'] and cache.stats()['errors'] == 1
+
+    # Сбросы ждут, пока Redis снова станет доступен
+    cache.invalidate('group:3')
+    cache.flush()
+    assert cache.stats()['pending'] == 1
+    server.connected = True
+    cache._down_until = 0  # пауза после ошибки истекла
+    cache.flush()
+    assert cache.stats()['pending'] == 0
+    print("[OK] Без Redis кэш работает в памяти процесса")
+
+
+def test_cluster_keeps_auth_lookups_out_of_memory():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    # Два воркера: сброс в одном не доходит до L1 другого
+    first, second = (QueryCache(fakeredis.FakeRedis(server=server, decode_responses=True), cluster=True)
+                     for _ in range(2))
+    roles = {'role': 'Admin'}
+    for cache in (first, second):
+        cache.cached('role', tags=lambda role: ['channel:1:members'], l1=False)(lambda: roles['role'])
+        cache.cached('title', tags=lambda title: ['channel:1'])(lambda: 'новости')
+    assert second.functions['role']() == 'Admin' and second.functions['title']() == 'новости'
+    assert second.stats()['entries'] == 1  # в памяти только название
+
+    roles['role'] = 'Member'
+    first.invalidate('channel:1:members')
+    first.flush()
+    assert second.functions['role']() == 'Member'
+    print("[OK] В кластерном режиме роли читаются из Redis или базы, а не из памяти процесса")
+
+
+def test_cached_user_row_has_no_password():
+    assert 'password' not in utils.get_user_by_username('test1')
+    credentials = utils.get_user_credentials('TEST1')
+    assert utils.verify_password('pass1', credentials['password'])
+    utils.update_user(credentials['id'], password=utils.hash_password('новый'))
+    assert utils.verify_password('новый', utils.get_user_credentials('test1')['password'])
+    print("[OK] Хеш пароля не попадает в кэш и читается из базы")
+
+
+def test_writes_invalidate_names():
+    user_id = utils.get_user_by_username('test1')['id']
+
+    assert utils.get_channel_by_name('имена') is None
+    channel_id = utils.create_channel('имена', 'test1')
+    assert utils.get_channel_by_name('имена')['id'] == channel_id
+    utils.update_channel(channel_id, 'имена2', 'описание', False)
+    assert utils.get_channel_by_name('имена') is None
+    assert utils.get_channel_by_name('имена2')['description'] == 'описание'
+
+    assert utils.get_user_by_username('Новое_Имя') is None
+    utils.update_user(user_id, username='новое_имя', city='Москва')
+    assert utils.get_user_by_username('test1') is None
+    assert utils.get_user_by_username('Новое_Имя')['city'] == 'Москва'
+    utils.set_user_avatar(user_id, 'a.png')
+    assert utils.get_user_by_username('новое_имя')['avatar'] == 'a.png'
+
+    group_id = utils.create_group('имена', 'test2')
+    utils.save_pinned_message(group_id, 1)
+    assert utils.get_group_by_name('имена')['pinned_msg_id'] == 1
+    utils.delete_group(group_id)
+    assert utils.get_group_by_name('имена') is None
+    print("[OK] Создание, переименование, правка и удаление сбрасывают кэш имён")
+
+
+def test_writes_invalidate_channel_reads():
+    user2 = utils.get_user_by_username('test2')['id']
+    channel_id = utils.create_channel('кэш', 'test1')
+    assert [m['username'] for m in utils.get_channel_members(channel_id)] == ['test1']
+    assert utils.get_user_channel_role(user2, channel_id) is None
+
+    utils.add_user_to_channel(channel_id, user2, 3)
+    assert utils.get_user_channel_role(user2, channel_id) == 'Member'
+    utils.set_channel_member_role(channel_id, user2, 2)
+    assert utils.get_user_channel_role(user2, channel_id) == 'Moderator'
+    utils.update_user(user2, username='переименован')
+    assert {m['username'] for m in utils.get_channel_members(channel_id)} == {'test1', 'переименован'}
+    utils.remove_user_from_channel(channel_id, user2)
+    assert utils.get_user_channel_role(user2, channel_id) is None
+
+    group_id = utils.create_group('закреп', 'test1')
+    msg_id = utils.save_group_message(group_id, 'test1', 'важное')
+    assert utils.get_pinned_message(group_id) is None
+    utils.save_pinned_message(group_id, msg_id)
+    assert utils.get_pinned_message(group_id)['message'] == 'важное'
+    assert utils.edit_own_message(msg_id, 'test1', 'исправлено', 'group', group_id)
+    assert utils.get_pinned_message(group_id)['message'] == 'исправлено'
+    assert utils.delete_own_message(msg_id, 'test1', 'group', group_id)
+    assert utils.get_pinned_message(group_id) is None
+    print("[OK] Запись сбрасывает закэшированных участников, роли и закреплённое сообщение")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,79 @@
+"""
+Тестирование сводки списка чатов conversation_summary
+"""
+import sys
+
+import pytest
+
+import utils
+
+
+def _user_ids():
+    return utils.get_user_by_username('test1')['id'], utils.get_user_by_username('test2')['id']
+
+
+def _chat_with(user_id, username):
+    return next(c for c in utils.get_user_chats(user_id) if c['username'] == username)
+
+
+def _group(user_id, name):
+    return next(g for g in utils.get_groups_for_user(user_id) if g['name'] == name)
+
+
+def test_dm_summary_follows_messages_and_reads():
+    user1, user2 = _user_ids()
+    chat_id = utils.get_or_create_chat(user1, user2)
+    assert utils.get_user_chats(user1) == []
+
+    first = utils.save_message(chat_id, 'test1', 'раз')
+    utils.save_message(chat_id, 'test1', 'два')
+    chat = _chat_with(user2, 'test1')
+    assert (chat['last_message'], chat['unread_count']) == ('два', 2)
+    assert _chat_with(user1, 'test2')['unread_count'] == 0
+
+    utils.mark_message_as_read(first)
+    utils.mark_message_as_read(first)  # повторное прочтение не уменьшает счётчик ещё раз
+    assert _chat_with(user2, 'test1')['unread_count'] == 1
+    print("[OK] Сводка личного чата обновляется при отправке и прочтении")
+
+
+def test_group_summary_for_late_member_and_deletes():
+    user1, user2 = _user_ids()
+    group_id = utils.create_group('сводка', 'test1')
+    utils.add_user_to_group(group_id, user1)
+    assert _group(user1, 'сводка')['last_message'] is None
+
+    utils.save_group_message(group_id, 'test1', 'первое')
+    last = utils.save_group_message(group_id, 'test1', 'второе')
+    # Вступивший позже участник сразу видит последнее сообщение и непрочитанные
+    utils.add_user_to_group(group_id, user2)
+    group = _group(user2, 'сводка')
+    assert (group['last_message'], group['unread_count']) == ('второе', 2)
+
+    utils.delete_message(last)
+    group = _group(user2, 'сводка')
+    assert (group['last_message'], group['unread_count']) == ('первое', 1)
+    print("[OK] Сводка группы учитывает новых участников и удаление сообщений")
+
+
+def test_summary_matches_full_rebuild():
+    user1, user2 = _user_ids()
+    channel_id = utils.create_channel('сверка', 'test1')
+    utils.add_user_to_channel(channel_id, user2)
+    ids = [utils.save_channel_message(channel_id, 'test1', f'пост {i}') for i in range(4)]
+    utils.update_channel_message_read(ids[0])
+    utils.edit_message(ids[3], 'пост 3 (правка)')
+
+    query = "SELECT user_id, last_message, unread_count FROM conversation_summary ORDER BY user_id"
+    with utils.get_db_connection() as conn:
+        incremental = [tuple(r) for r in conn.execute(query).fetchall()]
+    utils.db_write(lambda conn: utils._rebuild_conversation_summary(conn, 'channel', channel_id))()
+    with utils.get_db_connection() as conn:
+        rebuilt = [tuple(r) for r in conn.execute(query).fetchall()]
+    assert incremental == rebuilt == [(user1, 'пост 3 (правка)', 0), (user2, 'пост 3 (правка)', 3)]
+    print("[OK] Инкрементальная сводка совпадает с полным пересчётом")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
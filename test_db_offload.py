@@ -0,0 +1,68 @@
+"""
+Тестирование выноса запросов к базе из цикла событий gevent
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+import db_offload
+
+# Monkey-patching необратим, поэтому проверка под gevent идёт в отдельном процессе
+GEVENT_SCRIPT = r"""
+from gevent import monkey; monkey.patch_all()
+import sys, time, gevent
+import utils, db_offload
+utils.DATABASE = sys.argv[1]
+utils.init_db()
+assert db_offload.enable_offload()
+user1 = utils.get_user_by_username('test1')['id']
+user2 = utils.get_user_by_username('test2')['id']
+chat_id = utils.get_or_create_chat(user1, user2)
+
+stalls = []
+def ticker():
+    last = time.monotonic()
+    for _ in range(200):
+        gevent.sleep(0.001)
+        now = time.monotonic()
+        stalls.append(now - last)
+        last = now
+
+def writer(i):
+    for j in range(10):
+        utils.save_message(chat_id, 'test1', f'{i}-{j}')
+
+# Долгий блокирующий вызов не должен останавливать остальные greenlet'ы
+jobs = [gevent.spawn(ticker), gevent.spawn(db_offload.run_blocking, time.sleep, 0.3)]
+jobs += [gevent.spawn(writer, i) for i in range(20)]
+gevent.joinall(jobs, timeout=60, raise_error=True)
+sys.stdout.write(f"RESULT {len(utils.get_messages(chat_id, limit=1000))} {max(stalls):.3f}\n")
+"""
+
+
+def test_run_blocking_is_direct_without_gevent():
+    assert not db_offload.gevent_patched()
+    assert db_offload.run_blocking(sorted, [3, 1, 2]) == [1, 2, 3]
+    assert db_offload.offload_stats() == {'enabled': False}
+    print("[OK] Без gevent функции вызываются напрямую")
+
+
+def test_gevent_hub_is_not_blocked_by_database():
+    pytest.importorskip('gevent')
+    database = os.path.join(tempfile.mkdtemp(), 'offload_test.db')
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-c', GEVENT_SCRIPT, database], cwd=here,
+                            capture_output=True, text=True, timeout=120)
+    line = next(l for l in result.stdout.splitlines() if l.startswith('RESULT'))
+    count, max_stall = line.split()[1:]
+    assert int(count) == 200
+    assert float(max_stall) < 0.2
+    print("[OK] Запросы к базе выполняются в пуле потоков, цикл событий не простаивает")
+
+
+if __name__ == "__main__":
+    test_run_blocking_is_direct_without_gevent()
+    test_gevent_hub_is_not_blocked_by_database()
@@ -0,0 +1,88 @@
+"""
+Тестирование пула соединений SQLite
+"""
+import os
+import tempfile
+import threading
+
+from db_pool import ConnectionPool, PoolTimeoutError
+
+
+def _make_pool(**kwargs):
+    path = os.path.join(tempfile.mkdtemp(), 'pool_test.db')
+    return ConnectionPool(path, **kwargs)
+
+
+def test_connection_is_reused():
+    pool = _make_pool(size=2)
+    with pool.connection() as conn1:
+        conn1.execute("CREATE TABLE t (x INTEGER)")
+        conn1.commit()
+    with pool.connection() as conn2:
+        assert conn2 is conn1
+        assert conn2.execute("SELECT 1 AS one").fetchone()['one'] == 1
+    assert pool.stats()['open'] == 1
+    print("[OK] Соединение переиспользуется и настроено (row_factory)")
+
+
+def test_nested_connection_same_thread():
+    pool = _make_pool(size=1)
+    with pool.connection() as outer:
+        with pool.connection() as inner:
+            assert inner is outer
+    assert pool.stats() == {'size': 1, 'open': 1, 'idle': 1}
+    print("[OK] Вложенный вызов не занимает второе соединение")
+
+
+def test_uncommitted_changes_are_rolled_back():
+    pool = _make_pool(size=1)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.commit()
+        conn.execute("INSERT INTO t VALUES (1)")
+    with pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    print("[OK] Незакоммиченные изменения откатываются при возврате в пул")
+
+
+def test_pool_timeout_when_exhausted():
+    pool = _make_pool(size=1, timeout=0.05)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with pool.connection():
+            holding.set()
+            release.wait()
+
+    worker = threading.Thread(target=hold)
+    worker.start()
+    holding.wait()
+    try:
+        with pool.connection():
+            assert False, "ожидался PoolTimeoutError"
+    except PoolTimeoutError:
+        pass
+    finally:
+        release.set()
+        worker.join()
+    print("[OK] Исчерпанный пул возвращает PoolTimeoutError")
+
+
+def test_broken_connection_replaced_by_health_check():
+    pool = _make_pool(size=1, health_check_interval=0)
+    with pool.connection() as conn:
+        pass
+    conn.close()
+    with pool.connection() as fresh:
+        assert fresh is not conn
+        assert fresh.execute("SELECT 1").fetchone()[0] == 1
+    print("[OK] Нерабочее соединение заменяется при проверке")
+
+
+if __name__ == "__main__":
+    test_connection_is_reused()
+    test_nested_connection_same_thread()
+    test_uncommitted_changes_are_rolled_back()
+    test_pool_timeout_when_exhausted()
+    test_broken_connection_replaced_by_health_check()
@@ -0,0 +1,100 @@
+"""
+Тестирование потока-писателя (group commit)
+"""
+import os
+import sqlite3
+import tempfile
+import time
+
+from db_writer import DatabaseWriter
+
+
+def _make_writer(**kwargs):
+    path = os.path.join(tempfile.mkdtemp(), 'writer_test.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, x INTEGER UNIQUE)")
+    return path, DatabaseWriter(path, **kwargs)
+
+
+def _insert(conn, x):
+    return conn.execute("INSERT INTO t (x) VALUES (?)", (x,)).lastrowid
+
+
+def test_batch_is_committed_together():
+    path, writer = _make_writer()
+    futures = [writer.submit(_insert, i) for i in range(50)]
+    ids = [f.result() for f in futures]
+    writer.stop()
+    assert ids == sorted(ids)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 50
+    assert writer.batches <= 50
+    print(f"[OK] 50 задач применено за {writer.batches} транзакций")
+
+
+def test_failed_job_does_not_break_batch():
+    path, writer = _make_writer()
+    first = writer.submit(_insert, 1)
+    duplicate = writer.submit(_insert, 1)
+    last = writer.submit(_insert, 2)
+    assert first.result() and last.result()
+    try:
+        duplicate.result()
+        assert False, "ожидалась ошибка UNIQUE"
+    except sqlite3.IntegrityError:
+        pass
+    writer.stop()
+    with sqlite3.connect(path) as conn:
+        assert [r[0] for r in conn.execute("SELECT x FROM t ORDER BY x")] == [1, 2]
+    print("[OK] Ошибка одной задачи откатывает только её изменения")
+
+
+def test_nested_run_inside_writer():
+    path, writer = _make_writer()
+
+    def outer(conn):
+        _insert(conn, 10)
+        return writer.run(_insert, 11)
+
+    assert writer.run(outer)
+    writer.stop()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 2
+    print("[OK] Вложенная задача выполняется в транзакции внешней")
+
+
+def test_after_commit_skipped_for_failed_job():
+    path, writer = _make_writer()
+    fired = []
+
+    def insert_with_callback(conn, x):
+        writer.after_commit(lambda: fired.append(x))
+        return _insert(conn, x)
+
+    writer.run(insert_with_callback, 1)
+    try:
+        writer.run(insert_with_callback, 1)
+    except sqlite3.IntegrityError:
+        pass
+    writer.stop()
+    assert fired == [1]
+    print("[OK] after_commit вызывается только для зафиксированных задач")
+
+
+def test_linger_collects_late_jobs_into_batch():
+    path, writer = _make_writer(linger_ms=200)
+    first = writer.submit(_insert, 1)
+    time.sleep(0.02)  # вторая задача приходит, когда писатель уже взял первую
+    second = writer.submit(_insert, 2)
+    assert first.result() and second.result()
+    writer.stop()
+    assert (writer.batches, writer.jobs) == (1, 2)
+    print("[OK] Задачи, пришедшие в окне ожидания, попадают в ту же транзакцию")
+
+
+if __name__ == "__main__":
+    test_batch_is_committed_together()
+    test_failed_job_does_not_break_batch()
+    test_nested_run_inside_writer()
+    test_after_commit_skipped_for_failed_job()
+    test_linger_collects_late_jobs_into_batch()
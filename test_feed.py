@@ -0,0 +1,187 @@
+"""
+Тестирование пакетного дополнения страницы ленты
+"""
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+import utils
+
+
+def _make_feed():
+    user1 = utils.get_user_by_username('test1')['id']
+    user2 = utils.get_user_by_username('test2')['id']
+    utils.set_user_avatar(user2, 'test2.png')
+    utils.follow_user(user1, user2)
+    posts = [utils.create_post(user2, f'пост {i}') for i in range(4)]
+    for i in range(5):
+        utils.add_comment(user1 if i % 2 else user2, posts[0], f'комментарий {i}')
+    utils.add_reply(user1, posts[0], 1, 'ответ')
+    utils.like_post(user1, posts[1])
+    utils.repost(user1, posts[2])
+    utils.add_reaction(user1, posts[3], '🔥')
+    utils.add_reaction(user2, posts[3], '🔥')
+    utils.add_reaction(user2, posts[0], '👍')
+    return user1, posts
+
+
+def test_feed_matches_per_post_lookups():
+    user1, posts = _make_feed()
+    feed = utils.get_feed(user1)
+    assert sorted(p['id'] for p in feed) == sorted(posts)
+    for post in feed:
+        reactions = {}
+        for r in utils.get_reactions_for_post(post['id']):
+            reactions.setdefault(r['emoji'], []).append({'username': r['username'], 'user_id': r['user_id']})
+        assert post['avatar'] == 'test2.png'
+        assert post['comments'] == utils.get_comments_for_post(post['id'])[:3]
+        assert post['reactions'] == reactions
+        assert post['is_liked'] == utils.is_liked(user1, post['id'])
+        assert post['is_reposted'] == utils.is_reposted(user1, post['id'])
+        assert post['is_reacted'] == utils.is_reacted(user1, post['id'])
+    print("[OK] Пакетное дополнение ленты совпадает с запросами по каждому посту")
+
+
+def _feed_statements(user_id, limit):
+    # SQL-операторы, выполненные при загрузке одной страницы ленты
+    statements = []
+    connection = utils.get_db_connection
+
+    @contextmanager
+    def traced():
+        with connection() as conn:
+            conn.set_trace_callback(statements.append)
+            try:
+                yield conn
+            finally:
+                conn.set_trace_callback(None)
+    utils.get_db_connection = traced
+    try:
+        assert len(utils.get_feed(user_id, limit=limit)) == limit
+    finally:
+        utils.get_db_connection = connection
+    return statements
+
+
+def test_feed_query_count_does_not_depend_on_page_size():
+    user1, posts = _make_feed()
+    assert len(_feed_statements(user1, 4)) == len(_feed_statements(user1, 1))
+    print("[OK] Страница ленты дополняется фиксированным числом запросов")
+
+
+def _feed_ids_by_scan(user_id):
+    # Прежний запрос ленты: подписки через OR и сортировка всех подходящих постов
+    with utils.get_db_connection() as conn:
+        return [row['id'] for row in conn.execute("""
+            SELECT p.id FROM posts p
+            WHERE p.user_id IN (SELECT following_id FROM subscriptions WHERE follower_id = ?) OR p.user_id = ?
+            ORDER BY p.created_at DESC, p.id DESC
+        """, (user_id, user_id)).fetchall()]
+
+
+def test_timeline_follows_subscriptions():
+    user1, posts = _make_feed()
+    user2 = utils.get_user_by_username('test2')['id']
+    utils.create_user('test3', 'pass3')
+    user3 = utils.get_user_by_username('test3')['id']
+    own = utils.create_post(user1, 'свой пост')
+    later = utils.create_post(user3, 'до подписки')
+    utils.follow_user(user1, user3)  # старые посты переносятся в ленту
+    assert [p['id'] for p in utils.get_feed(user1, limit=100)] == _feed_ids_by_scan(user1)
+    assert later in [p['id'] for p in utils.get_feed(user1, limit=100)]
+
+    utils.delete_post(posts[1], user2)
+    utils.unfollow_user(user1, user2)
+    ids = [p['id'] for p in utils.get_feed(user1, limit=100)]
+    assert ids == _feed_ids_by_scan(user1) and own in ids and posts[0] not in ids
+    assert [p['id'] for p in utils.get_feed(user1, offset=1, limit=1)] == ids[1:2]
+
+    with utils.get_db_connection() as conn:
+        plan = ' '.join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT post_id FROM timeline WHERE user_id = ? "
+            "ORDER BY created_at DESC, post_id DESC LIMIT 10", (user1,)).fetchall())
+    assert 'idx_timeline_user_time' in plan and 'TEMP B-TREE' not in plan
+    print("[OK] Лента из timeline совпадает с подписками и читается по индексу")
+
+
+def test_large_accounts_are_merged_on_read():
+    user1, posts = _make_feed()
+    user2 = utils.get_user_by_username('test2')['id']
+    limit = utils.TIMELINE_FANOUT_LIMIT
+    utils.TIMELINE_FANOUT_LIMIT = 0
+    try:
+        utils.create_user('test3', 'pass3')
+        user3 = utils.get_user_by_username('test3')['id']
+        utils.follow_user(user1, user3)  # test3 становится «большим» автором
+        big = utils.create_post(user3, 'пост большого автора')
+        utils.follow_user(user3, user2)  # test2 тоже становится большим: его посты уже разосланы
+        with utils.get_db_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM timeline WHERE post_id = ?", (big,)).fetchone()[0] == 1
+        ids = [p['id'] for p in utils.get_feed(user1, limit=100)]
+        assert ids == _feed_ids_by_scan(user1) and big in ids and len(ids) == len(set(ids))
+        utils.unfollow_user(user1, user3)
+        assert big not in [p['id'] for p in utils.get_feed(user1, limit=100)]
+        assert utils.get_feed(user2, limit=100)[0]['id'] == posts[-1]
+    finally:
+        utils.TIMELINE_FANOUT_LIMIT = limit
+    print("[OK] Посты больших авторов подмешиваются при чтении без повторов")
+
+
+def _counters(post_id):
+    with utils.get_db_connection() as conn:
+        return tuple(conn.execute("SELECT likes_count, comments_count, reposts_count FROM posts WHERE id = ?",
+                                  (post_id,)).fetchone())
+
+
+def test_engagement_counters_and_reconcile():
+    user1, posts = _make_feed()
+    user2 = utils.get_user_by_username('test2')['id']
+    assert _counters(posts[0]) == (0, 6, 0)
+    utils.like_post(user1, posts[0])
+    utils.like_post(user1, posts[0])  # повторный лайк не считается
+    utils.like_post(user2, posts[0])
+    utils.repost(user2, posts[0])
+    utils.unlike_post(user2, posts[0])
+    utils.unlike_post(user2, posts[0])
+    assert _counters(posts[0]) == (1, 6, 1)
+    assert utils.get_top_posts(user2, limit=1)[0]['id'] in (posts[0], posts[1])
+
+    # Расхождение после записи в обход utils исправляется сверкой
+    with utils.get_db_connection() as conn:
+        conn.execute("UPDATE posts SET likes_count = 42, reposts_count = 0 WHERE id = ?", (posts[0],))
+        conn.execute("DELETE FROM comments WHERE post_id = ?", (posts[0],))
+        conn.commit()
+    assert utils.reconcile_post_counters(0, limit=2) == (1, posts[1])
+    assert utils.reconcile_post_counters(posts[1]) == (0, posts[-1])
+    assert utils.reconcile_post_counters(posts[-1]) == (0, None)
+    assert _counters(posts[0]) == (1, 0, 1)
+    feed = {p['id']: p for p in utils.get_feed(user1)}
+    assert (feed[posts[0]]['likes_count'], feed[posts[0]]['comments_count']) == (1, 0)
+    print("[OK] Счётчики постов обновляются при записи и исправляются сверкой")
+
+
+def test_post_image_is_removed_only_after_commit(tmp_path, monkeypatch):
+    user1 = utils.get_user_by_username('test1')['id']
+    image = tmp_path / 'uploads' / 'post.png'
+    image.parent.mkdir()
+    image.write_bytes(b'png')
+    monkeypatch.setattr(utils, 'UPLOADS_DIR', str(image.parent))
+    post_id = utils.create_post(user1, 'с картинкой', 'post.png')
+
+    def fail(conn, post_id):
+        raise RuntimeError("сбой записи")
+    with monkeypatch.context() as patch:
+        patch.setattr(utils, '_invalidate_post_readers', fail)
+        with pytest.raises(RuntimeError):
+            utils.delete_post(post_id, user1)
+    assert image.exists()  # транзакция откатилась - картинка на месте
+
+    utils.delete_post(post_id, user1)
+    assert not image.exists()
+    print("[OK] Картинка поста удаляется только после фиксации удаления")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,106 @@
+"""
+Тестирование кэша ленты в Redis (fakeredis)
+"""
+import sys
+
+import pytest
+
+import redis_config
+import utils
+from redis_config import FeedCache
+from test_feed import _make_feed
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def _install_cache(client=None):
+    client = client or fakeredis.FakeRedis(decode_responses=True)
+    # Сброс только по счётчикам поколений, без поиска ключей по шаблону
+    client.keys = client.scan = lambda *args, **kwargs: pytest.fail("поиск ключей по шаблону")
+    cache = redis_config.feed_cache = FeedCache(client)
+    return cache
+
+
+def _ids(user_id, **kwargs):
+    return [p['id'] for p in utils.get_feed_cached(user_id, **kwargs)]
+
+
+def test_cached_feed_matches_database_and_is_invalidated():
+    user1, posts = _make_feed()
+    user2 = utils.get_user_by_username('test2')['id']
+    cache = _install_cache()
+    try:
+        assert utils.get_feed_cached(user1) == utils.get_feed(user1)
+        assert utils.get_feed_cached(user1) == utils.get_feed(user1)
+        stats = cache.stats()
+        assert (stats['page_hits'], stats['page_misses'], stats['post_hits'], stats['post_misses']) == (1, 1, 4, 4)
+        assert stats['page_hit_rate'] == 0.5
+
+        # Общие данные поста одни на всех, отметки зрителя - свои у каждого
+        assert utils.get_feed_cached(user2) == utils.get_feed(user2)
+        assert cache.stats()['post_misses'] == 4
+        liked = {p['id']: p['is_liked'] for p in utils.get_feed_cached(user2)}
+        assert liked[posts[1]] is False and {p['id']: p['is_liked'] for p in utils.get_feed_cached(user1)}[posts[1]]
+
+        new = utils.create_post(user2, 'новый пост')
+        assert _ids(user1)[0] == new
+        utils.edit_post(posts[0], user2, content='правка')
+        utils.like_post(user2, posts[0])
+        utils.add_comment(user2, posts[0], 'ещё комментарий')
+        post = {p['id']: p for p in utils.get_feed_cached(user1)}[posts[0]]
+        assert (post['content'], post['likes_count'], post['comments_count']) == ('правка', 1, 7)
+        assert utils.get_feed_cached(user1) == utils.get_feed(user1)
+
+        utils.delete_post(new, user2)
+        assert new not in _ids(user1)
+        utils.unfollow_user(user1, user2)
+        assert _ids(user1) == []
+        utils.follow_user(user1, user2)
+        assert utils.get_feed_cached(user1, offset=1, limit=2) == utils.get_feed(user1, offset=1, limit=2)
+    finally:
+        redis_config.feed_cache = None
+    print("[OK] Лента из кэша совпадает с базой и сбрасывается записями")
+
+
+def test_large_author_posts_reach_cached_pages():
+    user1, posts = _make_feed()
+    limit = utils.TIMELINE_FANOUT_LIMIT
+    utils.TIMELINE_FANOUT_LIMIT = 0
+    _install_cache()
+    try:
+        utils.create_user('test3', 'pass3')
+        user3 = utils.get_user_by_username('test3')['id']
+        utils.follow_user(user1, user3)  # test3 становится «большим» автором
+        assert _ids(user1) == _ids(user1)
+        big = utils.create_post(user3, 'пост большого автора')
+        assert _ids(user1)[0] == big
+    finally:
+        utils.TIMELINE_FANOUT_LIMIT = limit
+        redis_config.feed_cache = None
+    print("[OK] Новый пост большого автора попадает в закэшированную ленту подписчика")
+
+
+def test_unavailable_redis_falls_back_to_database():
+    user1, posts = _make_feed()
+    user2 = utils.get_user_by_username('test2')['id']
+    server = fakeredis.FakeServer()
+    cache = _install_cache(fakeredis.FakeRedis(server=server, decode_responses=True))
+    try:
+        utils.get_feed_cached(user1)
+        server.connected = False
+        new = utils.create_post(user2, 'пока Redis недоступен')
+        assert _ids(user1)[0] == new
+        assert cache.stats()['errors'] == 1 and cache.stats()['pending'] == 1
+
+        # После восстановления отложенные сбросы отправляются до чтения
+        server.connected = True
+        cache._down_until = 0  # пауза после ошибки истекла
+        assert _ids(user1)[0] == new and cache.stats()['pending'] == 0
+    finally:
+        redis_config.feed_cache = None
+    print("[OK] Без Redis лента читается из базы, сбросы дожидаются восстановления")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,134 @@
+"""
+Тестирование буфера последних сообщений истории
+"""
+import sys
+
+import pytest
+
+import history_buffer
+import utils
+from history_buffer import HistoryBuffer
+
+
+def _rows(ids):
+    return [{'id': i, 'sender': 'test1', 'message': f'сообщение {i}'} for i in ids]
+
+
+def test_pages_are_served_only_when_covered():
+    buffer = HistoryBuffer(capacity=5)
+    key = ('group', 1)
+    assert buffer.fill(key, _rows(range(1, 4)), True, buffer.generation(key))
+    # Вся беседа в буфере - любая страница из памяти
+    assert [r['id'] for r in buffer.get_page(key, offset=1, limit=10)] == [2, 3]
+    assert [r['id'] for r in buffer.get_page(key, before_id=3, limit=10)] == [1, 2]
+
+    for i in range(4, 9):
+        buffer.append(key, _rows([i])[0])
+    # Старые сообщения вытеснены: без курсора и глубоко назад - в базу
+    assert buffer.get_page(key, offset=0, limit=2) is None
+    assert buffer.get_page(key, before_id=6, limit=5) is None
+    assert [r['id'] for r in buffer.get_page(key, after_id=5, limit=2)] == [6, 7]
+    assert [r['id'] for r in buffer.get_page(key, before_id=9, limit=3)] == [6, 7, 8]
+    assert buffer.get_page(key, after_id=2, limit=2) is None
+    print("[OK] Из памяти отдаются только страницы, целиком покрытые буфером")
+
+
+def test_stale_fill_is_rejected_and_cold_rooms_evicted():
+    buffer = HistoryBuffer(capacity=10, max_bytes=3000)
+    generation = buffer.generation(('dm', 1))
+    buffer.append(('dm', 1), _rows([1])[0])  # изменение между снимком и загрузкой
+    assert not buffer.fill(('dm', 1), [], True, generation)
+
+    for ref_id in range(1, 4):
+        key = ('dm', ref_id)
+        buffer.fill(key, _rows(range(1, 4)), True, buffer.generation(key))
+    # Три беседы не помещаются в бюджет - вытесняется самая давняя
+    assert not buffer.cached(('dm', 1)) and buffer.cached(('dm', 3))
+    assert buffer.stats()['bytes'] <= 3000
+    print("[OK] Устаревшая загрузка отбрасывается, холодные беседы вытесняются")
+
+
+def test_generation_counters_are_bounded(monkeypatch):
+    monkeypatch.setattr(history_buffer, '_MAX_GENERATIONS', 3)
+    buffer = HistoryBuffer(capacity=5)
+    generation = buffer.generation(('dm', 1))
+    for ref_id in range(2, 10):
+        buffer.invalidate(('dm', ref_id))
+    assert len(buffer._generations) <= 3
+    # Сброс счётчиков меняет эпоху: загрузка, начатая до него, не попадает в буфер
+    assert not buffer.fill(('dm', 1), _rows([1]), True, generation)
+    print("[OK] Счётчики поколений не копятся бесконечно")
+
+
+def test_cold_history_page_costs_one_query(monkeypatch):
+    monkeypatch.setattr(utils, 'history_buffer', HistoryBuffer(capacity=3))
+    history_queries = []
+    history_select = utils._history_select
+    monkeypatch.setattr(utils, '_history_select', lambda kind: history_queries.append(kind) or history_select(kind))
+    group_id = utils.create_group('холодная', 'test1')
+    small_id = utils.create_group('маленькая', 'test1')
+    ids = [utils.save_group_message(group_id, 'test1', f'пост {i}') for i in range(5)]
+    utils.save_group_message(small_id, 'test1', 'один')
+    utils.history_buffer.clear()
+
+    # Беседа помещается в буфер: первая страница ложится в него тем же запросом
+    assert [m['message'] for m in utils.get_group_messages(small_id)] == ['один']
+    assert utils.history_buffer.cached(('group', small_id))
+    # Большая беседа: начало отдаётся одним запросом, в буфер не попадает
+    assert [m['id'] for m in utils.get_group_messages(group_id, limit=2)] == ids[:2]
+    assert not utils.history_buffer.cached(('group', group_id))
+    # Курсор у конца беседы: загрузка последних сообщений сразу отдаёт страницу
+    assert [m['id'] for m in utils.get_group_messages(group_id, after_id=ids[2])] == ids[3:]
+    assert len(history_queries) == 3
+    assert [m['id'] for m in utils.get_group_messages(group_id, after_id=ids[2])] == ids[3:]
+    assert len(history_queries) == 3
+    print("[OK] Холодная беседа читается одним запросом")
+
+
+def test_disabled_buffer_keeps_nothing():
+    # Несколько воркеров: буфер выключен, каждая страница читается из базы
+    buffer = HistoryBuffer(capacity=0)
+    key = ('group', 1)
+    assert not buffer.fill(key, _rows([1, 2]), True, buffer.generation(key))
+    buffer.append(key, _rows([3])[0])
+    assert not buffer.cached(key) and buffer.get_page(key) is None
+    print("[OK] Выключенный буфер ничего не хранит")
+
+
+def test_buffered_history_matches_database():
+    user1 = utils.get_user_by_username('test1')['id']
+    user2 = utils.get_user_by_username('test2')['id']
+    chat_id = utils.get_or_create_chat(user1, user2)
+    group_id = utils.create_group('буфер', 'test1')
+    utils.add_user_to_group(group_id, user1)
+    utils.add_user_to_group(group_id, user2)
+
+    first = utils.save_message(chat_id, 'test1', 'раз')
+    utils.get_messages(chat_id)  # буфер загружен
+    utils.get_group_messages(group_id)
+    reply = utils.save_message(chat_id, 'test2', 'ответ', parent_message_id=first)
+    utils.mark_message_as_delivered(reply)
+    utils.save_message(chat_id, 'test1', 'три')
+    utils.mark_conversation_read('dm', chat_id, 'test2', up_to_id=first)
+    utils.edit_message(first, 'раз (правка)')
+    ids = [utils.save_group_message(group_id, 'test1', f'пост {i}') for i in range(3)]
+    utils.save_group_message(group_id, 'test2', 'ответ', parent_message_id=ids[1])
+    utils.mark_conversation_read('group', group_id, 'test2', up_to_id=ids[0])
+    utils.delete_message(ids[1])
+    utils.set_user_avatar(user1, 'avatar.png')
+
+    hits = utils.history_buffer.stats()['hits']
+    buffered = (utils.get_messages(chat_id), utils.get_group_messages(group_id))
+    assert utils.history_buffer.stats()['hits'] == hits + 2
+
+    utils.history_buffer.clear()
+    assert buffered == (utils.get_messages(chat_id), utils.get_group_messages(group_id))
+    assert [m['status'] for m in buffered[0]] == ['read', 'delivered', 'sent']
+    assert buffered[0][1]['parent_message'] == 'раз (правка)'
+    assert buffered[1][-1]['parent_message'] is None
+    print("[OK] История из буфера совпадает с историей из базы")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
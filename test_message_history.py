@@ -0,0 +1,94 @@
+"""
+Тестирование курсорной пагинации истории сообщений
+"""
+import sys
+
+import pytest
+
+import utils
+
+
+def _make_chat(count):
+    user1 = utils.get_user_by_username('test1')
+    user2 = utils.get_user_by_username('test2')
+    chat_id = utils.get_or_create_chat(user1['id'], user2['id'])
+    ids = [utils.save_message(chat_id, 'test1', f'сообщение {i}') for i in range(count)]
+    return chat_id, ids
+
+
+def test_before_id_walks_history_backwards():
+    chat_id, ids = _make_chat(7)
+    page = utils.get_messages(chat_id, limit=3, before_id=ids[-1] + 1)
+    assert [m['id'] for m in page] == ids[4:7]
+    cursor = utils.next_history_cursor(page, 3, before_id=ids[-1] + 1)
+    assert cursor == ids[4]
+
+    page = utils.get_messages(chat_id, limit=3, before_id=cursor)
+    assert [m['id'] for m in page] == ids[1:4]
+    page = utils.get_messages(chat_id, limit=3, before_id=ids[1])
+    assert [m['id'] for m in page] == ids[:1]
+    assert utils.next_history_cursor(page, 3, before_id=ids[1]) is None
+    print("[OK] before_id листает историю назад без пропусков")
+
+
+def test_after_id_is_stable_when_new_messages_arrive():
+    chat_id, ids = _make_chat(4)
+    first = utils.get_messages(chat_id, limit=2)
+    cursor = utils.next_history_cursor(first, 2)
+    # Новое сообщение не сдвигает следующую страницу, как это было с OFFSET
+    ids.append(utils.save_message(chat_id, 'test2', 'новое'))
+    page = utils.get_messages(chat_id, limit=2, after_id=cursor)
+    assert [m['id'] for m in page] == ids[2:4]
+    print("[OK] after_id не сдвигается при появлении новых сообщений")
+
+
+def test_cursor_does_not_cross_conversations():
+    chat_id, ids = _make_chat(2)
+    group_id = utils.create_group('история', 'test1')
+    utils.save_group_message(group_id, 'test1', 'в группе')
+    assert [m['id'] for m in utils.get_messages(chat_id, after_id=0)] == ids
+    assert len(utils.get_group_messages(group_id, before_id=10 ** 9)) == 1
+    print("[OK] Курсор ограничен одной беседой")
+
+
+def test_edit_and_delete_own_message_beyond_first_page():
+    chat_id, ids = _make_chat(60)
+    group_id = utils.create_group('правки', 'test1')
+    old = ids[-1]  # не попадает в первую страницу истории (50 самых старых)
+    assert old not in [m['id'] for m in utils.get_messages(chat_id)]
+
+    # Чужое сообщение и сообщение из другой беседы не меняются
+    assert not utils.edit_own_message(old, 'test2', 'чужая правка', 'dm', chat_id)
+    assert not utils.edit_own_message(old, 'test1', 'не та беседа', 'group', group_id)
+    assert utils.edit_own_message(old, 'test1', 'правка', 'dm', chat_id)
+    assert utils.get_conversation_message(old, 'dm', chat_id)['message'] == 'правка'
+    assert utils.get_conversation_message(old, 'group', group_id) is None
+
+    assert not utils.delete_own_message(old, 'test2', 'dm', chat_id)
+    assert utils.delete_own_message(old, 'test1', 'dm', chat_id)
+    assert not utils.delete_own_message(old, 'test1', 'dm', chat_id)
+    assert utils.get_conversation_message(old, 'dm', chat_id) is None
+    print("[OK] Своё сообщение правится и удаляется по id, в том числе вне первой страницы")
+
+
+def test_global_search_covers_member_conversations_only():
+    chat_id, ids = _make_chat(3)
+    user1 = utils.get_user_by_username('test1')['id']
+    group_id = utils.create_group('поиск', 'test1')
+    utils.add_user_to_group(group_id, user1)
+    utils.save_group_message(group_id, 'test1', 'сообщение в группе')
+    channel_id = utils.create_channel('поиск', 'test2')
+    utils.save_channel_message(channel_id, 'test2', 'сообщение в чужом канале')
+
+    results = utils.search_messages_global('сообщение', user1, limit=2)
+    assert [m['message_type'] for m in results] == ['group', 'private']
+    assert results[1]['chat_partner'] == 'test2' and results[0]['group_name'] == 'поиск'
+    # Пагинация в SQL: страницы не пересекаются, чужой канал не найден
+    rest = utils.search_messages_global('сообщение', user1, limit=10, offset=2)
+    assert [m['id'] for m in rest] == ids[-2::-1]
+    print("[OK] Глобальный поиск - один запрос по беседам пользователя с пагинацией")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
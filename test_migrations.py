@@ -0,0 +1,96 @@
+"""
+Тестирование версионированных миграций схемы
+"""
+import os
+import sqlite3
+import tempfile
+
+import migrations
+from migrations import migrate, latest_version
+
+
+def _db_path():
+    return os.path.join(tempfile.mkdtemp(), 'migrations_test.db')
+
+
+def test_fresh_database_gets_latest_version():
+    path = _db_path()
+    applied = migrate(path)
+    assert applied == sorted(applied) and applied[-1] == latest_version()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == latest_version()
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE username = 'test1'").fetchone()[0] == 1
+    print(f"[OK] Новая база мигрирована до версии {latest_version()}")
+
+
+def test_second_run_applies_nothing():
+    path = _db_path()
+    migrate(path)
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE users SET username = 'MixedCase' WHERE username = 'test1'")
+    assert migrate(path) == []
+    with sqlite3.connect(path) as conn:
+        # Полная перезапись users (LOWER) больше не выполняется при старте
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE username = 'MixedCase'").fetchone()[0] == 1
+    print("[OK] Повторный запуск не выполняет миграции")
+
+
+def test_failed_migration_is_rolled_back():
+    path = _db_path()
+    migrate(path)
+    version = latest_version() + 1
+
+    def broken(conn):
+        conn.execute("CREATE TABLE should_not_exist (id INTEGER)")
+        raise RuntimeError("сбой миграции")
+
+    migrations.MIGRATIONS.append((version, "сломанная миграция", broken))
+    try:
+        migrate(path)
+        assert False, "ожидалась ошибка"
+    except RuntimeError:
+        pass
+    finally:
+        migrations.MIGRATIONS.pop()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == version - 1
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'should_not_exist'").fetchone() is None
+    print("[OK] Неудачная миграция откатывается целиком")
+
+
+def test_legacy_messages_moved_to_conversations():
+    path = _db_path()
+    full = list(migrations.MIGRATIONS)
+    migrations.MIGRATIONS[:] = [m for m in full if m[0] < 3]
+    try:
+        migrate(path)
+    finally:
+        migrations.MIGRATIONS[:] = full
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO chats (id, user1_id, user2_id) VALUES (7, 1, 2)")
+        conn.execute("INSERT INTO messages (id, chat_id, sender, message, status) VALUES (40, 7, 'test1', 'привет', 'read')")
+        conn.execute("INSERT INTO messages (id, chat_id, sender, message, parent_message_id) VALUES (41, 7, 'test2', 'ответ', 40)")
+        conn.execute("INSERT INTO groups (id, name, creator) VALUES (3, 'g', 'test1')")
+        conn.execute("INSERT INTO group_messages (id, group_id, sender, message) VALUES (40, 3, 'test1', 'в группе')")
+        conn.execute("UPDATE groups SET pinned_msg_id = 40 WHERE id = 3")
+    migrate(path)
+    with sqlite3.connect(path) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("""
+            SELECT c.kind, c.ref_id, m.id, m.seq, m.message, m.status, m.is_read, m.parent_message_id
+            FROM conversation_messages m JOIN conversations c ON m.conversation_id = c.id
+            ORDER BY m.id
+        """).fetchall()
+        assert [(r['kind'], r['ref_id'], r['seq']) for r in rows] == [('dm', 7, 1), ('dm', 7, 2), ('group', 3, 1)]
+        assert rows[0]['status'] == 'read' and rows[0]['is_read'] == 1
+        assert rows[1]['parent_message_id'] == rows[0]['id']
+        assert conn.execute("SELECT pinned_msg_id FROM groups WHERE id = 3").fetchone()[0] == rows[2]['id']
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'group_messages'").fetchone() is None
+    print("[OK] Старые сообщения перенесены в единое хранилище")
+
+
+if __name__ == "__main__":
+    test_fresh_database_gets_latest_version()
+    test_second_run_applies_nothing()
+    test_failed_migration_is_rolled_back()
+    test_legacy_messages_moved_to_conversations()
@@ -0,0 +1,73 @@
+"""
+Тестирование реестра присутствия (память процесса и общий Redis)
+"""
+import pytest
+
+from presence import LocalPresence, RedisPresence
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def _stores():
+    server = fakeredis.FakeServer()
+    return [
+        (LocalPresence(shards=4, ttl=60), None),
+        # Два воркера с общим Redis: второй видит то, что записал первый
+        (RedisPresence(fakeredis.FakeRedis(server=server), ttl=60),
+         RedisPresence(fakeredis.FakeRedis(server=server), ttl=60)),
+    ]
+
+
+@pytest.mark.parametrize('store, other', _stores(), ids=['local', 'redis'])
+def test_multiple_devices(store, other):
+    other = other or store
+    assert store.connect('test1', 'phone', now=100)
+    assert not other.connect('test1', 'laptop', now=100)  # уже онлайн
+    assert other.sids_for('test1', now=100) == {'phone', 'laptop'}
+
+    # У каждого устройства свой открытый чат
+    assert store.set_context('test1', 'phone', 'group_g1') is None
+    other.set_context('test1', 'laptop', 'test1_test2')
+    assert other.viewers_of('group_g1') == {'test1'} and store.viewers_of('test1_test2') == {'test1'}
+    assert store.set_context('test1', 'phone', 'test1_test2') == 'group_g1'
+    assert other.viewers_of('group_g1') == set()
+
+    # Закрытие одной вкладки не уводит пользователя в оффлайн
+    assert not other.disconnect('test1', 'laptop')
+    assert store.is_online('test1', now=100) and store.viewers_of('test1_test2') == {'test1'}
+    assert store.disconnect('test1', 'phone')
+    assert not other.is_online('test1', now=100) and other.viewers_of('test1_test2') == set()
+    assert store.online_count() == 0
+    print("[OK] Несколько устройств одного пользователя учитываются отдельно")
+
+
+@pytest.mark.parametrize('store, other', _stores(), ids=['local', 'redis'])
+def test_heartbeat_expiry(store, other):
+    other = other or store
+    store.connect('test1', 'sid-1', now=100)
+    store.connect('test2', 'sid-2', now=100)
+    store.set_context('test1', 'sid-1', 'group_g1')
+    assert other.heartbeat('test2', 'sid-2', now=150) == (False, False)
+
+    # Сокет без heartbeat истекает, даже если disconnect так и не пришёл
+    assert not store.is_online('test1', now=170)
+    assert other.expire_stale(now=170) == ['test1']
+    assert store.viewers_of('group_g1') == set()
+    assert store.is_online('test2', now=170)
+    # Запоздалое отключение уже убранного сокета ничего не ломает
+    assert not store.disconnect('test1', 'sid-1')
+    # Запоздалый heartbeat возвращает сокет в онлайн, но без чата: клиента просят прислать его заново
+    assert other.heartbeat('test1', 'sid-1', now=175) == (True, True)
+    assert store.viewers_of('group_g1') == set()
+    assert store.disconnect('test1', 'sid-1')
+    # Выход из аккаунта убирает все сокеты пользователя
+    assert other.disconnect('test2')
+    assert store.online_count() == 0
+    print("[OK] Сокеты без heartbeat убираются из онлайна")
+
+
+if __name__ == "__main__":
+    for store, other in _stores():
+        test_multiple_devices(store, other)
+    for store, other in _stores():
+        test_heartbeat_expiry(store, other)
@@ -0,0 +1,113 @@
+"""
+Тестирование пакетной отметки прочтения
+"""
+import sys
+
+import pytest
+
+import utils
+
+
+def _user_ids():
+    return utils.get_user_by_username('test1')['id'], utils.get_user_by_username('test2')['id']
+
+
+def _unread(user_id, name):
+    return next(g for g in utils.get_groups_for_user(user_id) if g['name'] == name)['unread_count']
+
+
+def test_mark_read_up_to_high_water_mark():
+    user1, user2 = _user_ids()
+    group_id = utils.create_group('пачка', 'test1')
+    utils.add_user_to_group(group_id, user1)
+    utils.add_user_to_group(group_id, user2)
+    ids = [utils.save_group_message(group_id, 'test1', f'сообщение {i}') for i in range(5)]
+    own = utils.save_group_message(group_id, 'test2', 'своё')
+
+    result = utils.mark_conversation_read('group', group_id, 'test2', up_to_id=ids[2])
+    assert result == {'from_id': ids[0], 'up_to_id': ids[2], 'count': 3}
+    assert _unread(user2, 'пачка') == 2
+    # Своё сообщение автора не считается непрочитанным для него и не отмечается им
+    assert _unread(user1, 'пачка') == 1
+
+    result = utils.mark_conversation_read('group', group_id, 'test2')
+    assert result == {'from_id': ids[3], 'up_to_id': own, 'count': 2}
+    assert _unread(user2, 'пачка') == 0
+    assert utils.mark_conversation_read('group', group_id, 'test2') is None
+    print("[OK] Прочтение до верхней границы отмечается одной операцией")
+
+
+def test_bulk_read_is_single_change_log_entry():
+    user1, user2 = _user_ids()
+    chat_id = utils.get_or_create_chat(user1, user2)
+    for i in range(10):
+        utils.save_message(chat_id, 'test1', f'сообщение {i}')
+    token = utils.get_sync_token()
+
+    utils.mark_conversation_read('dm', chat_id, 'test2')
+    changes = utils.get_changes_since(user1, token)['changes']
+    assert [(c['kind'], c['payload']['count']) for c in changes] == [('read', 10)]
+    assert all(m['status'] == 'read' for m in utils.get_messages(chat_id))
+    print("[OK] Пакетное прочтение - одна запись в журнале изменений")
+
+
+def test_read_cursor_is_per_user():
+    user1, user2 = _user_ids()
+    utils.create_user('test3', 'pass3')
+    user3 = utils.get_user_by_username('test3')['id']
+    group_id = utils.create_group('курсоры', 'test1')
+    for user_id in (user1, user2, user3):
+        utils.add_user_to_group(group_id, user_id)
+    ids = [utils.save_group_message(group_id, 'test1', f'сообщение {i}') for i in range(3)]
+
+    utils.mark_conversation_read('group', group_id, 'test2', up_to_id=ids[1])
+    # Прочтение одним участником не отмечает сообщения прочитанными для другого
+    assert _unread(user2, 'курсоры') == 1
+    assert _unread(user3, 'курсоры') == 3
+    assert utils.get_read_cursor(user2, 'group', group_id) == ids[1]
+    assert utils.get_read_cursor(user3, 'group', group_id) == 0
+    # Для автора сообщение считается прочитанным, если его прочитал кто-то из участников
+    assert [m['is_read'] for m in utils.get_group_messages(group_id)] == [1, 1, 0]
+
+    # Курсор не сдвигается назад
+    assert utils.mark_conversation_read('group', group_id, 'test2', up_to_id=ids[0]) is None
+    assert utils.get_read_cursor(user2, 'group', group_id) == ids[1]
+    print("[OK] Курсоры прочтения независимы для каждого участника")
+
+
+def test_dm_status_derived_from_cursor():
+    user1, user2 = _user_ids()
+    chat_id = utils.get_or_create_chat(user1, user2)
+    first = utils.save_message(chat_id, 'test1', 'раз')
+    utils.mark_message_as_delivered(first)
+    second = utils.save_message(chat_id, 'test1', 'два')
+    assert [m['status'] for m in utils.get_messages(chat_id)] == ['delivered', 'sent']
+    assert [m['id'] for m in utils.get_unread_messages('test2', 'test1')] == [first, second]
+
+    utils.mark_message_as_read(first)
+    assert [m['status'] for m in utils.get_messages(chat_id)] == ['read', 'sent']
+    assert [m['id'] for m in utils.get_unread_messages('test2', 'test1')] == [second]
+    print("[OK] Статус личного сообщения выводится из курсора получателя")
+
+
+def test_post_message_is_single_write():
+    user1, user2 = _user_ids()
+    chat_id = utils.get_or_create_chat(user1, user2)
+    token = utils.get_sync_token()
+    jobs = utils.get_writer(utils.DATABASE).jobs if utils.WRITER_ENABLED else None
+
+    msg_id, reads = utils.post_message('dm', chat_id, 'test1', 'привет', status='delivered', readers=('test2',))
+    assert reads == {'test2': {'from_id': msg_id, 'up_to_id': msg_id, 'count': 1}}
+    if jobs is not None:
+        assert utils.get_writer(utils.DATABASE).jobs == jobs + 1
+    # Сообщение сразу сохранено с итоговым статусом, без отдельных UPDATE
+    changes = utils.get_changes_since(user1, token)['changes']
+    assert [(c['kind'], c['payload'].get('status')) for c in changes] == [('message', 'delivered'), ('read', None)]
+    assert changes[1]['payload'] == {'from_id': msg_id, 'up_to_id': msg_id, 'count': 1, 'reader': 'test2'}
+    assert utils.get_messages(chat_id)[0]['status'] == 'read'
+    print("[OK] Сообщение и его прочтение сохраняются одной задачей записи")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,101 @@
+"""
+Тестирование кэша составов бесед
+"""
+import sys
+
+import pytest
+
+import roster
+import utils
+from roster import RosterCache, Member
+
+
+def test_cache_hits_and_lru_eviction():
+    loads = []
+
+    def loader(kind, ref_id):
+        loads.append((kind, ref_id))
+        return [Member(ref_id, f'user{ref_id}')]
+
+    cache = RosterCache(loader, max_entries=2)
+    assert cache.get('group', 1) == (Member(1, 'user1'),)
+    cache.get('group', 1)
+    cache.get('group', 2)
+    cache.get('group', 3)  # вытесняет group 1
+    cache.get('group', 1)
+    assert loads == [('group', 1), ('group', 2), ('group', 3), ('group', 1)]
+    assert cache.stats() == {'entries': 2, 'hits': 1, 'misses': 4}
+    print("[OK] Составы кэшируются, старые вытесняются")
+
+
+def test_invalidation_during_load_is_not_cached():
+    cache = None
+
+    def loader(kind, ref_id):
+        # Состав изменился, пока шла загрузка
+        cache.invalidate(kind, ref_id)
+        return [Member(1, 'old')]
+
+    cache = RosterCache(loader)
+    cache.get('channel', 5)
+    assert cache.stats()['entries'] == 0
+    print("[OK] Загрузка, пересёкшаяся со сбросом, не попадает в кэш")
+
+
+def test_generation_counters_are_bounded(monkeypatch):
+    monkeypatch.setattr(roster, '_MAX_GENERATIONS', 3)
+    cache = RosterCache(lambda kind, ref_id: [Member(ref_id, 'user')], max_entries=4)
+    for ref_id in range(10):
+        cache.invalidate('group', ref_id)
+    assert len(cache._generations) <= 3
+    assert cache.get('group', 1) == (Member(1, 'user'),)
+    print("[OK] Счётчики поколений составов не копятся бесконечно")
+
+
+def test_disabled_cache_loads_every_time():
+    # Несколько воркеров: состав загружается при каждой рассылке
+    loads = []
+    cache = RosterCache(lambda kind, ref_id: loads.append(ref_id) or [Member(ref_id, 'test1')], max_entries=0)
+    cache.get('group', 1)
+    cache.get('group', 1)
+    assert loads == [1, 1] and cache.stats()['entries'] == 0
+    print("[OK] Выключенный кэш составов загружает состав при каждом вызове")
+
+
+def test_membership_changes_invalidate_roster():
+    user1 = utils.get_user_by_username('test1')['id']
+    user2 = utils.get_user_by_username('test2')['id']
+
+    channel_id = utils.create_channel('состав', 'test1')
+    assert [m.username for m in utils.get_roster('channel', channel_id)] == ['test1']
+    utils.add_user_to_channel(channel_id, user2)
+    assert sorted(m.username for m in utils.get_roster('channel', channel_id)) == ['test1', 'test2']
+    utils.remove_user_from_channel(channel_id, user1)
+    assert [m.user_id for m in utils.get_roster('channel', channel_id)] == [user2]
+
+    group_id = utils.create_group('состав', 'test1')
+    assert utils.get_roster('group', group_id) == ()
+    utils.add_user_to_group(group_id, user1)
+    assert utils.get_roster('group', group_id) == (Member(user1, 'test1'),)
+    print("[OK] Изменения членства сбрасывают кэш состава")
+
+
+def test_rename_invalidates_member_rosters():
+    user1 = utils.get_user_by_username('test1')['id']
+    user2 = utils.get_user_by_username('test2')['id']
+    chat_id = utils.get_or_create_chat(user1, user2)
+    group_id = utils.create_group('переименование', 'test1')
+    utils.add_user_to_group(group_id, user1)
+    channel_id = utils.create_channel('переименование', 'test1')
+    for kind, ref_id in (('dm', chat_id), ('group', group_id), ('channel', channel_id)):
+        assert Member(user1, 'test1') in utils.get_roster(kind, ref_id)
+
+    utils.update_user(user1, username='новое_имя')
+    for kind, ref_id in (('dm', chat_id), ('group', group_id), ('channel', channel_id)):
+        assert Member(user1, 'новое_имя') in utils.get_roster(kind, ref_id)
+    print("[OK] Переименование сбрасывает составы всех бесед пользователя")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
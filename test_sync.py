@@ -0,0 +1,115 @@
+"""
+Тестирование журнала изменений и дельта-синхронизации
+"""
+import sys
+
+import pytest
+
+import utils
+
+
+def _user_ids():
+    user1 = utils.get_user_by_username('test1')
+    user2 = utils.get_user_by_username('test2')
+    return user1['id'], user2['id']
+
+
+def test_changes_since_token_cover_message_lifecycle():
+    user1, user2 = _user_ids()
+    chat_id = utils.get_or_create_chat(user1, user2)
+    token = utils.get_sync_token()
+
+    msg_id = utils.save_message(chat_id, 'test1', 'привет')
+    utils.mark_message_as_delivered(msg_id)
+    utils.mark_message_as_read(msg_id)
+    utils.edit_message(msg_id, 'привет!')
+    utils.delete_message(msg_id)
+
+    result = utils.get_changes_since(user2, token)
+    assert [c['kind'] for c in result['changes']] == ['message', 'delivered', 'read', 'edit', 'delete']
+    assert all(c['room'] == 'test1_test2' for c in result['changes'])
+    assert result['changes'][1]['payload']['status'] == 'delivered'
+    # Прочтение - всегда диапазон по курсору
+    assert result['changes'][2]['payload'] == {'from_id': msg_id, 'up_to_id': msg_id, 'count': 1, 'reader': 'test2'}
+    assert result['changes'][3]['payload']['message'] == 'привет!'
+    assert not result['has_more']
+
+    # Повторный запрос с новым токеном ничего не возвращает
+    assert utils.get_changes_since(user2, result['token'])['changes'] == []
+    print("[OK] Журнал отдаёт новые сообщения, прочтения, правки и удаления")
+
+
+def test_changes_are_filtered_by_membership():
+    user1, user2 = _user_ids()
+    group_id = utils.create_group('секрет', 'test1')
+    utils.add_user_to_group(group_id, user1)
+    token = utils.get_sync_token()
+    utils.save_group_message(group_id, 'test1', 'только для участников')
+
+    assert utils.get_changes_since(user2, token)['changes'] == []
+
+    utils.add_user_to_group(group_id, user2)
+    changes = utils.get_changes_since(user2, token)['changes']
+    # После вступления участник видит историю беседы и своё членство
+    assert [c['kind'] for c in changes] == ['message', 'membership']
+    assert changes[1]['payload'] == {'kind': 'group', 'ref_id': group_id, 'user_id': user2, 'action': 'added'}
+    print("[OK] Изменения фильтруются по членству в беседе")
+
+
+def test_removed_user_sees_removal_but_not_later_messages():
+    user1, user2 = _user_ids()
+    channel_id = utils.create_channel('новости', 'test1')
+    utils.add_user_to_channel(channel_id, user2)
+    token = utils.get_sync_token()
+    utils.remove_user_from_channel(channel_id, user2)
+    utils.save_channel_message(channel_id, 'test1', 'после удаления')
+
+    changes = utils.get_changes_since(user2, token)['changes']
+    assert [(c['kind'], c['payload'].get('action')) for c in changes] == [('membership', 'removed')]
+    print("[OK] Удалённый участник получает только событие удаления")
+
+
+def test_paging_through_large_backlog():
+    user1, user2 = _user_ids()
+    chat_id = utils.get_or_create_chat(user1, user2)
+    token = utils.get_sync_token()
+    for i in range(5):
+        utils.save_message(chat_id, 'test1', f'сообщение {i}')
+
+    seen = []
+    while True:
+        result = utils.get_changes_since(user2, token, limit=2)
+        seen += [c['payload']['message'] for c in result['changes']]
+        token = result['token']
+        if not result['has_more']:
+            break
+    assert seen == [f'сообщение {i}' for i in range(5)]
+    print("[OK] Большой журнал выдаётся порциями без пропусков")
+
+
+def test_trimmed_log_asks_for_resync():
+    user1, user2 = _user_ids()
+    chat_id = utils.get_or_create_chat(user1, user2)
+    old_token = utils.get_sync_token()
+    utils.save_message(chat_id, 'test1', 'давнее')
+    fresh_token = utils.get_sync_token()
+    utils.save_message(chat_id, 'test1', 'недавнее')
+    with utils.get_db_connection() as conn:
+        conn.execute("UPDATE change_log SET created_at = datetime('now', '-40 days') WHERE id <= ?", (fresh_token,))
+        conn.commit()
+
+    assert utils.trim_change_log(days=30) == fresh_token
+    assert utils.get_changes_since(user2, old_token) == {
+        'changes': [], 'token': fresh_token + 1, 'has_more': False, 'resync': True}
+    assert [c['payload']['message'] for c in utils.get_changes_since(user2, fresh_token)['changes']] == ['недавнее']
+
+    # Весь журнал устарел: последняя запись остаётся, токен не откатывается
+    utils.trim_change_log(days=0)
+    assert utils.get_sync_token() == fresh_token + 1
+    assert utils.get_changes_since(user2, fresh_token + 1)['changes'] == []
+    print("[OK] Старые записи журнала удаляются, устаревший токен получает resync")
+
+
+if __name__ == "__main__":
+    # Тестам нужна временная база из фикстуры conftest.py
+    sys.exit(pytest.main([__file__]))
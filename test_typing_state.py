@@ -0,0 +1,51 @@
+"""
+Тестирование прореживания индикатора «печатает»
+"""
+from typing_state import TypingTracker
+
+
+def test_keystrokes_are_throttled_per_user():
+    tracker = TypingTracker(throttle=2, timeout=6)
+    assert tracker.start('group_g1', 'test1', now=0) == {'room': 'group_g1', 'users': ['test1'], 'count': 1}
+    # Нажатия внутри окна не рассылаются, но продлевают набор
+    assert [tracker.start('group_g1', 'test1', now=t / 10) for t in range(1, 20)] == [None] * 19
+    assert tracker.suppressed == 19
+    assert tracker.start('group_g1', 'test1', now=2.0)['count'] == 1
+
+    # Другой пользователь в той же комнате сразу попадает в агрегированный кадр
+    assert tracker.start('group_g1', 'test2', now=2.1) == {'room': 'group_g1', 'users': ['test1', 'test2'], 'count': 2}
+    assert tracker.stop('group_g1', 'test1') == {'room': 'group_g1', 'users': ['test2'], 'count': 1}
+    assert tracker.stop('group_g1', 'test1') is None
+    print("[OK] Кадры набора прореживаются и агрегируются по комнате")
+
+
+def test_typing_expires_without_stop():
+    tracker = TypingTracker(throttle=2, timeout=6)
+    tracker.start('group_g1', 'test1', now=0)
+    tracker.start('group_g1', 'test2', now=0)
+    tracker.start('group_g1', 'test2', now=5)  # продлевает набор test2
+    tracker.start('test1_test2', 'test1', now=1)
+
+    assert tracker.expire(now=5.5) == []
+    frames = tracker.expire(now=7)
+    assert sorted(f['room'] for f in frames) == ['group_g1', 'test1_test2']
+    assert {'room': 'group_g1', 'users': ['test2'], 'count': 1} in frames
+    assert tracker.expire(now=11) == [{'room': 'group_g1', 'users': [], 'count': 0}]
+    assert not tracker.active()
+    print("[OK] Набор без событий завершается автоматически")
+
+
+def test_disconnect_stops_typing_everywhere():
+    tracker = TypingTracker()
+    tracker.start('group_g1', 'test1', now=0)
+    tracker.start('channel_c1', 'test1', now=0)
+    tracker.start('channel_c1', 'test2', now=0)
+    frames = tracker.stop_all('test1')
+    assert sorted((f['room'], f['count']) for f in frames) == [('channel_c1', 1), ('group_g1', 0)]
+    print("[OK] Отключение завершает набор во всех комнатах")
+
+
+if __name__ == "__main__":
+    test_keystrokes_are_throttled_per_user()
+    test_typing_expires_without_stop()
+    test_disconnect_stops_typing_everywhere()
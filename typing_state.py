@@ -0,0 +1,93 @@
+# typing_state.py
+"""
+Состояние индикатора «печатает» по комнатам.
+
+Клиент сообщает о наборе текста при каждом нажатии клавиш, но рассылать
+каждое такое событие всей комнате незачем. Трекер хранит, кто печатает в
+каждой комнате, и решает, когда действительно нужен кадр для комнаты: при
+начале и окончании набора, и не чаще одного раза за TYPING_THROTTLE секунд
+для продолжающегося набора одного пользователя. Если клиент не прислал
+stop, набор истекает сам через TYPING_TIMEOUT секунд.
+
+Кадр - агрегированное состояние комнаты: {'room', 'users', 'count'}.
+Состояние хранится в воркере, получившем события набора.
+"""
+import os
+import threading
+import time
+
+# Не чаще одного кадра typing за это время на пользователя в комнате
+TYPING_THROTTLE = float(os.environ.get('TYPING_THROTTLE', 2))
+# Через сколько секунд без событий набор считается законченным
+TYPING_TIMEOUT = float(os.environ.get('TYPING_TIMEOUT', 6))
+
+
+class TypingTracker:
+    """
+    Кто печатает в каждой комнате.
+
+    start/stop/expire возвращают кадр для рассылки или None, если рассылать нечего.
+    """
+
+    def __init__(self, throttle=TYPING_THROTTLE, timeout=TYPING_TIMEOUT):
+        self.throttle = throttle
+        self.timeout = timeout
+        # {room: {username: [время последнего события, время последнего кадра]}}
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def _frame(self, room):
+        users = sorted(self._rooms.get(room) or ())
+        return {'room': room, 'users': users, 'count': len(users)}
+
+    def start(self, room, username, now=None):
+        """Пользователь печатает; кадр нужен для нового набора или после окна throttle"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            typers = self._rooms.setdefault(room, {})
+            state = typers.get(username)
+            if state is not None and now - state[1] < self.throttle:
+                state[0] = now
+                self.suppressed += 1
+                return None
+            typers[username] = [now, now]
+            return self._frame(room)
+
+    def stop(self, room, username):
+        """Пользователь перестал печатать (или отправил сообщение)"""
+        with self._lock:
+            typers = self._rooms.get(room)
+            if not typers or typers.pop(username, None) is None:
+                return None
+            frame = self._frame(room)
+            if not typers:
+                del self._rooms[room]
+            return frame
+
+    def stop_all(self, username):
+        """Пользователь отключился: кадры для всех комнат, где он печатал"""
+        with self._lock:
+            rooms = [room for room, typers in self._rooms.items() if username in typers]
+        return [frame for frame in (self.stop(room, username) for room in rooms) if frame]
+
+    def expire(self, now=None):
+        """Завершить наборы без событий дольше timeout; кадры для изменившихся комнат"""
+        now = time.monotonic() if now is None else now
+        frames = []
+        with self._lock:
+            for room in list(self._rooms):
+                typers = self._rooms[room]
+                stale = [u for u, (last, _) in typers.items() if now - last >= self.timeout]
+                if not stale:
+                    continue
+                for username in stale:
+                    del typers[username]
+                frames.append(self._frame(room))
+                if not typers:
+                    del self._rooms[room]
+        return frames
+
+    def active(self):
+        with self._lock:
+            return bool(self._rooms)
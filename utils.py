@@ -1,527 +1,721 @@
 # utils.py (обновлённый)
-import sqlite3
+import os
 import hashlib
+import functools
+import threading
 from contextlib import contextmanager
 import datetime
+import json
 import uuid
 
+from db_pool import get_pool, apply_storage_profile
+from db_writer import get_writer, WRITER_ENABLED
+from db_offload import offloaded
+from migrations import migrate
+from roster import RosterCache, Member
+from history_buffer import HistoryBuffer
+from cache import create_query_cache
+from app_logging import get_logger
+import redis_config
+
 DATABASE = 'database.db'
+# Загруженные файлы (картинки постов и др.)
+UPLOADS_DIR = os.path.join(os.path.dirname(__file__), 'uploads')
+
+log = get_logger('db')
 
 def init_db():
-    print("init_db called")
+    apply_storage_profile(DATABASE)
+    migrate(DATABASE)
+    # Кэши в памяти относятся к прежнему файлу базы
+    roster_cache.clear()
+    history_buffer.clear()
+    query_cache.clear()
+
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def verify_password(password, hashed):
+    return hash_password(password) == hashed
+
+@contextmanager
+def get_db_connection():
+    # Соединение берётся из пула и возвращается в него после выхода из блока
+    with get_pool(DATABASE).connection() as conn:
+        yield conn
+
+
+# Колбэки after_commit для режима без потока-писателя (стек на случай вложенных вызовов)
+_commit_callbacks = threading.local()
+
+
+def db_write(func):
+    """
+    Декоратор для функций записи: func(conn, *args) выполняется в потоке-писателе
+    и возвращает результат после фиксации транзакции. Вызывающий код передаёт
+    только свои аргументы, без conn.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if WRITER_ENABLED:
+            return get_writer(DATABASE).run(func, *args, **kwargs)
+        pending = getattr(_commit_callbacks, 'stack', None)
+        if pending is None:
+            pending = _commit_callbacks.stack = []
+        pending.append([])
+        try:
+            with get_db_connection() as conn:
+                result = func(conn, *args, **kwargs)
+                conn.commit()
+        finally:
+            callbacks = pending.pop()
+        for callback in callbacks:
+            callback()
+        return result
+    return wrapper
+
+
+def after_commit(callback):
+    """Выполнить callback после фиксации текущей записи (используется для сброса кэшей)"""
+    if WRITER_ENABLED:
+        get_writer(DATABASE).after_commit(callback)
+        return
+    stack = getattr(_commit_callbacks, 'stack', None)
+    if stack:
+        stack[-1].append(callback)
+    else:
+        callback()
+
+
+# === Беседы: личные чаты, группы и каналы в одном хранилище сообщений ===
+
+def _find_conversation_id(conn, kind, ref_id):
+    row = conn.execute("SELECT id FROM conversations WHERE kind = ? AND ref_id = ?", (kind, ref_id)).fetchone()
+    return row['id'] if row else None
+
+
+def _ensure_conversation(conn, kind, ref_id):
+    """Вернуть id беседы, создав её при необходимости (только внутри задачи записи)"""
+    conn.execute("INSERT OR IGNORE INTO conversations (kind, ref_id) VALUES (?, ?)", (kind, ref_id))
+    return _find_conversation_id(conn, kind, ref_id)
+
+
+def get_conversation_id(kind, ref_id):
+    with get_db_connection() as conn:
+        return _find_conversation_id(conn, kind, ref_id)
+
+
+def _insert_conversation_message(conn, kind, ref_id, sender, message, parent_message_id=None,
+                                 message_type='text', audio_path=None, status='sent', is_read=False):
+    conversation_id = _ensure_conversation(conn, kind, ref_id)
+    conn.execute("UPDATE conversations SET last_seq = last_seq + 1 WHERE id = ?", (conversation_id,))
+    seq = conn.execute("SELECT last_seq FROM conversations WHERE id = ?", (conversation_id,)).fetchone()['last_seq']
+    cursor = conn.execute("""
+        INSERT INTO conversation_messages
+            (conversation_id, seq, sender, message, status, is_read, parent_message_id, message_type, audio_path)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (conversation_id, seq, sender, message, status, is_read, parent_message_id, message_type, audio_path))
+    timestamp = conn.execute("SELECT timestamp FROM conversation_messages WHERE id = ?", (cursor.lastrowid,)).fetchone()['timestamp']
+    _summary_on_message(conn, conversation_id, kind, ref_id, sender, message, timestamp)
+    _log_message_change(conn, 'message', cursor.lastrowid)
+    _history_on_message(conn, kind, ref_id, cursor.lastrowid)
+    return cursor.lastrowid
+
+
+@db_write
+def post_message(conn, kind, ref_id, sender, message, parent_message_id=None, message_type='text',
+                 audio_path=None, status='sent', readers=()):
+    """
+    Сохранить новое сообщение одной задачей записи: строка вставляется сразу с итоговым
+    статусом, а курсоры readers (тех, у кого беседа открыта) сдвигаются до него.
+
+    Возвращает (msg_id, {reader: результат прочтения}) после фиксации транзакции.
+    """
+    msg_id = _insert_conversation_message(conn, kind, ref_id, sender, message, parent_message_id,
+                                          message_type, audio_path, status=status)
+    read = _mark_conversation_read(conn, kind, ref_id, tuple(readers), msg_id) if readers else {}
+    return msg_id, read
+
+
+# === Сводка списка чатов ===
+# conversation_summary хранит для каждого участника последнее сообщение беседы и
+# число непрочитанных. Строки обновляются при записи, поэтому список чатов -
+# это один проход по первичному ключу (user_id, conversation_id).
+
+_MEMBERS_SQL = {
+    'dm': "SELECT u.id as user_id, u.username FROM chats c JOIN users u ON u.id IN (c.user1_id, c.user2_id) WHERE c.id = ?",
+    'group': "SELECT u.id as user_id, u.username FROM group_members gm JOIN users u ON u.id = gm.user_id WHERE gm.group_id = ?",
+    'channel': "SELECT u.id as user_id, u.username FROM channel_members cm JOIN users u ON u.id = cm.user_id WHERE cm.channel_id = ?",
+}
+
+# === Составы бесед ===
+
+def _load_roster(kind, ref_id):
     with get_db_connection() as conn:
-        # === Таблица пользователей ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                registration_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                city TEXT,
-                bio_short TEXT,
-                country TEXT,
-                languages TEXT,
-                bio_full TEXT,
-                hobbies TEXT,
-                avatar TEXT,
-                status TEXT,
-                banner_photo TEXT,
-                banner_color TEXT
-            )
-        """)
+        return [Member(row['user_id'], row['username']) for row in conn.execute(_MEMBERS_SQL[kind], (ref_id,)).fetchall()]
 
-        # === Таблица чатов ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user1_id INTEGER,
-                user2_id INTEGER,
-                UNIQUE(user1_id, user2_id)
-            )
-        """)
 
-        # === Таблица личных сообщений ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                sender TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'sent',  -- sent, delivered, read
-                parent_message_id INTEGER REFERENCES messages(id),
-                edited BOOLEAN DEFAULT FALSE
-            )
-        """)
+roster_cache = RosterCache(_load_roster)
 
-        # === ГРУППЫ ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS groups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                creator TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                pinned_msg_id INTEGER,
-                description TEXT
-            )
-        """)
 
-        # === Участники групп ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS group_members (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER,
-                user_id INTEGER,
-                joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (group_id) REFERENCES groups (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(group_id, user_id)
-            )
-        """)
+def get_roster(kind, ref_id):
+    """Участники беседы (кортеж Member) из кэша; загружаются одним запросом с JOIN"""
+    return roster_cache.get(kind, ref_id)
 
-        # === Сообщения в группах ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS group_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER,
-                sender TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                is_read BOOLEAN DEFAULT FALSE,
-                edited BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (group_id) REFERENCES groups (id)
-            )
-        """)
 
-        # Добавить тестовых пользователей
-        conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('test1', hash_password('pass1'), 'Москва', 'Привет'))
-        conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('test2', hash_password('pass2'), 'СПб', 'Хай'))
-        conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('user1', hash_password('pass1'), 'Екатеринбург', 'Тест'))
-        conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('user2', hash_password('pass2'), 'Казань', 'Привет всем'))
-        conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('alex', hash_password('pass1'), 'Новосибирск', 'Разработчик'))
-        conn.execute("INSERT OR IGNORE INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)", ('maria', hash_password('pass2'), 'Владивосток', 'Дизайнер'))
+def _invalidate_roster(kind, ref_id):
+    # Сброс после фиксации: иначе параллельное чтение может закэшировать состав до изменения
+    after_commit(lambda: roster_cache.invalidate(kind, ref_id))
+    _invalidate_tags(f'{kind}:{ref_id}:members')
 
-        # === Подписки ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                follower_id INTEGER,
-                following_id INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(follower_id, following_id),
-                FOREIGN KEY (follower_id) REFERENCES users (id),
-                FOREIGN KEY (following_id) REFERENCES users (id)
-            )
-        """)
 
-        # === Посты ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                content TEXT NOT NULL,
-                image_url TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
+# Беседы пользователя (kind, ref_id): личные чаты, группы и каналы, где он участник
+_USER_CONVERSATIONS_SQL = """
+    SELECT 'dm' as kind, id as ref_id FROM chats WHERE user1_id = :user_id OR user2_id = :user_id
+    UNION ALL
+    SELECT 'group', group_id FROM group_members WHERE user_id = :user_id
+    UNION ALL
+    SELECT 'channel', channel_id FROM channel_members WHERE user_id = :user_id
+"""
 
-        # === Лайки ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS likes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                post_id INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, post_id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (post_id) REFERENCES posts (id)
-            )
-        """)
 
-        # === Комментарии ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                post_id INTEGER,
-                content TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (post_id) REFERENCES posts (id)
-            )
-        """)
+def _invalidate_user_rosters(conn, user_id):
+    """Сбросить составы всех бесед пользователя (в них закэшировано его имя)"""
+    for row in conn.execute(_USER_CONVERSATIONS_SQL, {'user_id': user_id}).fetchall():
+        _invalidate_roster(row['kind'], row['ref_id'])
 
-        # === Комментарии к сообщениям ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS message_comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id INTEGER,
-                user_id INTEGER,
-                content TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (message_id) REFERENCES messages (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
 
-        # === Комментарии к профилям ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS profile_comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                profile_user_id INTEGER,
-                content TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (profile_user_id) REFERENCES users (id)
-            )
-        """)
+# Сообщение m прочитано, если курсор прочтения хотя бы одного участника, кроме автора, дошёл до него
+# (проверка идёт по индексу read_cursor(conversation_id, last_read_id))
+_READ_BY_OTHERS_SQL = """EXISTS (
+    SELECT 1 FROM read_cursor rc
+    WHERE rc.conversation_id = m.conversation_id AND rc.last_read_id >= m.id
+      AND rc.user_id NOT IN (SELECT id FROM users WHERE username = m.sender))"""
+# Статус для личных чатов: 'read' по курсору, иначе хранимый sent/delivered
+_DM_STATUS_SQL = f"CASE WHEN {_READ_BY_OTHERS_SQL} THEN 'read' ELSE m.status END"
 
-        # === Репосты ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS reposts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                original_post_id INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, original_post_id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (original_post_id) REFERENCES posts (id)
-            )
-        """)
 
-        # === Реакции ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS reactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                post_id INTEGER,
-                emoji TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, post_id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (post_id) REFERENCES posts (id)
-            )
-        """)
+def _summary_on_message(conn, conversation_id, kind, ref_id, sender, message, timestamp):
+    """Новое сообщение: обновить последнее сообщение у всех участников и +1 непрочитанное у всех, кроме автора"""
+    conn.execute(f"""
+        INSERT INTO conversation_summary (user_id, conversation_id, last_message, last_time, unread_count)
+        SELECT m.user_id, ?, ?, ?, CASE WHEN m.username = ? THEN 0 ELSE 1 END
+        FROM ({_MEMBERS_SQL[kind]}) m WHERE true
+        ON CONFLICT(user_id, conversation_id) DO UPDATE SET
+            last_message = excluded.last_message,
+            last_time = excluded.last_time,
+            unread_count = conversation_summary.unread_count + excluded.unread_count
+    """, (conversation_id, message, timestamp, sender, ref_id))
 
-        # === Ответы на комментарии ===
-        try:
-            conn.execute("ALTER TABLE comments ADD COLUMN parent_comment_id INTEGER REFERENCES comments(id)")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE messages ADD COLUMN parent_message_id INTEGER REFERENCES messages(id)")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def _summary_on_delete(conn, msg_id):
+    """Удаляемое сообщение перестаёт быть непрочитанным у участников, чей курсор до него не дошёл"""
+    conn.execute("""
+        UPDATE conversation_summary SET unread_count = MAX(unread_count - 1, 0)
+        WHERE conversation_id = (SELECT conversation_id FROM conversation_messages WHERE id = :msg_id)
+          AND user_id NOT IN (SELECT u.id FROM users u JOIN conversation_messages m ON m.sender = u.username WHERE m.id = :msg_id)
+          AND COALESCE((SELECT rc.last_read_id FROM read_cursor rc
+                        WHERE rc.user_id = conversation_summary.user_id
+                          AND rc.conversation_id = conversation_summary.conversation_id), 0) < :msg_id
+    """, {'msg_id': msg_id})
 
-        # === Сообщения в каналах ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS channel_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                channel_id INTEGER,
-                sender TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                is_read BOOLEAN DEFAULT FALSE,
-                edited BOOLEAN DEFAULT FALSE,
-                parent_message_id INTEGER REFERENCES channel_messages(id),
-                FOREIGN KEY (channel_id) REFERENCES channels (id)
-            )
-        """)
 
-        try:
-            conn.execute("ALTER TABLE group_messages ADD COLUMN parent_message_id INTEGER REFERENCES group_messages(id)")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def _summary_refresh_last(conn, conversation_id):
+    """Обновить последнее сообщение после правки или удаления"""
+    last = conn.execute("""
+        SELECT message, timestamp FROM conversation_messages
+        WHERE conversation_id = ? ORDER BY seq DESC LIMIT 1
+    """, (conversation_id,)).fetchone()
+    if last is None:
+        conn.execute("DELETE FROM conversation_summary WHERE conversation_id = ?", (conversation_id,))
+    else:
+        conn.execute("UPDATE conversation_summary SET last_message = ?, last_time = ? WHERE conversation_id = ?",
+                     (last['message'], last['timestamp'], conversation_id))
 
-        try:
-            conn.execute("ALTER TABLE messages ADD COLUMN edited BOOLEAN DEFAULT FALSE")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE group_messages ADD COLUMN edited BOOLEAN DEFAULT FALSE")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+# === Курсоры прочтения ===
+# Прочтение хранится как read_cursor(user_id, conversation_id, last_read_id):
+# открытие беседы - один upsert, а не запись в каждую строку сообщения.
 
-        try:
-            conn.execute("ALTER TABLE channel_messages ADD COLUMN parent_message_id INTEGER REFERENCES channel_messages(id)")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def _advance_read_cursor(conn, conversation_id, user_id, username, up_to_id):
+    """
+    Сдвинуть курсор пользователя до up_to_id (курсор только растёт) и пересчитать его непрочитанные.
 
-        # === Добавление полей для голосовых сообщений ===
-        try:
-            conn.execute("ALTER TABLE messages ADD COLUMN message_type VARCHAR DEFAULT 'text'")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+    Возвращает {'from_id', 'up_to_id', 'count'} для чужих сообщений, ставших прочитанными, или None.
+    """
+    row = conn.execute("SELECT last_read_id FROM read_cursor WHERE user_id = ? AND conversation_id = ?",
+                       (user_id, conversation_id)).fetchone()
+    last_read_id = row['last_read_id'] if row else 0
+    if up_to_id <= last_read_id:
+        return None
+    conn.execute("""
+        INSERT INTO read_cursor (user_id, conversation_id, last_read_id) VALUES (?, ?, ?)
+        ON CONFLICT(user_id, conversation_id) DO UPDATE SET last_read_id = excluded.last_read_id
+    """, (user_id, conversation_id, up_to_id))
+    _history_on_read(conn, conversation_id, username, up_to_id)
+
+    # Непрочитанные считаются диапазоном id по индексу (conversation_id, id)
+    newly_read = conn.execute("""
+        SELECT COUNT(*) as count, MIN(id) as from_id FROM conversation_messages
+        WHERE conversation_id = ? AND id > ? AND id <= ? AND sender != ?
+    """, (conversation_id, last_read_id, up_to_id, username)).fetchone()
+    conn.execute("""
+        UPDATE conversation_summary SET unread_count = (
+            SELECT COUNT(*) FROM conversation_messages
+            WHERE conversation_id = ? AND id > ? AND sender != ?
+        ) WHERE user_id = ? AND conversation_id = ?
+    """, (conversation_id, up_to_id, username, user_id, conversation_id))
+    if not newly_read['count']:
+        return None
+    result = {'from_id': newly_read['from_id'], 'up_to_id': up_to_id, 'count': newly_read['count']}
+    _log_change(conn, 'read', dict(result, reader=username), conversation_id=conversation_id)
+    return result
 
-        try:
-            conn.execute("ALTER TABLE messages ADD COLUMN audio_path VARCHAR")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE group_messages ADD COLUMN message_type VARCHAR DEFAULT 'text'")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def _mark_message_read(conn, msg_id, reader=None):
+    """
+    Прочитать беседу до сообщения msg_id.
 
-        try:
-            conn.execute("ALTER TABLE group_messages ADD COLUMN audio_path VARCHAR")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+    Без reader сохраняется прежнее поведение «прочитано для всех»: курсоры
+    сдвигаются у всех участников, кроме автора сообщения.
+    """
+    row = conn.execute("""
+        SELECT m.conversation_id, m.sender, c.kind, c.ref_id FROM conversation_messages m
+        JOIN conversations c ON m.conversation_id = c.id WHERE m.id = ?
+    """, (msg_id,)).fetchone()
+    if row is None:
+        return None
+    if reader is None:
+        readers = [m for m in conn.execute(_MEMBERS_SQL[row['kind']], (row['ref_id'],)).fetchall()
+                   if m['username'] != row['sender']]
+    else:
+        readers = conn.execute("SELECT id as user_id, username FROM users WHERE username = ?", (reader,)).fetchall()
+    result = None
+    for member in readers:
+        result = _advance_read_cursor(conn, row['conversation_id'], member['user_id'], member['username'], msg_id) or result
+    return result
+
+
+def _mark_conversation_read(conn, kind, ref_id, readers, up_to_id):
+    conversation_id = _find_conversation_id(conn, kind, ref_id)
+    if conversation_id is None:
+        return {}
+    if up_to_id is None:
+        up_to_id = conn.execute("SELECT MAX(id) FROM conversation_messages WHERE conversation_id = ?",
+                                (conversation_id,)).fetchone()[0]
+        if up_to_id is None:
+            return {}
+    results = {}
+    placeholders = ','.join('?' * len(readers))
+    for user in conn.execute(f"SELECT id, username FROM users WHERE username IN ({placeholders})", tuple(readers)).fetchall():
+        result = _advance_read_cursor(conn, conversation_id, user['id'], user['username'], up_to_id)
+        if result:
+            results[user['username']] = result
+    return results
+
+
+@db_write
+def mark_conversation_read(conn, kind, ref_id, reader, up_to_id=None):
+    """
+    Отметить беседу прочитанной пользователем reader до up_to_id включительно (по умолчанию - до последнего).
 
-        try:
-            conn.execute("ALTER TABLE channel_messages ADD COLUMN message_type VARCHAR DEFAULT 'text'")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+    Возвращает {'from_id', 'up_to_id', 'count'} или None, если отмечать нечего.
+    """
+    return _mark_conversation_read(conn, kind, ref_id, (reader,), up_to_id).get(reader)
+
+
+def get_read_cursor(user_id, kind, ref_id):
+    with get_db_connection() as conn:
+        row = conn.execute("""
+            SELECT rc.last_read_id FROM read_cursor rc
+            JOIN conversations c ON rc.conversation_id = c.id
+            WHERE rc.user_id = ? AND c.kind = ? AND c.ref_id = ?
+        """, (user_id, kind, ref_id)).fetchone()
+        return row['last_read_id'] if row else 0
+
+
+def _rebuild_conversation_summary(conn, kind, ref_id, user_id=None):
+    """Пересчитать сводку беседы по сообщениям (для одного участника - при вступлении в беседу)"""
+    conversation_id = _find_conversation_id(conn, kind, ref_id)
+    if conversation_id is None:
+        return
+    if user_id is None:
+        conn.execute("DELETE FROM conversation_summary WHERE conversation_id = ?", (conversation_id,))
+    else:
+        conn.execute("DELETE FROM conversation_summary WHERE conversation_id = ? AND user_id = ?", (conversation_id, user_id))
+    conn.execute(f"""
+        INSERT INTO conversation_summary (user_id, conversation_id, last_message, last_time, unread_count)
+        SELECT m.user_id, :conversation_id, last.message, last.timestamp,
+               (SELECT COUNT(*) FROM conversation_messages x
+                WHERE x.conversation_id = :conversation_id AND x.sender != m.username
+                  AND x.id > COALESCE((SELECT last_read_id FROM read_cursor
+                                       WHERE user_id = m.user_id AND conversation_id = :conversation_id), 0))
+        FROM ({_MEMBERS_SQL[kind].replace('?', ':ref_id')}) m
+        JOIN (SELECT message, timestamp FROM conversation_messages
+              WHERE conversation_id = :conversation_id ORDER BY seq DESC LIMIT 1) last
+        WHERE :user_id IS NULL OR m.user_id = :user_id
+    """, {'conversation_id': conversation_id, 'ref_id': ref_id, 'user_id': user_id})
+
+
+# === Буфер истории ===
+# Последние сообщения каждой беседы в том виде, в каком их отдаёт история. Изменения
+# применяются к буферу после фиксации транзакции; если нужных данных нет, буфер беседы сбрасывается.
+
+history_buffer = HistoryBuffer()
+
+
+def _history_select(kind):
+    """SELECT строки истории (с родительским сообщением, аватаром автора и состоянием прочтения)"""
+    # Состояние прочтения выводится из курсоров участников
+    read_state = f"{_DM_STATUS_SQL} as status" if kind == 'dm' else f"{_READ_BY_OTHERS_SQL} as is_read"
+    return f"""
+        SELECT m.id, m.sender, m.message, m.timestamp, {read_state}, m.parent_message_id, m.edited, m.message_type, m.audio_path,
+               p.sender as parent_sender, p.message as parent_message,
+               u.avatar as sender_avatar
+        FROM conversation_messages m
+        LEFT JOIN conversation_messages p ON m.parent_message_id = p.id
+        LEFT JOIN users u ON m.sender = u.username
+    """
 
-        try:
-            conn.execute("ALTER TABLE channel_messages ADD COLUMN audio_path VARCHAR")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        # === Закрепленные посты ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS pinned_posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                post_id INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, post_id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (post_id) REFERENCES posts (id)
-            )
-        """)
+def _history_key(conn, conversation_id):
+    row = conn.execute("SELECT kind, ref_id FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+    return (row['kind'], row['ref_id']) if row else None
 
-        # === Сессии пользователей ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                login_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-                logout_time DATETIME,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
 
-        # === Каналы ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS channels (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                creator TEXT NOT NULL,
-                description TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                is_private BOOLEAN DEFAULT FALSE
-            )
-        """)
+def _fill_history_buffer(conn, kind, ref_id, conversation_id, offset, limit, before_id, after_id):
+    """
+    Загрузить беседу в буфер одним запросом и отдать из тех же строк запрошенную страницу.
 
-        # === Участники каналов ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS channel_members (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                channel_id INTEGER,
-                user_id INTEGER,
-                role_id INTEGER,
-                joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (channel_id) REFERENCES channels (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (role_id) REFERENCES channel_roles (id),
-                UNIQUE(channel_id, user_id)
-            )
-        """)
+    Первая страница без курсора читается с начала беседы: если беседа целиком
+    помещается в буфер, она и ложится в буфер, иначе страница отдаётся без заполнения.
+    Для курсора загружаются последние сообщения. None - строки страницу не покрывают.
+    """
+    key = (kind, ref_id)
+    capacity = history_buffer.capacity
+    head = before_id is None and after_id is None
+    if head and offset >= capacity:
+        return None
+    generation = history_buffer.generation(key)
+    order = "m.seq" if head else "m.id DESC"
+    count = max(capacity + 1, offset + limit) if head else capacity + 1
+    rows = [dict(r) for r in conn.execute(
+        _history_select(kind) + f" WHERE m.conversation_id = ? ORDER BY {order} LIMIT ?",
+        (conversation_id, count)
+    ).fetchall()]
+    if not head:
+        rows.reverse()
+    complete = len(rows) <= capacity
+    if complete or not head:
+        history_buffer.fill(key, rows, complete, generation)
+    if head:
+        return [dict(r) for r in rows[offset:offset + limit]]
+    return history_buffer.page_of(rows, complete, offset, limit, before_id, after_id)
+
+
+def _history_on_message(conn, kind, ref_id, msg_id):
+    key = (kind, ref_id)
+    if history_buffer.cached(key):
+        row = dict(conn.execute(_history_select(kind) + " WHERE m.id = ?", (msg_id,)).fetchone())
+        after_commit(lambda: history_buffer.append(key, row))
+    else:
+        # Загрузка буфера, начатая до фиксации, не должна попасть в него без этого сообщения
+        after_commit(lambda: history_buffer.invalidate(key))
+
+
+def _history_on_read(conn, conversation_id, reader, up_to_id):
+    key = _history_key(conn, conversation_id)
+    if key is None:
+        return
+    fields = {'status': 'read'} if key[0] == 'dm' else {'is_read': 1}
+    after_commit(lambda: history_buffer.update(
+        key, fields, lambda row: row['id'] <= up_to_id and row['sender'] != reader))
+
+
+def _history_on_change(conn, msg_id, kind, value=None):
+    """Правка ('edit'), удаление ('delete') или доставка ('delivered') сообщения msg_id"""
+    row = conn.execute("SELECT conversation_id FROM conversation_messages WHERE id = ?", (msg_id,)).fetchone()
+    key = _history_key(conn, row['conversation_id']) if row else None
+    if key is None:
+        return
+    if kind == 'edit':
+        def apply():
+            history_buffer.update(key, {'message': value, 'edited': 1}, lambda r: r['id'] == msg_id)
+            history_buffer.update(key, {'parent_message': value}, lambda r: r['parent_message_id'] == msg_id)
+    elif kind == 'delete':
+        def apply():
+            history_buffer.remove(key, msg_id)
+            history_buffer.update(key, {'parent_sender': None, 'parent_message': None},
+                                  lambda r: r['parent_message_id'] == msg_id)
+    else:
+        def apply():
+            history_buffer.update(key, {'status': 'delivered'},
+                                  lambda r: r['id'] == msg_id and r.get('status') != 'read')
+    after_commit(apply)
+
+
+def _get_conversation_messages(kind, ref_id, offset, limit, before_id=None, after_id=None):
+    """
+    История беседы в хронологическом порядке.
 
-        # === Приглашения в каналы ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS channel_invites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                channel_id INTEGER,
-                invite_code TEXT UNIQUE NOT NULL,
-                created_by INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                expires_at DATETIME,
-                max_uses INTEGER DEFAULT NULL,
-                uses INTEGER DEFAULT 0,
-                FOREIGN KEY (channel_id) REFERENCES channels (id),
-                FOREIGN KEY (created_by) REFERENCES users (id)
-            )
-        """)
+    Страницы, которые целиком покрывает буфер последних сообщений, отдаются из памяти.
+    С курсором (before_id/after_id) выборка идёт по индексу (conversation_id, id)
+    и не зависит от глубины прокрутки; без курсора - старый режим LIMIT/OFFSET.
+    """
+    key = (kind, ref_id)
+    messages = history_buffer.get_page(key, offset, limit, before_id, after_id)
+    if messages is not None:
+        return messages
+    with get_db_connection() as conn:
+        conversation_id = _find_conversation_id(conn, kind, ref_id)
+        if conversation_id is None:
+            return []
+        if history_buffer.enabled and not history_buffer.cached(key):
+            messages = _fill_history_buffer(conn, kind, ref_id, conversation_id, offset, limit, before_id, after_id)
+            if messages is not None:
+                return messages
+        if before_id is not None:
+            # Страница перед курсором: берём ближайшие к нему сообщения и разворачиваем
+            condition, order, params = "AND m.id < ?", "m.id DESC", (before_id, limit)
+        elif after_id is not None:
+            condition, order, params = "AND m.id > ?", "m.id", (after_id, limit)
+        else:
+            condition, order, params = "", "m.seq", (limit,)
+        query = _history_select(kind) + f"""
+            WHERE m.conversation_id = ? {condition}
+            ORDER BY {order}
+            LIMIT ?
+        """
+        if not condition:
+            query += " OFFSET ?"
+            params += (offset,)
+        messages = [dict(m) for m in conn.execute(query, (conversation_id,) + params).fetchall()]
+    if before_id is not None:
+        messages.reverse()
+    return messages
 
-        # === Роли в каналах ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS channel_roles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                channel_id INTEGER,
-                role_name TEXT NOT NULL,
-                permissions TEXT,
-                FOREIGN KEY (channel_id) REFERENCES channels (id),
-                UNIQUE(channel_id, role_name)
-            )
-        """)
 
-        # === Мероприятия ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                description TEXT,
-                event_date DATETIME,
-                location TEXT,
-                creator_id INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (creator_id) REFERENCES users (id)
-            )
-        """)
+def next_history_cursor(messages, limit, before_id=None):
+    """
+    Курсор следующей страницы истории или None, если страница последняя.
 
-        # === Участники мероприятий ===
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS event_participants (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_id INTEGER,
-                user_id INTEGER,
-                status TEXT DEFAULT 'invited',  -- invited, confirmed, declined
-                joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (event_id) REFERENCES events (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(event_id, user_id)
-            )
-        """)
+    При листании назад (before_id) это id самого старого сообщения страницы,
+    иначе - id самого нового (для after_id).
+    """
+    if not messages or len(messages) < limit:
+        return None
+    return messages[0]['id'] if before_id is not None else messages[-1]['id']
 
-        conn.commit()
 
-        # Добавить колонки если не существуют
-        try:
-            conn.execute("ALTER TABLE groups ADD COLUMN pinned_msg_id INTEGER")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass  # Колонка уже существует
+# === Журнал изменений для дельта-синхронизации ===
+# Изменение в беседе записывается один раз (conversation_id), а не по строке на
+# каждого участника: при синхронизации журнал фильтруется по членству пользователя.
+# Виды: message, edit, delete (строка сообщения), delivered (статус доставки одного
+# сообщения), read (курсор прочтения: from_id, up_to_id, count, reader), membership.
 
-        try:
-            conn.execute("ALTER TABLE groups ADD COLUMN description TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass  # Колонка уже существует
+SYNC_BATCH_LIMIT = 500
+# Сколько дней хранить журнал; клиенту с более старым токеном отвечают resync
+CHANGE_LOG_RETENTION_DAYS = int(os.environ.get('CHANGE_LOG_RETENTION_DAYS', 30))
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN registration_date DATETIME DEFAULT CURRENT_TIMESTAMP")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN city TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def _log_change(conn, kind, payload, conversation_id=None, user_id=None):
+    conn.execute(
+        "INSERT INTO change_log (conversation_id, user_id, kind, payload) VALUES (?, ?, ?, ?)",
+        (conversation_id, user_id, kind, json.dumps(payload, ensure_ascii=False, default=str))
+    )
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN bio_short TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN country TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def _log_message_change(conn, kind, msg_id):
+    """Записать изменение сообщения (вызывается до удаления для kind='delete')"""
+    row = conn.execute(f"""
+        SELECT m.id, m.conversation_id, m.sender, m.message, m.timestamp,
+               {_DM_STATUS_SQL} as status, {_READ_BY_OTHERS_SQL} as is_read,
+               m.parent_message_id, m.edited, m.message_type, m.audio_path
+        FROM conversation_messages m WHERE m.id = ?
+    """, (msg_id,)).fetchone()
+    if row is None:
+        return
+    payload = {'id': row['id']} if kind == 'delete' else dict(row)
+    payload.pop('conversation_id', None)
+    _log_change(conn, kind, payload, conversation_id=row['conversation_id'])
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN languages TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN bio_full TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def _log_membership(conn, kind, ref_id, user_id, action):
+    _log_change(conn, 'membership', {'kind': kind, 'ref_id': ref_id, 'user_id': user_id, 'action': action},
+                conversation_id=_find_conversation_id(conn, kind, ref_id), user_id=user_id)
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN hobbies TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN avatar TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+@db_write
+def trim_change_log(conn, days=CHANGE_LOG_RETENTION_DAYS):
+    """Удалить из журнала изменения старше days дней; возвращает количество удалённых записей"""
+    first_kept = conn.execute("""
+        SELECT id FROM change_log WHERE created_at >= datetime('now', ?) ORDER BY id LIMIT 1
+    """, (f'-{days} days',)).fetchone()
+    if first_kept is None:
+        # Последняя запись остаётся всегда: по ней get_sync_token() не откатывается назад
+        first_kept = conn.execute("SELECT MAX(id) as id FROM change_log").fetchone()
+    if first_kept['id'] is None:
+        return 0
+    return conn.execute("DELETE FROM change_log WHERE id < ?", (first_kept['id'],)).rowcount
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN status TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN banner_photo TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def get_sync_token():
+    """Текущая позиция журнала изменений (токен для клиента без истории синхронизации)"""
+    with get_db_connection() as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM change_log").fetchone()[0]
 
-        try:
-            conn.execute("ALTER TABLE users ADD COLUMN banner_color TEXT")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
 
-        try:
-            conn.execute("ALTER TABLE channel_invites ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP")
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass
+def get_changes_since(user_id, since, limit=SYNC_BATCH_LIMIT):
+    """
+    Изменения во всех личных чатах, группах и каналах пользователя после токена since.
 
+    Возвращает {'changes': [...], 'token': новый токен, 'has_more': bool}. Если
+    изменения после since уже удалены из журнала, ответ без изменений с 'resync': True -
+    клиент перечитывает чаты целиком.
+    """
+    with get_db_connection() as conn:
+        # Конец журнала фиксируется заранее: изменения, записанные во время выборки, попадут в следующую
+        head = conn.execute("SELECT COALESCE(MAX(id), 0) FROM change_log").fetchone()[0]
+        oldest = conn.execute("SELECT MIN(id) FROM change_log").fetchone()[0]
+        if oldest is not None and since < oldest - 1:
+            return {'changes': [], 'token': head, 'has_more': False, 'resync': True}
+        rows = conn.execute("""
+            SELECT l.id, l.kind, l.payload, l.created_at, c.kind as conversation_kind, c.ref_id,
+                   CASE c.kind
+                       WHEN 'group' THEN 'group_' || g.name
+                       WHEN 'channel' THEN 'channel_' || ch.name
+                       WHEN 'dm' THEN CASE WHEN u1.username < u2.username
+                                           THEN u1.username || '_' || u2.username
+                                           ELSE u2.username || '_' || u1.username END
+                   END as room
+            FROM change_log l
+            LEFT JOIN conversations c ON l.conversation_id = c.id
+            LEFT JOIN groups g ON c.kind = 'group' AND g.id = c.ref_id
+            LEFT JOIN channels ch ON c.kind = 'channel' AND ch.id = c.ref_id
+            LEFT JOIN chats dm ON c.kind = 'dm' AND dm.id = c.ref_id
+            LEFT JOIN users u1 ON u1.id = dm.user1_id
+            LEFT JOIN users u2 ON u2.id = dm.user2_id
+            WHERE l.id > ? AND l.id <= ?
+              AND (l.user_id = ? OR l.conversation_id IN (
+                    SELECT cv.id FROM conversations cv JOIN chats x ON cv.kind = 'dm' AND cv.ref_id = x.id
+                    WHERE x.user1_id = ? OR x.user2_id = ?
+                    UNION
+                    SELECT cv.id FROM conversations cv JOIN group_members gm ON cv.kind = 'group' AND cv.ref_id = gm.group_id
+                    WHERE gm.user_id = ?
+                    UNION
+                    SELECT cv.id FROM conversations cv JOIN channel_members cm ON cv.kind = 'channel' AND cv.ref_id = cm.channel_id
+                    WHERE cm.user_id = ?
+              ))
+            ORDER BY l.id
+            LIMIT ?
+        """, (since, head, user_id, user_id, user_id, user_id, user_id, limit)).fetchall()
+    has_more = len(rows) == limit
+    # Если всё прочитано, токен сдвигается на конец журнала, чтобы не сканировать чужие изменения повторно
+    token = rows[-1]['id'] if has_more else max(head, since)
+    changes = []
+    for row in rows:
+        change = dict(row)
+        change['payload'] = json.loads(change['payload'])
+        if change['room']:
+            change['room'] = change['room'].lower()
+        changes.append(change)
+    return {'changes': changes, 'token': token, 'has_more': has_more}
 
 
-        # Обновить usernames на lower
-        conn.execute("UPDATE users SET username = LOWER(username)")
-        conn.commit()
-        print("Updated usernames to lower")
+def _delete_conversation(conn, kind, ref_id):
+    conversation_id = _find_conversation_id(conn, kind, ref_id)
+    after_commit(lambda: history_buffer.invalidate((kind, ref_id)))
+    if conversation_id is not None:
+        conn.execute("DELETE FROM conversation_messages WHERE conversation_id = ?", (conversation_id,))
+        conn.execute("DELETE FROM conversation_summary WHERE conversation_id = ?", (conversation_id,))
+        conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# === Кэш частых чтений: строки по имени, участники и роли каналов, закреплённые сообщения ===
+# Функции с @query_cache.cached выполняются в потоке вызывающего (не выносятся в пул),
+# в пул под gevent выносится только загрузка из базы при промахе.
 
-def verify_password(password, hashed):
-    return hash_password(password) == hashed
+query_cache = create_query_cache()
 
-@contextmanager
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
 
-def get_user_by_username(username):
+def _invalidate_tags(*tags):
+    # Сброс после фиксации, как и для составов бесед
+    after_commit(lambda: query_cache.invalidate(*tags))
+
+
+def _invalidate_name(kind, name=None, id=None):
+    """Сбросить строку по имени и/или по id (например, после переименования)"""
+    _invalidate_tags(*([f'{kind}-name:{name}'] if name is not None else []),
+                     *([f'{kind}:{id}'] if id is not None else []))
+
+
+def _name_tags(kind):
+    # Строка по имени помечается именем (его создание сбрасывает отсутствие) и id (правка, переименование)
+    return lambda row, name: [f'{kind}-name:{name}'] + ([f"{kind}:{row['id']}"] if row else [])
+
+
+def _row_by_name(table, column, name, columns='*'):
     with get_db_connection() as conn:
-        user = conn.execute("SELECT * FROM users WHERE username = ?", (username.lower(),)).fetchone()
-    print(f"get_user_by_username({username}) -> {dict(user) if user else None}")
-    return user
+        row = conn.execute(f"SELECT {columns} FROM {table} WHERE {column} = ?", (name,)).fetchone()
+        return dict(row) if row else None
 
-def create_user(username, password, city='', bio_short=''):
+
+# Профиль пользователя без хеша пароля: строка попадает в общий кэш в Redis
+_USER_COLUMNS = ("id, username, registration_date, city, bio_short, country, languages, bio_full, "
+                 "hobbies, avatar, status, banner_photo, banner_color")
+
+
+@query_cache.cached('user', tags=_name_tags('user'), l1=False)
+@offloaded
+def _user_by_name(username):
+    return _row_by_name('users', 'username', username, _USER_COLUMNS)
+
+
+def get_user_by_username(username):
+    return _user_by_name(username.lower())
+
+
+def get_user_credentials(username):
+    """id, имя и хеш пароля для входа и смены пароля (всегда из базы, мимо кэша)"""
+    return _row_by_name('users', 'username', username.lower(), 'id, username, password')
+
+@db_write
+def create_user(conn, username, password, city='', bio_short=''):
     hashed = hash_password(password)
-    with get_db_connection() as conn:
-        conn.execute('INSERT INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)', (username, hashed, city, bio_short))
-        conn.commit()
+    conn.execute('INSERT INTO users (username, password, city, bio_short) VALUES (?, ?, ?, ?)', (username, hashed, city, bio_short))
+    _invalidate_name('user', username.lower())
+
+
+def _invalidate_author_posts(conn, user_id):
+    # Имя и аватар автора входят в закэшированные данные его постов в ленте
+    if redis_config.feed_cache is not None:
+        _invalidate_feeds(post_ids=[row['id'] for row in conn.execute("SELECT id FROM posts WHERE user_id = ?", (user_id,))])
+
+
+@db_write
+def set_user_avatar(conn, user_id, avatar):
+    """Сменить (или убрать, avatar=None) аватар пользователя"""
+    conn.execute("UPDATE users SET avatar = ? WHERE id = ?", (avatar, user_id))
+    _invalidate_name('user', id=user_id)
+    _invalidate_author_posts(conn, user_id)
+    row = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
+    if row:
+        username = row['username']
+        after_commit(lambda: history_buffer.update_all({'sender_avatar': avatar}, lambda r: r['sender'] == username))
+
+
+@db_write
+def update_user(conn, user_id, **fields):
+    """Обновить поля профиля пользователя (username, password, city, banner_photo, ...)"""
+    if not fields:
+        return
+    conn.execute(f"UPDATE users SET {', '.join(f'{column} = ?' for column in fields)} WHERE id = ?",
+                 (*fields.values(), user_id))
+    _invalidate_name('user', id=user_id)
+    if 'username' in fields:
+        # Новое имя могло быть закэшировано как отсутствующее
+        _invalidate_name('user', fields['username'].lower())
+        _invalidate_author_posts(conn, user_id)
+        _invalidate_user_rosters(conn, user_id)
 
 def get_active_users(exclude_user_id=None):
     query = "SELECT id, username FROM users"
@@ -535,27 +729,20 @@ def get_active_users(exclude_user_id=None):
 
 
 def get_user_chats(user_id):
-    print(f"DEBUG: get_user_chats called with user_id: {user_id}")
     with get_db_connection() as conn:
-        user = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
-        print(f"DEBUG: user fetchone result: {user}")
-        if user is None:
-            print(f"DEBUG: User with id {user_id} not found, returning empty list")
-            return []
-        my_username = user['username']
+        # Личные чаты с сообщениями - это строки сводки пользователя с kind = 'dm'
         chats = conn.execute('''
-            SELECT DISTINCT u.username, u.id, u.avatar,
-                (SELECT m.message FROM messages m WHERE m.chat_id = c.id ORDER BY m.timestamp DESC LIMIT 1) as last_message,
-                (SELECT m.timestamp FROM messages m WHERE m.chat_id = c.id ORDER BY m.timestamp DESC LIMIT 1) as last_time,
-                (SELECT COUNT(*) FROM messages m WHERE m.chat_id = c.id AND m.sender != ? AND m.status != 'read') as unread_count
-            FROM users u
-            JOIN chats c ON (c.user1_id = u.id OR c.user2_id = u.id)
-            WHERE (c.user1_id = ? OR c.user2_id = ?) AND u.id != ?
-            AND EXISTS (SELECT 1 FROM messages m WHERE m.chat_id = c.id)
-        ''', (my_username, user_id, user_id, user_id)).fetchall()
+            SELECT u.username, u.id, u.avatar, s.last_message, s.last_time, s.unread_count
+            FROM conversation_summary s
+            JOIN conversations cv ON cv.id = s.conversation_id AND cv.kind = 'dm'
+            JOIN chats c ON c.id = cv.ref_id
+            JOIN users u ON u.id = CASE WHEN c.user1_id = s.user_id THEN c.user2_id ELSE c.user1_id END
+            WHERE s.user_id = ? AND u.id != s.user_id
+        ''', (user_id,)).fetchall()
     return [dict(chat) for chat in chats]
 
-def get_or_create_chat(user1_id, user2_id):
+def find_chat(user1_id, user2_id):
+    """id личного чата двух пользователей или None (чат не создаётся)"""
     if user1_id > user2_id:
         user1_id, user2_id = user2_id, user1_id
     with get_db_connection() as conn:
@@ -563,189 +750,343 @@ def get_or_create_chat(user1_id, user2_id):
             'SELECT id FROM chats WHERE user1_id = ? AND user2_id = ?',
             (user1_id, user2_id)
         ).fetchone()
-        if chat:
-            return chat['id']
-        conn.execute(
-            'INSERT INTO chats (user1_id, user2_id) VALUES (?, ?)',
-            (user1_id, user2_id)
-        )
-        conn.commit()
-        return conn.execute('SELECT last_insert_rowid() AS id').fetchone()['id']
-
-def get_messages(chat_id, offset=0, limit=50):
-    with get_db_connection() as conn:
-        messages = conn.execute("""
-            SELECT m.id, m.sender, m.message, m.timestamp, m.status, m.parent_message_id, m.edited, m.message_type, m.audio_path,
-                   p.sender as parent_sender, p.message as parent_message,
-                   u.avatar as sender_avatar
-            FROM messages m
-            LEFT JOIN messages p ON m.parent_message_id = p.id
-            LEFT JOIN users u ON m.sender = u.username
-            WHERE m.chat_id = ? ORDER BY m.timestamp
-            LIMIT ? OFFSET ?
-        """, (chat_id, limit, offset)).fetchall()
-    print(f"Getting messages for chat {chat_id}: {len(messages)} messages")
-    return [dict(m) for m in messages]
+    return chat['id'] if chat else None
 
-def save_message(chat_id, sender, message, parent_message_id=None, message_type='text', audio_path=None):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO messages (chat_id, sender, message, parent_message_id, message_type, audio_path)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (chat_id, sender, message, parent_message_id, message_type, audio_path))
-        conn.commit()
-        return cursor.lastrowid
-
-def mark_message_as_delivered(msg_id):
-    with get_db_connection() as conn:
-        conn.execute('UPDATE messages SET status = "delivered" WHERE id = ?', (msg_id,))
-        conn.commit()
 
-def mark_message_as_read(msg_id):
-    with get_db_connection() as conn:
-        conn.execute('UPDATE messages SET status = "read" WHERE id = ?', (msg_id,))
-        conn.commit()
+def get_or_create_chat(user1_id, user2_id):
+    if user1_id > user2_id:
+        user1_id, user2_id = user2_id, user1_id
+    return find_chat(user1_id, user2_id) or _create_chat(user1_id, user2_id)
+
+
+@db_write
+def _create_chat(conn, user1_id, user2_id):
+    cursor = conn.execute(
+        'INSERT OR IGNORE INTO chats (user1_id, user2_id) VALUES (?, ?)',
+        (user1_id, user2_id)
+    )
+    # Чат мог быть создан параллельным запросом - берём существующий id
+    chat_id = conn.execute(
+        'SELECT id FROM chats WHERE user1_id = ? AND user2_id = ?',
+        (user1_id, user2_id)
+    ).fetchone()['id']
+    _ensure_conversation(conn, 'dm', chat_id)
+    if cursor.rowcount:
+        for user_id in (user1_id, user2_id):
+            _log_membership(conn, 'dm', chat_id, user_id, 'added')
+        _invalidate_roster('dm', chat_id)
+    return chat_id
+
+def get_messages(chat_id, offset=0, limit=50, before_id=None, after_id=None):
+    messages = _get_conversation_messages('dm', chat_id, offset, limit, before_id, after_id)
+    return messages
+
+@db_write
+def save_message(conn, chat_id, sender, message, parent_message_id=None, message_type='text', audio_path=None):
+    return _insert_conversation_message(conn, 'dm', chat_id, sender, message, parent_message_id, message_type, audio_path)
+
+@db_write
+def mark_message_as_delivered(conn, msg_id):
+    conn.execute("UPDATE conversation_messages SET status = 'delivered' WHERE id = ?", (msg_id,))
+    _log_message_change(conn, 'delivered', msg_id)
+    _history_on_change(conn, msg_id, 'delivered')
+
+@db_write
+def mark_message_as_read(conn, msg_id, reader=None):
+    return _mark_message_read(conn, msg_id, reader)
 
 def get_unread_messages(recipient_username, sender_username):
     with get_db_connection() as conn:
         return [
             dict(row) for row in conn.execute('''
-                SELECT m.id, m.sender FROM messages m
-                JOIN chats c ON m.chat_id = c.id
-                JOIN users u1 ON c.user1_id = u1.id
-                JOIN users u2 ON c.user2_id = u2.id
-                WHERE m.status != 'read'
-                  AND m.sender = ?
-                  AND (u1.username = ? OR u2.username = ?)
-            ''', (sender_username, recipient_username, recipient_username)).fetchall()
+                SELECT m.id, m.sender FROM conversation_messages m
+                JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'dm'
+                JOIN chats c ON cv.ref_id = c.id
+                JOIN users r ON r.username = ? AND r.id IN (c.user1_id, c.user2_id)
+                WHERE m.sender = ?
+                  AND m.id > COALESCE((SELECT last_read_id FROM read_cursor
+                                       WHERE user_id = r.id AND conversation_id = cv.id), 0)
+            ''', (recipient_username, sender_username)).fetchall()
         ]
 
 
 
 
-def create_group(name, creator, description=None):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO groups (name, creator, description) VALUES (?, ?, ?)", (name, creator, description))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def create_group(conn, name, creator, description=None):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO groups (name, creator, description) VALUES (?, ?, ?)", (name, creator, description))
+    _ensure_conversation(conn, 'group', cursor.lastrowid)
+    _invalidate_name('group', name)
+    return cursor.lastrowid
 
 
+@query_cache.cached('group', tags=_name_tags('group'))
+@offloaded
 def get_group_by_name(name):
-    with get_db_connection() as conn:
-        group = conn.execute("SELECT * FROM groups WHERE name = ?", (name,)).fetchone()
-        return group
+    return _row_by_name('groups', 'name', name)
 
 
 def get_groups_for_user(user_id):
-    print(f"get_groups_for_user called for user_id: {user_id}")
     try:
         with get_db_connection() as conn:
-            user = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
-            if not user:
-                print(f"No user found for id {user_id}")
-                return []
-            my_username = user['username']
-            print(f"Username: {my_username}")
             groups = conn.execute("""
-                SELECT g.name,
-                    (SELECT gm2.message FROM group_messages gm2 WHERE gm2.group_id = g.id ORDER BY gm2.timestamp DESC LIMIT 1) as last_message,
-                    (SELECT gm2.timestamp FROM group_messages gm2 WHERE gm2.group_id = g.id ORDER BY gm2.timestamp DESC LIMIT 1) as last_time,
-                    (SELECT COUNT(*) FROM group_messages gm2 WHERE gm2.group_id = g.id AND gm2.sender != ? AND gm2.is_read = 0) as unread_count
-                FROM groups g
-                JOIN group_members gm ON g.id = gm.group_id
+                SELECT g.name, s.last_message, s.last_time, COALESCE(s.unread_count, 0) as unread_count
+                FROM group_members gm
+                JOIN groups g ON g.id = gm.group_id
+                LEFT JOIN conversations cv ON cv.kind = 'group' AND cv.ref_id = g.id
+                LEFT JOIN conversation_summary s ON s.user_id = gm.user_id AND s.conversation_id = cv.id
                 WHERE gm.user_id = ?
-            """, (my_username, user_id)).fetchall()
-            print(f"Found groups: {[dict(g) for g in groups]}")
+            """, (user_id,)).fetchall()
         return [dict(g) for g in groups]
-    except Exception as e:
-        print(f"Error in get_groups_for_user: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("Ошибка при загрузке групп пользователя %s", user_id)
         return []
 
 
-def add_user_to_group(group_id, user_id):
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
-        conn.commit()
+@db_write
+def add_user_to_group(conn, group_id, user_id):
+    cursor = conn.execute("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
+    if cursor.rowcount:
+        _rebuild_conversation_summary(conn, 'group', group_id, user_id)
+        _log_membership(conn, 'group', group_id, user_id, 'added')
+        _invalidate_roster('group', group_id)
 
 
-def get_group_messages(group_id, offset=0, limit=50):
-    with get_db_connection() as conn:
-        messages = conn.execute("""
-            SELECT m.id, m.sender, m.message, m.timestamp, m.is_read, m.parent_message_id, m.edited, m.message_type, m.audio_path,
-                   p.sender as parent_sender, p.message as parent_message,
-                   u.avatar as sender_avatar
-            FROM group_messages m
-            LEFT JOIN group_messages p ON m.parent_message_id = p.id
-            LEFT JOIN users u ON m.sender = u.username
-            WHERE m.group_id = ?
-            ORDER BY m.timestamp
-            LIMIT ? OFFSET ?
-        """, (group_id, limit, offset)).fetchall()
-        return [dict(m) for m in messages]
+def get_group_messages(group_id, offset=0, limit=50, before_id=None, after_id=None):
+    return _get_conversation_messages('group', group_id, offset, limit, before_id, after_id)
 
 
-def save_group_message(group_id, sender, message, is_read=False, parent_message_id=None, message_type='text', audio_path=None):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO group_messages (group_id, sender, message, is_read, parent_message_id, message_type, audio_path)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (group_id, sender, message, is_read, parent_message_id, message_type, audio_path))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def save_group_message(conn, group_id, sender, message, is_read=False, parent_message_id=None, message_type='text', audio_path=None):
+    return _insert_conversation_message(conn, 'group', group_id, sender, message, parent_message_id, message_type, audio_path, is_read=is_read)
 
 
-def update_group_message_read(msg_id, is_read=True):
-    with get_db_connection() as conn:
-        conn.execute("UPDATE group_messages SET is_read = ? WHERE id = ?", (is_read, msg_id))
-        conn.commit()
+@db_write
+def update_group_message_read(conn, msg_id, is_read=True, reader=None):
+    # Курсоры прочтения только растут, поэтому снять отметку (is_read=False) нельзя
+    if is_read:
+        return _mark_message_read(conn, msg_id, reader)
 
 
 
-def delete_message(msg_id, is_group=False):
-    table = 'group_messages' if is_group else 'messages'
-    with get_db_connection() as conn:
-        conn.execute(f"DELETE FROM {table} WHERE id = ?", (msg_id,))
-        conn.commit()
+def _delete_message(conn, msg_id, conversation_id, sender=None):
+    _invalidate_tags(f'message:{msg_id}')
+    _summary_on_delete(conn, msg_id)
+    _log_message_change(conn, 'delete', msg_id)
+    _history_on_change(conn, msg_id, 'delete')
+    cursor = conn.execute("DELETE FROM conversation_messages WHERE id = ? AND sender = COALESCE(?, sender)",
+                          (msg_id, sender))
+    _summary_refresh_last(conn, conversation_id)
+    return cursor.rowcount > 0
+
 
+def _message_edited(conn, msg_id, conversation_id, new_message):
+    _invalidate_tags(f'message:{msg_id}')
+    _log_message_change(conn, 'edit', msg_id)
+    _history_on_change(conn, msg_id, 'edit', new_message)
+    _summary_refresh_last(conn, conversation_id)
 
-def save_pinned_message(group_id, msg_id):
+
+@db_write
+def delete_message(conn, msg_id, is_group=False):
+    # id сообщений уникальны во всех беседах, поэтому тип беседы не нужен (is_group оставлен для совместимости)
+    row = conn.execute("SELECT conversation_id FROM conversation_messages WHERE id = ?", (msg_id,)).fetchone()
+    if row is None:
+        return
+    _delete_message(conn, msg_id, row['conversation_id'])
+
+
+@db_write
+def edit_message(conn, msg_id, new_message):
+    conn.execute("UPDATE conversation_messages SET message = ?, edited = 1 WHERE id = ?", (new_message, msg_id))
+    row = conn.execute("SELECT conversation_id FROM conversation_messages WHERE id = ?", (msg_id,)).fetchone()
+    if row:
+        _message_edited(conn, msg_id, row['conversation_id'], new_message)
+
+
+# Сообщение msg_id, принадлежащее беседе (kind, ref_id): поиск по первичному ключу и индексу бесед
+_MESSAGE_IN_CONVERSATION_SQL = """
+    id = :msg_id AND conversation_id = (SELECT id FROM conversations WHERE kind = :kind AND ref_id = :ref_id)
+"""
+
+
+def get_conversation_message(msg_id, kind, ref_id):
+    """Получить одно сообщение беседы по id (None, если его нет или оно из другой беседы)"""
     with get_db_connection() as conn:
-        conn.execute("UPDATE groups SET pinned_msg_id = ? WHERE id = ?", (msg_id, group_id))
-        conn.commit()
+        row = conn.execute(f"""
+            SELECT id, conversation_id, sender, message, timestamp, edited,
+                   parent_message_id, message_type, audio_path
+            FROM conversation_messages WHERE {_MESSAGE_IN_CONVERSATION_SQL}
+        """, {'msg_id': msg_id, 'kind': kind, 'ref_id': ref_id}).fetchone()
+        return dict(row) if row else None
 
 
+@db_write
+def edit_own_message(conn, msg_id, sender, new_message, kind, ref_id):
+    """
+    Изменить сообщение, если оно написано sender в беседе (kind, ref_id).
+    Проверка и изменение - один UPDATE; возвращает True, если сообщение изменено.
+    """
+    cursor = conn.execute(f"""
+        UPDATE conversation_messages SET message = :message, edited = 1
+        WHERE {_MESSAGE_IN_CONVERSATION_SQL} AND sender = :sender
+    """, {'msg_id': msg_id, 'kind': kind, 'ref_id': ref_id, 'sender': sender, 'message': new_message})
+    if cursor.rowcount == 0:
+        return False
+    conversation_id = conn.execute("SELECT conversation_id FROM conversation_messages WHERE id = ?",
+                                   (msg_id,)).fetchone()['conversation_id']
+    _message_edited(conn, msg_id, conversation_id, new_message)
+    return True
+
+
+@db_write
+def delete_own_message(conn, msg_id, sender, kind, ref_id):
+    """Удалить сообщение, если оно написано sender в беседе (kind, ref_id); возвращает True, если удалено"""
+    row = conn.execute(f"""
+        SELECT conversation_id FROM conversation_messages
+        WHERE {_MESSAGE_IN_CONVERSATION_SQL} AND sender = :sender
+    """, {'msg_id': msg_id, 'kind': kind, 'ref_id': ref_id, 'sender': sender}).fetchone()
+    if row is None:
+        return False
+    # Задачи записи выполняются по одной, поэтому строка не может смениться между проверкой и удалением
+    return _delete_message(conn, msg_id, row['conversation_id'], sender)
+
+
+@db_write
+def save_pinned_message(conn, group_id, msg_id):
+    conn.execute("UPDATE groups SET pinned_msg_id = ? WHERE id = ?", (msg_id, group_id))
+    _invalidate_name('group', id=group_id)
+
+
+@query_cache.cached('pinned_message', tags=lambda msg, group_id: [f'group:{group_id}']
+                    + ([f"message:{msg['id']}"] if msg else []))
+@offloaded
 def get_pinned_message(group_id):
     with get_db_connection() as conn:
         row = conn.execute("SELECT pinned_msg_id FROM groups WHERE id = ?", (group_id,)).fetchone()
         if row and row['pinned_msg_id']:
-            msg = conn.execute("SELECT * FROM group_messages WHERE id = ?", (row['pinned_msg_id'],)).fetchone()
+            msg = conn.execute(f"""
+                SELECT m.id, m.sender, m.message, m.timestamp, {_READ_BY_OTHERS_SQL} as is_read,
+                       m.edited, m.parent_message_id, m.message_type, m.audio_path
+                FROM conversation_messages m WHERE m.id = ?
+            """, (row['pinned_msg_id'],)).fetchone()
             return dict(msg) if msg else None
         return None
 
 
-def remove_pinned_message(group_id):
-    with get_db_connection() as conn:
-        conn.execute("UPDATE groups SET pinned_msg_id = NULL WHERE id = ?", (group_id,))
-        conn.commit()
+@db_write
+def remove_pinned_message(conn, group_id):
+    conn.execute("UPDATE groups SET pinned_msg_id = NULL WHERE id = ?", (group_id,))
+    _invalidate_name('group', id=group_id)
 
 
 # === Социальная сеть ===
 
-def follow_user(follower_id, following_id):
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR IGNORE INTO subscriptions (follower_id, following_id) VALUES (?, ?)", (follower_id, following_id))
-        conn.commit()
+# === Лента: посты рассылаются в timeline подписчиков при записи ===
 
+# Посты авторов, у которых подписчиков больше, не рассылаются, а подмешиваются при чтении ленты
+TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
 
-def unfollow_user(follower_id, following_id):
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM subscriptions WHERE follower_id = ? AND following_id = ?", (follower_id, following_id))
-        conn.commit()
+
+def _invalidate_feeds(user_ids=(), post_ids=()):
+    """Сбросить кэш лент пользователей и общих данных постов после фиксации (если кэш ленты включён)"""
+    if redis_config.feed_cache is not None:
+        after_commit(lambda: redis_config.invalidate_feed_cache(user_ids, post_ids))
+
+
+def _invalidate_post_readers(conn, post_id):
+    """Сбросить пост и ленты, в которых он есть (до удаления его строк из timeline)"""
+    if redis_config.feed_cache is not None:
+        readers = [row['user_id'] for row in conn.execute("SELECT user_id FROM timeline WHERE post_id = ?", (post_id,))]
+        _invalidate_feeds(readers, [post_id])
+
+
+def _timeline_is_pull(conn, author_id):
+    return conn.execute("SELECT 1 FROM timeline_pull WHERE user_id = ?", (author_id,)).fetchone() is not None
+
+
+def _timeline_on_post(conn, post_id, author_id):
+    """Новый пост: в ленту автора и (если автор не из больших) в ленты всех подписчиков"""
+    created_at = conn.execute("SELECT created_at FROM posts WHERE id = ?", (post_id,)).fetchone()['created_at']
+    conn.execute("INSERT OR IGNORE INTO timeline (user_id, post_id, created_at) VALUES (?, ?, ?)",
+                 (author_id, post_id, created_at))
+    if not _timeline_is_pull(conn, author_id):
+        conn.execute("""
+            INSERT OR IGNORE INTO timeline (user_id, post_id, created_at)
+            SELECT follower_id, ?, ? FROM subscriptions WHERE following_id = ?
+        """, (post_id, created_at, author_id))
+
+
+def _timeline_on_follow(conn, follower_id, following_id):
+    """Подписка: перенести посты автора в ленту подписчика или перевести автора на подмешивание"""
+    if _timeline_is_pull(conn, following_id):
+        return
+    followers = conn.execute("SELECT COUNT(*) FROM subscriptions WHERE following_id = ?", (following_id,)).fetchone()[0]
+    if followers > TIMELINE_FANOUT_LIMIT:
+        # Уже разосланные посты остаются в лентах, чтение объединяет их с подмешанными без повторов
+        conn.execute("INSERT OR IGNORE INTO timeline_pull (user_id) VALUES (?)", (following_id,))
+        if redis_config.feed_cache is not None:
+            # Закэшированные страницы подписчиков собраны без поколения автора
+            _invalidate_feeds([row['follower_id'] for row in conn.execute(
+                "SELECT follower_id FROM subscriptions WHERE following_id = ?", (following_id,))])
+        return
+    conn.execute("""
+        INSERT OR IGNORE INTO timeline (user_id, post_id, created_at)
+        SELECT ?, id, created_at FROM posts WHERE user_id = ?
+    """, (follower_id, following_id))
+
+
+def _timeline_page(conn, user_id, offset, limit):
+    """id постов страницы ленты: проход по индексу timeline, плюс посты больших авторов, если они есть в подписках"""
+    has_pull = conn.execute("""
+        SELECT 1 FROM subscriptions s JOIN timeline_pull tp ON tp.user_id = s.following_id
+        WHERE s.follower_id = ? LIMIT 1
+    """, (user_id,)).fetchone()
+    if not has_pull:
+        rows = conn.execute("""
+            SELECT post_id FROM timeline WHERE user_id = ?
+            ORDER BY created_at DESC, post_id DESC LIMIT ? OFFSET ?
+        """, (user_id, limit, offset)).fetchall()
+    else:
+        rows = conn.execute("""
+            SELECT post_id FROM (
+                SELECT post_id, created_at FROM timeline WHERE user_id = :user_id
+                UNION
+                SELECT p.id, p.created_at FROM subscriptions s
+                JOIN timeline_pull tp ON tp.user_id = s.following_id
+                JOIN posts p ON p.user_id = s.following_id
+                WHERE s.follower_id = :user_id
+            ) ORDER BY created_at DESC, post_id DESC LIMIT :limit OFFSET :offset
+        """, {'user_id': user_id, 'limit': limit, 'offset': offset}).fetchall()
+    return [row['post_id'] for row in rows]
+
+
+def _feed_pull_authors(conn, user_id):
+    """Большие авторы из подписок: их посты подмешиваются при чтении ленты"""
+    return [row['following_id'] for row in conn.execute("""
+        SELECT s.following_id FROM subscriptions s JOIN timeline_pull tp ON tp.user_id = s.following_id
+        WHERE s.follower_id = ?
+    """, (user_id,)).fetchall()]
+
+
+@db_write
+def follow_user(conn, follower_id, following_id):
+    cursor = conn.execute("INSERT OR IGNORE INTO subscriptions (follower_id, following_id) VALUES (?, ?)", (follower_id, following_id))
+    if cursor.rowcount:
+        _timeline_on_follow(conn, follower_id, following_id)
+        _invalidate_feeds([follower_id])
+
+
+@db_write
+def unfollow_user(conn, follower_id, following_id):
+    cursor = conn.execute("DELETE FROM subscriptions WHERE follower_id = ? AND following_id = ?", (follower_id, following_id))
+    if cursor.rowcount:
+        _invalidate_feeds([follower_id])
+    if follower_id != following_id:  # свои посты всегда остаются в своей ленте
+        conn.execute("""
+            DELETE FROM timeline WHERE user_id = ? AND post_id IN (SELECT id FROM posts WHERE user_id = ?)
+        """, (follower_id, following_id))
 
 
 def is_following(follower_id, following_id):
@@ -763,21 +1104,19 @@ def get_following(user_id):
         return [dict(row) for row in conn.execute("SELECT u.username FROM subscriptions s JOIN users u ON s.following_id = u.id WHERE s.follower_id = ?", (user_id,)).fetchall()]
 
 
-def create_post(user_id, content, image_url=None):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO posts (user_id, content, image_url) VALUES (?, ?, ?)", (user_id, content, image_url))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def create_post(conn, user_id, content, image_url=None):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO posts (user_id, content, image_url) VALUES (?, ?, ?)", (user_id, content, image_url))
+    _timeline_on_post(conn, cursor.lastrowid, user_id)
+    _invalidate_post_readers(conn, cursor.lastrowid)
+    return cursor.lastrowid
 
 
 def get_posts_for_user(user_id):
     with get_db_connection() as conn:
         posts = conn.execute("""
-            SELECT p.*, u.username,
-                   (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as likes_count,
-                   (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comments_count,
-                   (SELECT COUNT(*) FROM reposts WHERE original_post_id = p.id) as reposts_count
+            SELECT p.*, u.username
             FROM posts p
             JOIN users u ON p.user_id = u.id
             WHERE p.user_id = ?
@@ -800,52 +1139,177 @@ def get_posts_for_user(user_id):
         return posts_list
 
 
+def _hydrate_posts(conn, posts, preview_comments=3):
+    """
+    Дополнить посты общими для всех зрителей данными одним запросом на каждый вид данных
+    для всех постов сразу: первые комментарии и реакции по эмодзи.
+    """
+    for post in posts:
+        post.update(comments=[], reactions={})
+    if not posts:
+        return posts
+    by_id = {post['id']: post for post in posts}
+    ids = list(by_id)
+    in_list = ', '.join('?' * len(ids))
+
+    for row in conn.execute(f"""
+        SELECT * FROM (
+            SELECT c.*, u.username,
+                   ROW_NUMBER() OVER (PARTITION BY c.post_id ORDER BY c.created_at, c.id) AS preview_rank
+            FROM comments c JOIN users u ON c.user_id = u.id
+            WHERE c.post_id IN ({in_list}) AND c.parent_comment_id IS NULL
+        ) WHERE preview_rank <= ? ORDER BY post_id, preview_rank
+    """, (*ids, preview_comments)).fetchall():
+        comment = dict(row)
+        del comment['preview_rank']
+        by_id[comment['post_id']]['comments'].append(comment)
+
+    for row in conn.execute(f"""
+        SELECT r.post_id, r.emoji, r.user_id, u.username FROM reactions r
+        JOIN users u ON r.user_id = u.id
+        WHERE r.post_id IN ({in_list})
+        ORDER BY r.created_at ASC
+    """, ids).fetchall():
+        by_id[row['post_id']]['reactions'].setdefault(row['emoji'], []).append(
+            {'username': row['username'], 'user_id': row['user_id']})
+    return posts
+
+
+def _viewer_flags(conn, user_id, post_ids):
+    """Лайки и репосты зрителя среди постов одним запросом: {post_id: {'is_liked', 'is_reposted'}}"""
+    flags = {post_id: {'is_liked': False, 'is_reposted': False} for post_id in post_ids}
+    if flags:
+        in_list = ', '.join('?' * len(flags))
+        for row in conn.execute(f"""
+            SELECT 'is_liked' AS flag, post_id FROM likes WHERE user_id = ? AND post_id IN ({in_list})
+            UNION ALL
+            SELECT 'is_reposted', original_post_id FROM reposts WHERE user_id = ? AND original_post_id IN ({in_list})
+        """, (user_id, *flags, user_id, *flags)).fetchall():
+            flags[row['post_id']][row['flag']] = True
+    return flags
+
+
+def _apply_viewer_flags(posts, user_id, flags):
+    # Реакция зрителя видна по общему списку реакций поста
+    for post in posts:
+        post.update(flags[post['id']])
+        post['is_reacted'] = any(r['user_id'] == user_id for users in post['reactions'].values() for r in users)
+    return posts
+
+
+def _load_feed_posts(conn, post_ids):
+    """Посты с автором, аватаром, первыми комментариями и реакциями: {id: пост}"""
+    if not post_ids:
+        return {}
+    posts = [dict(row) for row in conn.execute(f"""
+        SELECT p.*, u.username, u.avatar
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        WHERE p.id IN ({', '.join('?' * len(post_ids))})
+    """, list(post_ids)).fetchall()]
+    return {post['id']: post for post in _hydrate_posts(conn, posts)}
+
+
 def get_feed(user_id, offset=0, limit=10):
+    """Страница ленты со всем, что нужно для отображения постов (автор, аватар, комментарии, реакции, отметки)"""
     try:
         with get_db_connection() as conn:
-            posts = conn.execute("""
-                SELECT p.*, u.username,
-                       (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as likes_count,
-                       (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comments_count,
-                       (SELECT COUNT(*) FROM reposts WHERE original_post_id = p.id) as reposts_count
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.user_id IN (SELECT following_id FROM subscriptions WHERE follower_id = ?) OR p.user_id = ?
-                ORDER BY p.created_at DESC
-                LIMIT ? OFFSET ?
-            """, (user_id, user_id, limit, offset)).fetchall()
-            posts_list = []
-            for post in posts:
-                post_dict = dict(post)
-                # Добавить реакции для каждого поста
-                reactions = get_reactions_for_post(post['id'])
-                reactions_grouped = {}
-                for r in reactions:
-                    emoji = r['emoji']
-                    if emoji not in reactions_grouped:
-                        reactions_grouped[emoji] = []
-                    reactions_grouped[emoji].append({'username': r['username'], 'user_id': r['user_id']})
-                post_dict['reactions'] = reactions_grouped
-                post_dict['is_reacted'] = is_reacted(user_id, post['id'])
-                posts_list.append(post_dict)
-            return posts_list
-    except Exception as e:
-        print(f"Error in get_feed for user_id {user_id}: {e}")
-        import traceback
-        traceback.print_exc()
+            ids = _timeline_page(conn, user_id, offset, limit)
+            by_id = _load_feed_posts(conn, ids)
+            posts = [by_id[post_id] for post_id in ids if post_id in by_id]
+            return _apply_viewer_flags(posts, user_id, _viewer_flags(conn, user_id, list(by_id)))
+    except Exception:
+        log.exception("Ошибка при загрузке ленты пользователя %s", user_id)
         return []
 
 
-def like_post(user_id, post_id):
+# Части ленты для кэша: каждая функция - отдельный вынос в пул под gevent
+
+def get_feed_page_ids(user_id, offset=0, limit=10):
+    with get_db_connection() as conn:
+        return _timeline_page(conn, user_id, offset, limit)
+
+
+def get_feed_pull_authors(user_id):
     with get_db_connection() as conn:
-        conn.execute("INSERT OR IGNORE INTO likes (user_id, post_id) VALUES (?, ?)", (user_id, post_id))
-        conn.commit()
+        return _feed_pull_authors(conn, user_id)
 
 
-def unlike_post(user_id, post_id):
+def get_feed_posts(post_ids):
     with get_db_connection() as conn:
-        conn.execute("DELETE FROM likes WHERE user_id = ? AND post_id = ?", (user_id, post_id))
-        conn.commit()
+        return _load_feed_posts(conn, post_ids)
+
+
+def get_feed_viewer_flags(user_id, post_ids):
+    with get_db_connection() as conn:
+        return _viewer_flags(conn, user_id, post_ids)
+
+
+def get_feed_cached(user_id, offset=0, limit=10):
+    """
+    get_feed через кэш ленты в Redis, если он включён: список id страницы и общие данные
+    постов берутся из кэша, отметки зрителя - всегда из базы.
+
+    Выполняется в потоке запроса (не выносится в пул): под gevent сокеты Redis нельзя
+    использовать из других потоков, запросы к базе выносятся как обычно.
+    """
+    cache = redis_config.feed_cache
+    if cache is None:
+        return get_feed(user_id, offset, limit)
+    try:
+        cache.flush()
+        ids = cache.page(user_id, offset, limit, lambda: get_feed_page_ids(user_id, offset, limit),
+                         lambda: get_feed_pull_authors(user_id))
+        by_id = cache.posts(ids, get_feed_posts)
+        posts = [by_id[post_id] for post_id in ids if post_id in by_id]
+        return _apply_viewer_flags(posts, user_id, get_feed_viewer_flags(user_id, list(by_id)))
+    except Exception:
+        log.exception("Ошибка при загрузке ленты пользователя %s", user_id)
+        return []
+
+
+# Счётчики в posts меняются в той же транзакции, что и сама запись (лайк, комментарий, репост)
+_POST_COUNTERS_SQL = {
+    'likes_count': "SELECT COUNT(*) FROM likes WHERE post_id = posts.id",
+    'comments_count': "SELECT COUNT(*) FROM comments WHERE post_id = posts.id",
+    'reposts_count': "SELECT COUNT(*) FROM reposts WHERE original_post_id = posts.id",
+}
+
+
+def _bump_post_counter(conn, post_id, column, delta):
+    conn.execute(f"UPDATE posts SET {column} = MAX({column} + ?, 0) WHERE id = ?", (delta, post_id))
+    _invalidate_feeds(post_ids=[post_id])
+
+
+@db_write
+def reconcile_post_counters(conn, after_id=0, limit=1000):
+    """
+    Пересчитать счётчики постов с id > after_id (не больше limit постов за вызов).
+    Возвращает (число исправленных постов, последний проверенный id или None, если посты кончились).
+    """
+    last = conn.execute("SELECT MAX(id) FROM (SELECT id FROM posts WHERE id > ? ORDER BY id LIMIT ?)",
+                        (after_id, limit)).fetchone()[0]
+    if last is None:
+        return 0, None
+    cursor = conn.execute(f"""
+        UPDATE posts SET {', '.join(f'{column} = ({sql})' for column, sql in _POST_COUNTERS_SQL.items())}
+        WHERE id > ? AND id <= ? AND ({' OR '.join(f'{column} != ({sql})' for column, sql in _POST_COUNTERS_SQL.items())})
+    """, (after_id, last))
+    return cursor.rowcount, last
+
+
+@db_write
+def like_post(conn, user_id, post_id):
+    cursor = conn.execute("INSERT OR IGNORE INTO likes (user_id, post_id) VALUES (?, ?)", (user_id, post_id))
+    if cursor.rowcount:
+        _bump_post_counter(conn, post_id, 'likes_count', 1)
+
+
+@db_write
+def unlike_post(conn, user_id, post_id):
+    cursor = conn.execute("DELETE FROM likes WHERE user_id = ? AND post_id = ?", (user_id, post_id))
+    if cursor.rowcount:
+        _bump_post_counter(conn, post_id, 'likes_count', -1)
 
 
 def is_liked(user_id, post_id):
@@ -853,12 +1317,12 @@ def is_liked(user_id, post_id):
         return conn.execute("SELECT 1 FROM likes WHERE user_id = ? AND post_id = ?", (user_id, post_id)).fetchone() is not None
 
 
-def add_comment(user_id, post_id, content):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO comments (user_id, post_id, content) VALUES (?, ?, ?)", (user_id, post_id, content))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def add_comment(conn, user_id, post_id, content):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO comments (user_id, post_id, content) VALUES (?, ?, ?)", (user_id, post_id, content))
+    _bump_post_counter(conn, post_id, 'comments_count', 1)
+    return cursor.lastrowid
 
 
 def get_comments_for_post(post_id):
@@ -870,12 +1334,11 @@ def get_comments_for_post(post_id):
             ORDER BY c.created_at ASC
         """, (post_id,)).fetchall()]
 
-def add_profile_comment(user_id, profile_user_id, content):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO profile_comments (user_id, profile_user_id, content) VALUES (?, ?, ?)", (user_id, profile_user_id, content))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def add_profile_comment(conn, user_id, profile_user_id, content):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO profile_comments (user_id, profile_user_id, content) VALUES (?, ?, ?)", (user_id, profile_user_id, content))
+    return cursor.lastrowid
 
 def get_profile_comments_for_user(profile_user_id):
     with get_db_connection() as conn:
@@ -895,22 +1358,22 @@ def get_replies_for_comment(comment_id):
             ORDER BY c.created_at ASC
         """, (comment_id,)).fetchall()]
 
-def add_reply(user_id, post_id, parent_comment_id, content):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO comments (user_id, post_id, parent_comment_id, content) VALUES (?, ?, ?, ?)", (user_id, post_id, parent_comment_id, content))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def add_reply(conn, user_id, post_id, parent_comment_id, content):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO comments (user_id, post_id, parent_comment_id, content) VALUES (?, ?, ?, ?)", (user_id, post_id, parent_comment_id, content))
+    _bump_post_counter(conn, post_id, 'comments_count', 1)
+    return cursor.lastrowid
 
-def add_reaction(user_id, post_id, emoji):
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR REPLACE INTO reactions (user_id, post_id, emoji) VALUES (?, ?, ?)", (user_id, post_id, emoji))
-        conn.commit()
+@db_write
+def add_reaction(conn, user_id, post_id, emoji):
+    conn.execute("INSERT OR REPLACE INTO reactions (user_id, post_id, emoji) VALUES (?, ?, ?)", (user_id, post_id, emoji))
+    _invalidate_feeds(post_ids=[post_id])
 
-def remove_reaction(user_id, post_id):
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM reactions WHERE user_id = ? AND post_id = ?", (user_id, post_id))
-        conn.commit()
+@db_write
+def remove_reaction(conn, user_id, post_id):
+    if conn.execute("DELETE FROM reactions WHERE user_id = ? AND post_id = ?", (user_id, post_id)).rowcount:
+        _invalidate_feeds(post_ids=[post_id])
 
 def get_reactions_for_post(post_id):
     with get_db_connection() as conn:
@@ -925,15 +1388,13 @@ def is_reacted(user_id, post_id):
     with get_db_connection() as conn:
         return conn.execute("SELECT emoji FROM reactions WHERE user_id = ? AND post_id = ?", (user_id, post_id)).fetchone() is not None
 
-def pin_post(user_id, post_id):
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR IGNORE INTO pinned_posts (user_id, post_id) VALUES (?, ?)", (user_id, post_id))
-        conn.commit()
+@db_write
+def pin_post(conn, user_id, post_id):
+    conn.execute("INSERT OR IGNORE INTO pinned_posts (user_id, post_id) VALUES (?, ?)", (user_id, post_id))
 
-def unpin_post(user_id, post_id):
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM pinned_posts WHERE user_id = ? AND post_id = ?", (user_id, post_id))
-        conn.commit()
+@db_write
+def unpin_post(conn, user_id, post_id):
+    conn.execute("DELETE FROM pinned_posts WHERE user_id = ? AND post_id = ?", (user_id, post_id))
 
 def is_pinned(user_id, post_id):
     with get_db_connection() as conn:
@@ -950,16 +1411,18 @@ def get_pinned_posts(user_id):
         """, (user_id,)).fetchall()]
 
 
-def repost(user_id, original_post_id):
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR IGNORE INTO reposts (user_id, original_post_id) VALUES (?, ?)", (user_id, original_post_id))
-        conn.commit()
+@db_write
+def repost(conn, user_id, original_post_id):
+    cursor = conn.execute("INSERT OR IGNORE INTO reposts (user_id, original_post_id) VALUES (?, ?)", (user_id, original_post_id))
+    if cursor.rowcount:
+        _bump_post_counter(conn, original_post_id, 'reposts_count', 1)
 
 
-def unrepost(user_id, original_post_id):
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM reposts WHERE user_id = ? AND original_post_id = ?", (user_id, original_post_id))
-        conn.commit()
+@db_write
+def unrepost(conn, user_id, original_post_id):
+    cursor = conn.execute("DELETE FROM reposts WHERE user_id = ? AND original_post_id = ?", (user_id, original_post_id))
+    if cursor.rowcount:
+        _bump_post_counter(conn, original_post_id, 'reposts_count', -1)
 
 
 def is_reposted(user_id, post_id):
@@ -970,10 +1433,7 @@ def is_reposted(user_id, post_id):
 def get_reposts_for_user(user_id):
     with get_db_connection() as conn:
         reposts = conn.execute("""
-            SELECT p.*, u.username,
-                   (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as likes_count,
-                   (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comments_count,
-                   (SELECT COUNT(*) FROM reposts WHERE original_post_id = p.id) as reposts_count
+            SELECT p.*, u.username
             FROM reposts r
             JOIN posts p ON r.original_post_id = p.id
             JOIN users u ON p.user_id = u.id
@@ -997,63 +1457,77 @@ def get_reposts_for_user(user_id):
         return reposts_list
 
 
-def edit_post(post_id, user_id, content=None, image_url=None):
-    with get_db_connection() as conn:
-        # Проверить, что пост принадлежит пользователю
-        post = conn.execute("SELECT user_id FROM posts WHERE id = ?", (post_id,)).fetchone()
-        if not post or post['user_id'] != user_id:
-            raise ValueError("Пост не найден или нет доступа")
-
-        # Обновить пост
-        update_fields = []
-        params = []
-        if content is not None:
-            update_fields.append("content = ?")
-            params.append(content)
-        if image_url is not None:
-            update_fields.append("image_url = ?")
-            params.append(image_url)
-        if update_fields:
-            params.append(post_id)
-            conn.execute(f"UPDATE posts SET {', '.join(update_fields)} WHERE id = ?", params)
-            conn.commit()
-
-
-def delete_post(post_id, user_id):
-    with get_db_connection() as conn:
-        # Проверить, что пост принадлежит пользователю
-        post = conn.execute("SELECT user_id, image_url FROM posts WHERE id = ?", (post_id,)).fetchone()
-        if not post or post['user_id'] != user_id:
-            raise ValueError("Пост не найден или нет доступа")
-
-        # Удалить файл изображения, если есть
-        if post['image_url']:
-            import os
-            image_path = os.path.join(os.path.dirname(__file__), 'uploads', post['image_url'])
-            if os.path.exists(image_path):
-                os.remove(image_path)
-
-        # Удалить пост
-        conn.execute("DELETE FROM likes WHERE post_id = ?", (post_id,))
-        conn.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
-        conn.execute("DELETE FROM reposts WHERE original_post_id = ?", (post_id,))
-        conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-        conn.commit()
-
-
-def delete_chat(chat_id):
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-        conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-        conn.commit()
+@db_write
+def edit_post(conn, post_id, user_id, content=None, image_url=None):
+    # Проверить, что пост принадлежит пользователю
+    post = conn.execute("SELECT user_id FROM posts WHERE id = ?", (post_id,)).fetchone()
+    if not post or post['user_id'] != user_id:
+        raise ValueError("Пост не найден или нет доступа")
+
+    # Обновить пост
+    update_fields = []
+    params = []
+    if content is not None:
+        update_fields.append("content = ?")
+        params.append(content)
+    if image_url is not None:
+        update_fields.append("image_url = ?")
+        params.append(image_url)
+    if update_fields:
+        params.append(post_id)
+        conn.execute(f"UPDATE posts SET {', '.join(update_fields)} WHERE id = ?", params)
+        # Страницы лент хранят только id постов, правка меняет лишь общие данные поста
+        _invalidate_feeds(post_ids=[post_id])
+
+
+@db_write
+def delete_post(conn, post_id, user_id):
+    # Проверить, что пост принадлежит пользователю
+    post = conn.execute("SELECT user_id, image_url FROM posts WHERE id = ?", (post_id,)).fetchone()
+    if not post or post['user_id'] != user_id:
+        raise ValueError("Пост не найден или нет доступа")
+
+    # Удалить пост
+    conn.execute("DELETE FROM likes WHERE post_id = ?", (post_id,))
+    conn.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
+    conn.execute("DELETE FROM reposts WHERE original_post_id = ?", (post_id,))
+    _invalidate_post_readers(conn, post_id)
+    conn.execute("DELETE FROM timeline WHERE post_id = ?", (post_id,))
+    conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+
+    # Файл изображения удаляется только после фиксации: при откате пост остаётся вместе с картинкой
+    if post['image_url']:
+        image_path = os.path.join(UPLOADS_DIR, post['image_url'])
+        after_commit(lambda: _remove_file(image_path))
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
-def delete_group(group_id):
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM group_messages WHERE group_id = ?", (group_id,))
-        conn.execute("DELETE FROM group_members WHERE group_id = ?", (group_id,))
-        conn.execute("DELETE FROM groups WHERE id = ?", (group_id,))
-        conn.commit()
+@db_write
+def delete_chat(conn, chat_id):
+    chat = conn.execute("SELECT user1_id, user2_id FROM chats WHERE id = ?", (chat_id,)).fetchone()
+    if chat:
+        for user_id in (chat['user1_id'], chat['user2_id']):
+            _log_membership(conn, 'dm', chat_id, user_id, 'removed')
+    _delete_conversation(conn, 'dm', chat_id)
+    conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+    _invalidate_roster('dm', chat_id)
+
+
+@db_write
+def delete_group(conn, group_id):
+    for member in conn.execute("SELECT user_id FROM group_members WHERE group_id = ?", (group_id,)).fetchall():
+        _log_membership(conn, 'group', group_id, member['user_id'], 'removed')
+    _delete_conversation(conn, 'group', group_id)
+    conn.execute("DELETE FROM group_members WHERE group_id = ?", (group_id,))
+    conn.execute("DELETE FROM groups WHERE id = ?", (group_id,))
+    _invalidate_roster('group', group_id)
+    _invalidate_name('group', id=group_id)
 
 
 # === Дополнительная статистика для профиля ===
@@ -1062,13 +1536,10 @@ def get_top_posts(user_id, limit=3):
     """Получить топ постов пользователя по количеству лайков"""
     with get_db_connection() as conn:
         posts = conn.execute("""
-            SELECT p.id, p.content, p.created_at, p.image_url,
-                   COUNT(l.id) as likes_count
+            SELECT p.id, p.content, p.created_at, p.image_url, p.likes_count
             FROM posts p
-            LEFT JOIN likes l ON p.id = l.post_id
             WHERE p.user_id = ?
-            GROUP BY p.id
-            ORDER BY likes_count DESC, p.created_at DESC
+            ORDER BY p.likes_count DESC, p.created_at DESC
             LIMIT ?
         """, (user_id, limit)).fetchall()
         return [dict(post) for post in posts]
@@ -1131,134 +1602,129 @@ def get_posts_with_images_percentage(user_id):
 
 def get_message_by_id(msg_id):
     with get_db_connection() as conn:
-        msg = conn.execute("SELECT sender, message FROM messages WHERE id = ?", (msg_id,)).fetchone()
-        if not msg:
-            msg = conn.execute("SELECT sender, message FROM group_messages WHERE id = ?", (msg_id,)).fetchone()
-        if not msg:
-            msg = conn.execute("SELECT sender, message FROM channel_messages WHERE id = ?", (msg_id,)).fetchone()
-        return msg
+        return conn.execute("SELECT sender, message FROM conversation_messages WHERE id = ?", (msg_id,)).fetchone()
 
 
-def get_channel_messages(channel_id, offset=0, limit=50):
-    with get_db_connection() as conn:
-        messages = conn.execute("""
-            SELECT m.id, m.sender, m.message, m.timestamp, m.is_read, m.parent_message_id, m.edited, m.message_type, m.audio_path,
-                   p.sender as parent_sender, p.message as parent_message,
-                   u.avatar as sender_avatar
-            FROM channel_messages m
-            LEFT JOIN channel_messages p ON m.parent_message_id = p.id
-            LEFT JOIN users u ON m.sender = u.username
-            WHERE m.channel_id = ?
-            ORDER BY m.timestamp
-            LIMIT ? OFFSET ?
-        """, (channel_id, limit, offset)).fetchall()
-        return [dict(m) for m in messages]
+def get_channel_messages(channel_id, offset=0, limit=50, before_id=None, after_id=None):
+    return _get_conversation_messages('channel', channel_id, offset, limit, before_id, after_id)
 
 
-def save_channel_message(channel_id, sender, message, is_read=False, parent_message_id=None, message_type='text', audio_path=None):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO channel_messages (channel_id, sender, message, is_read, parent_message_id, message_type, audio_path)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (channel_id, sender, message, is_read, parent_message_id, message_type, audio_path))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def save_channel_message(conn, channel_id, sender, message, is_read=False, parent_message_id=None, message_type='text', audio_path=None):
+    return _insert_conversation_message(conn, 'channel', channel_id, sender, message, parent_message_id, message_type, audio_path, is_read=is_read)
 
 
-def update_channel_message_read(msg_id, is_read=True):
-    with get_db_connection() as conn:
-        conn.execute("UPDATE channel_messages SET is_read = ? WHERE id = ?", (is_read, msg_id))
-        conn.commit()
+@db_write
+def update_channel_message_read(conn, msg_id, is_read=True, reader=None):
+    # Курсоры прочтения только растут, поэтому снять отметку (is_read=False) нельзя
+    if is_read:
+        return _mark_message_read(conn, msg_id, reader)
 
 
 # === Каналы ===
 
-def create_channel(name, creator, description=None, is_private=False):
-    print(f"create_channel called with name: {repr(name)}, creator: {repr(creator)}, description: {repr(description)}, is_private: {is_private}")
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO channels (name, creator, description, is_private) VALUES (?, ?, ?, ?)", (name, creator, description, is_private))
-        channel_id = cursor.lastrowid
-        print(f"Channel created successfully, channel_id: {channel_id}")
-        # Создать дефолтные роли для канала
-        cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, 'Admin', 'read,write,manage_members,manage_roles,manage_invites')", (channel_id,))
-        admin_role_id = cursor.lastrowid
-        print(f"Admin role id: {admin_role_id}")
-        cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, 'Moderator', 'read,write,manage_members')", (channel_id,))
-        moderator_role_id = cursor.lastrowid
-        cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, 'Member', 'read,write')", (channel_id,))
-        member_role_id = cursor.lastrowid
-        # Добавить создателя как участника с ролью администратора
-        user = conn.execute("SELECT id FROM users WHERE username = ?", (creator.lower(),)).fetchone()
-        print(f"User found: {user}")
-        if user:
-            cursor.execute("INSERT INTO channel_members (channel_id, user_id, role_id) VALUES (?, ?, ?)", (channel_id, user['id'], admin_role_id))
-            print(f"Inserted member: channel_id={channel_id}, user_id={user['id']}, role_id={admin_role_id}")
-        else:
-            print(f"Creator {creator} not found")
-        conn.commit()
-        print(f"Channel setup complete for channel_id: {channel_id}")
-        return channel_id
+@db_write
+def create_channel(conn, name, creator, description=None, is_private=False):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO channels (name, creator, description, is_private) VALUES (?, ?, ?, ?)", (name, creator, description, is_private))
+    channel_id = cursor.lastrowid
+    _ensure_conversation(conn, 'channel', channel_id)
+    _invalidate_name('channel', name)
+    # Создать дефолтные роли для канала
+    cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, 'Admin', 'read,write,manage_members,manage_roles,manage_invites')", (channel_id,))
+    admin_role_id = cursor.lastrowid
+    cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, 'Moderator', 'read,write,manage_members')", (channel_id,))
+    moderator_role_id = cursor.lastrowid
+    cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, 'Member', 'read,write')", (channel_id,))
+    member_role_id = cursor.lastrowid
+    # Добавить создателя как участника с ролью администратора
+    user = conn.execute("SELECT id FROM users WHERE username = ?", (creator.lower(),)).fetchone()
+    if user:
+        cursor.execute("INSERT INTO channel_members (channel_id, user_id, role_id) VALUES (?, ?, ?)", (channel_id, user['id'], admin_role_id))
+        _log_membership(conn, 'channel', channel_id, user['id'], 'added')
+        _invalidate_roster('channel', channel_id)
+    else:
+        log.warning("Канал %r создан без администратора: пользователь %s не найден", name, creator)
+    log.info("Создан канал %r (id %s)", name, channel_id)
+    return channel_id
+
+
+@query_cache.cached('channel', tags=_name_tags('channel'))
+@offloaded
+def _channel_by_name(name):
+    return _row_by_name('channels', 'name', name)
 
 
 def get_channel_by_name(name):
-    print(f"get_channel_by_name called with name: {repr(name)}")
-    print(f"name type: {type(name)}, len: {len(name)}")
-    with get_db_connection() as conn:
-        all_channels = conn.execute("SELECT name FROM channels").fetchall()
-        print(f"All channels in DB: {[repr(row[0]) for row in all_channels]}")
-        channel = conn.execute("SELECT * FROM channels WHERE name = ?", (name,)).fetchone()
-        print(f"SQL Query: SELECT * FROM channels WHERE name = {repr(name)}")
-        print(f"Query returned: {channel}")
-        if not channel:
-            print(f"Channel '{name}' not found in DB")
-            # Попробуем не точное совпадение, сравним
-            for row in all_channels:
-                db_name = row[0]
-                print(f"Comparing '{repr(name)}' with DB '{repr(db_name)}'")
-        else:
-            print(f"Channel found: {dict(channel) if channel else None}")
-        return channel
+    channel = _channel_by_name(name)
+    if not channel:
+        log.debug("Канал %r не найден", name)
+    return channel
+
+
+@db_write
+def update_channel(conn, channel_id, name, description, is_private):
+    conn.execute("UPDATE channels SET name = ?, description = ?, is_private = ? WHERE id = ?",
+                 (name, description, is_private, channel_id))
+    _invalidate_name('channel', id=channel_id)
+    _invalidate_name('channel', name)
 
 
 def get_channels_for_user(user_id):
     with get_db_connection() as conn:
         channels = conn.execute("""
-            SELECT c.name FROM channels c
+            SELECT c.id, c.name FROM channels c
             JOIN channel_members cm ON c.id = cm.channel_id
             WHERE cm.user_id = ?
         """, (user_id,)).fetchall()
-        print(f"get_channels_for_user({user_id}) -> {[dict(c) for c in channels]}")
         return [dict(channel) for channel in channels]
 
 
-def add_user_to_channel(channel_id, user_id, role_id=None):
-    print(f"add_user_to_channel({channel_id}, {user_id}, {role_id})")
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR IGNORE INTO channel_members (channel_id, user_id, role_id) VALUES (?, ?, ?)", (channel_id, user_id, role_id))
-        conn.commit()
-        print(f"Added user {user_id} to channel {channel_id} with role {role_id}")
+@db_write
+def add_user_to_channel(conn, channel_id, user_id, role_id=None):
+    cursor = conn.execute("INSERT OR IGNORE INTO channel_members (channel_id, user_id, role_id) VALUES (?, ?, ?)", (channel_id, user_id, role_id))
+    if cursor.rowcount:
+        _rebuild_conversation_summary(conn, 'channel', channel_id, user_id)
+        _log_membership(conn, 'channel', channel_id, user_id, 'added')
+        _invalidate_roster('channel', channel_id)
 
 
-def remove_user_from_channel(channel_id, user_id):
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM channel_members WHERE channel_id = ? AND user_id = ?", (channel_id, user_id))
-        conn.commit()
+@db_write
+def remove_user_from_channel(conn, channel_id, user_id):
+    cursor = conn.execute("DELETE FROM channel_members WHERE channel_id = ? AND user_id = ?", (channel_id, user_id))
+    if cursor.rowcount:
+        conn.execute("""
+            DELETE FROM conversation_summary WHERE user_id = ?
+              AND conversation_id = (SELECT id FROM conversations WHERE kind = 'channel' AND ref_id = ?)
+        """, (user_id, channel_id))
+        _log_membership(conn, 'channel', channel_id, user_id, 'removed')
+        _invalidate_roster('channel', channel_id)
 
 
-def create_channel_role(channel_id, role_name, permissions):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, ?, ?)", (channel_id, role_name, permissions))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def set_channel_member_role(conn, channel_id, user_id, role_id):
+    conn.execute("UPDATE channel_members SET role_id = ? WHERE channel_id = ? AND user_id = ?", (role_id, channel_id, user_id))
+    _invalidate_tags(f'channel:{channel_id}:members')
+
+
+@db_write
+def create_channel_role(conn, channel_id, role_name, permissions):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO channel_roles (channel_id, role_name, permissions) VALUES (?, ?, ?)", (channel_id, role_name, permissions))
+    return cursor.lastrowid
 
 
+def _channel_member_tags(members, channel_id):
+    # Имена участников меняются при переименовании пользователя
+    return [f'channel:{channel_id}:members'] + [f"user:{member['user_id']}" for member in members]
+
+
+@query_cache.cached('channel_members', tags=_channel_member_tags, l1=False)
+@offloaded
 def get_channel_members(channel_id):
     with get_db_connection() as conn:
         members = conn.execute("""
-            SELECT u.username, cr.role_name FROM channel_members cm
+            SELECT cm.user_id, u.username, cr.role_name FROM channel_members cm
             JOIN users u ON cm.user_id = u.id
             LEFT JOIN channel_roles cr ON cm.role_id = cr.id
             WHERE cm.channel_id = ?
@@ -1266,6 +1732,8 @@ def get_channel_members(channel_id):
         return [dict(member) for member in members]
 
 
+@query_cache.cached('channel_role', tags=lambda role, user_id, channel_id: [f'channel:{channel_id}:members'], l1=False)
+@offloaded
 def get_user_channel_role(user_id, channel_id):
     with get_db_connection() as conn:
         role = conn.execute("""
@@ -1276,59 +1744,52 @@ def get_user_channel_role(user_id, channel_id):
         return role['role_name'] if role else None
 
 
-def create_channel_invite(channel_id, created_by, expires_at=None, max_uses=None):
+@db_write
+def create_channel_invite(conn, channel_id, created_by, expires_at=None, max_uses=None):
     invite_code = str(uuid.uuid4())
-    print(f"DEBUG: Creating invite for channel {channel_id}, expires_at={expires_at}, max_uses={max_uses}")
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO channel_invites (channel_id, invite_code, created_by, expires_at, max_uses) VALUES (?, ?, ?, ?, ?)", (channel_id, invite_code, created_by, expires_at, max_uses))
-        conn.commit()
-        print(f"DEBUG: Invite created with code {invite_code}")
-        return invite_code
-
-
-def use_channel_invite(invite_code, user_id):
-    with get_db_connection() as conn:
-        invite = conn.execute("SELECT * FROM channel_invites WHERE invite_code = ?", (invite_code,)).fetchone()
-        if not invite:
-            return False
-        if invite['expires_at'] and invite['expires_at'] < datetime.now():
-            return False
-        if invite['max_uses'] and invite['uses'] >= invite['max_uses']:
-            return False
-        # Добавить пользователя в канал
-        add_user_to_channel(invite['channel_id'], user_id)
-        # Увеличить счетчик использований
-        conn.execute("UPDATE channel_invites SET uses = uses + 1 WHERE id = ?", (invite['id'],))
-        conn.commit()
-        return True
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO channel_invites (channel_id, invite_code, created_by, expires_at, max_uses) VALUES (?, ?, ?, ?, ?)", (channel_id, invite_code, created_by, expires_at, max_uses))
+    return invite_code
+
+
+@db_write
+def use_channel_invite(conn, invite_code, user_id):
+    invite = conn.execute("SELECT * FROM channel_invites WHERE invite_code = ?", (invite_code,)).fetchone()
+    if not invite:
+        return False
+    if invite['expires_at'] and invite['expires_at'] < datetime.now():
+        return False
+    if invite['max_uses'] and invite['uses'] >= invite['max_uses']:
+        return False
+    # Добавить пользователя в канал
+    add_user_to_channel(invite['channel_id'], user_id)
+    # Увеличить счетчик использований
+    conn.execute("UPDATE channel_invites SET uses = uses + 1 WHERE id = ?", (invite['id'],))
+    return True
 
 
 def get_channel_invites(channel_id):
     with get_db_connection() as conn:
         invites = conn.execute("SELECT * FROM channel_invites WHERE channel_id = ?", (channel_id,)).fetchall()
         invites_list = [dict(invite) for invite in invites]
-        print(f"DEBUG: Loaded {len(invites_list)} invites for channel {channel_id}: {[i['invite_code'] for i in invites_list]}")
         return invites_list
 
 
-def delete_channel_invite(invite_id):
-    with get_db_connection() as conn:
-        # Проверить, что инвайт существует
-        invite = conn.execute("SELECT * FROM channel_invites WHERE id = ?", (invite_id,)).fetchone()
-        if not invite:
-            raise ValueError("Инвайт не найден")
-        # Удалить инвайт
-        conn.execute("DELETE FROM channel_invites WHERE id = ?", (invite_id,))
-        conn.commit()
+@db_write
+def delete_channel_invite(conn, invite_id):
+    # Проверить, что инвайт существует
+    invite = conn.execute("SELECT * FROM channel_invites WHERE id = ?", (invite_id,)).fetchone()
+    if not invite:
+        raise ValueError("Инвайт не найден")
+    # Удалить инвайт
+    conn.execute("DELETE FROM channel_invites WHERE id = ?", (invite_id,))
 
 
-def add_message_comment(message_id, user_id, content):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO message_comments (message_id, user_id, content) VALUES (?, ?, ?)", (message_id, user_id, content))
-        conn.commit()
-        return cursor.lastrowid
+@db_write
+def add_message_comment(conn, message_id, user_id, content):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO message_comments (message_id, user_id, content) VALUES (?, ?, ?)", (message_id, user_id, content))
+    return cursor.lastrowid
 
 
 def get_comments_for_message(message_id):
@@ -1358,102 +1819,49 @@ def search_messages_global(query, user_id, case_sensitive=False, limit=50, offse
         list: Список найденных сообщений с типом и контекстом
     """
     with get_db_connection() as conn:
-        # Подготовить параметры поиска
-        search_pattern = f"%{query}%"
-        search_params = (search_pattern, user_id, user_id, limit, offset)
-        
-        # SQL шаблон для поиска с учетом или без регистра
-        search_column = "message" if case_sensitive else "LOWER(message)"
-        query_condition = f"{search_column} LIKE ?" if case_sensitive else f"LOWER({search_column}) LIKE LOWER(?)"
-        
-        # Поиск по личным сообщениям
-        private_messages_query = f"""
-            SELECT 
+        query_condition = "m.message LIKE :pattern" if case_sensitive else "LOWER(m.message) LIKE LOWER(:pattern)"
+        # Один запрос: беседы пользователя (личные чаты, группы и каналы, где он участник),
+        # их сообщения по индексу (conversation_id, id), сортировка и пагинация в SQL
+        messages = conn.execute(f"""
+            WITH member_conversations(id) AS (
+                SELECT cv.id FROM chats c
+                JOIN conversations cv ON cv.kind = 'dm' AND cv.ref_id = c.id
+                WHERE c.user1_id = :user_id OR c.user2_id = :user_id
+                UNION
+                SELECT cv.id FROM group_members gm
+                JOIN conversations cv ON cv.kind = 'group' AND cv.ref_id = gm.group_id
+                WHERE gm.user_id = :user_id
+                UNION
+                SELECT cv.id FROM channel_members cm
+                JOIN conversations cv ON cv.kind = 'channel' AND cv.ref_id = cm.channel_id
+                WHERE cm.user_id = :user_id
+            )
+            SELECT
                 m.id,
                 m.sender,
                 m.message,
                 m.timestamp,
-                'private' as message_type,
+                CASE cv.kind WHEN 'dm' THEN 'private' ELSE cv.kind END as message_type,
                 c.id as chat_id,
-                CASE 
-                    WHEN c.user1_id = ? THEN (SELECT username FROM users WHERE id = c.user2_id)
+                CASE
+                    WHEN c.user1_id = :user_id THEN (SELECT username FROM users WHERE id = c.user2_id)
                     ELSE (SELECT username FROM users WHERE id = c.user1_id)
-                END as chat_partner
-            FROM messages m
-            JOIN chats c ON m.chat_id = c.id
-            WHERE {query_condition}
-              AND (c.user1_id = ? OR c.user2_id = ?)
-            ORDER BY m.timestamp DESC
-            LIMIT ? OFFSET ?
-        """
-        
-        # Поиск по сообщениям в группах
-        group_messages_query = f"""
-            SELECT 
-                m.id,
-                m.sender,
-                m.message,
-                m.timestamp,
-                'group' as message_type,
+                END as chat_partner,
                 g.id as group_id,
-                g.name as group_name
-            FROM group_messages m
-            JOIN groups g ON m.group_id = g.id
-            JOIN group_members gm ON g.id = gm.group_id
-            WHERE {query_condition}
-              AND gm.user_id = ?
-            ORDER BY m.timestamp DESC
-            LIMIT ? OFFSET ?
-        """
-        
-        # Поиск по сообщениям в каналах
-        channel_messages_query = f"""
-            SELECT 
-                m.id,
-                m.sender,
-                m.message,
-                m.timestamp,
-                'channel' as message_type,
+                g.name as group_name,
                 ch.id as channel_id,
                 ch.name as channel_name
-            FROM channel_messages m
-            JOIN channels ch ON m.channel_id = ch.id
-            JOIN channel_members cm ON ch.id = cm.channel_id
+            FROM member_conversations mc
+            JOIN conversations cv ON cv.id = mc.id
+            JOIN conversation_messages m ON m.conversation_id = mc.id
+            LEFT JOIN chats c ON cv.kind = 'dm' AND c.id = cv.ref_id
+            LEFT JOIN groups g ON cv.kind = 'group' AND g.id = cv.ref_id
+            LEFT JOIN channels ch ON cv.kind = 'channel' AND ch.id = cv.ref_id
             WHERE {query_condition}
-              AND cm.user_id = ?
-            ORDER BY m.timestamp DESC
-            LIMIT ? OFFSET ?
-        """
-        
-        # Выполнить все три запроса
-        private_messages = conn.execute(
-            private_messages_query, 
-            (search_pattern, user_id, user_id, user_id, limit, offset)
-        ).fetchall()
-        
-        group_messages = conn.execute(
-            group_messages_query, 
-            (search_pattern, user_id, limit, offset)
-        ).fetchall()
-        
-        channel_messages = conn.execute(
-            channel_messages_query, 
-            (search_pattern, user_id, limit, offset)
-        ).fetchall()
-        
-        # Объединить результаты и отсортировать по времени
-        all_messages = []
-        for msg in private_messages:
-            all_messages.append(dict(msg))
-        for msg in group_messages:
-            all_messages.append(dict(msg))
-        for msg in channel_messages:
-            all_messages.append(dict(msg))
-        
-        # Сортировать по времени (новые первыми)
-        all_messages.sort(key=lambda x: x['timestamp'], reverse=True)
-        
-        return all_messages[:limit]
+            ORDER BY m.timestamp DESC, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """, {'pattern': f"%{query}%", 'user_id': user_id, 'limit': limit, 'offset': offset}).fetchall()
+        return [dict(msg) for msg in messages]
 
 
 def search_posts_global(query, user_id, case_sensitive=False, limit=50, offset=0):
@@ -1487,9 +1895,9 @@ def search_posts_global(query, user_id, case_sensitive=False, limit=50, offset=0
                 p.created_at,
                 u.username,
                 u.avatar,
-                (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as likes_count,
-                (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comments_count,
-                (SELECT COUNT(*) FROM reposts WHERE original_post_id = p.id) as reposts_count,
+                p.likes_count,
+                p.comments_count,
+                p.reposts_count,
                 (SELECT COUNT(*) FROM reactions WHERE post_id = p.id) as reactions_count
             FROM posts p
             JOIN users u ON p.user_id = u.id
@@ -1578,14 +1986,15 @@ def search_messages_in_chat(chat_partner_username, query, user_id, case_sensitiv
                 m.sender,
                 m.message,
                 m.timestamp,
-                m.status,
+                {_DM_STATUS_SQL} as status,
                 m.parent_message_id,
                 m.edited,
                 m.message_type,
                 m.audio_path
-            FROM messages m
+            FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'dm'
             WHERE {query_condition}
-              AND m.chat_id = ?
+              AND cv.ref_id = ?
             ORDER BY m.timestamp DESC
             LIMIT ? OFFSET ?
         """
@@ -1642,14 +2051,15 @@ def search_messages_in_group(group_name, query, user_id, case_sensitive=False, l
                 m.sender,
                 m.message,
                 m.timestamp,
-                m.is_read,
+                {_READ_BY_OTHERS_SQL} as is_read,
                 m.parent_message_id,
                 m.edited,
                 m.message_type,
                 m.audio_path
-            FROM group_messages m
+            FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'group'
             WHERE {query_condition}
-              AND m.group_id = ?
+              AND cv.ref_id = ?
             ORDER BY m.timestamp DESC
             LIMIT ? OFFSET ?
         """
@@ -1706,14 +2116,15 @@ def search_messages_in_channel(channel_name, query, user_id, case_sensitive=Fals
                 m.sender,
                 m.message,
                 m.timestamp,
-                m.is_read,
+                {_READ_BY_OTHERS_SQL} as is_read,
                 m.parent_message_id,
                 m.edited,
                 m.message_type,
                 m.audio_path
-            FROM channel_messages m
+            FROM conversation_messages m
+            JOIN conversations cv ON m.conversation_id = cv.id AND cv.kind = 'channel'
             WHERE {query_condition}
-              AND m.channel_id = ?
+              AND cv.ref_id = ?
             ORDER BY m.timestamp DESC
             LIMIT ? OFFSET ?
         """
@@ -1753,7 +2164,8 @@ def search_all_content(query, user_id, case_sensitive=False, limit=50, offset=0)
 
 # === Функции для работы с мероприятиями ===
 
-def create_event(title, description, event_date, location, creator_id):
+@db_write
+def create_event(conn, title, description, event_date, location, creator_id):
     """
     Создать новое мероприятие
     
@@ -1767,14 +2179,12 @@ def create_event(title, description, event_date, location, creator_id):
     Returns:
         int: ID созданного мероприятия
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO events (title, description, event_date, location, creator_id)
-            VALUES (?, ?, ?, ?, ?)
-        """, (title, description, event_date, location, creator_id))
-        conn.commit()
-        return cursor.lastrowid
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO events (title, description, event_date, location, creator_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, (title, description, event_date, location, creator_id))
+    return cursor.lastrowid
 
 
 def get_event_by_id(event_id):
@@ -1842,7 +2252,8 @@ def get_events_created_by_user(user_id):
         return [dict(event) for event in events]
 
 
-def add_event_participant(event_id, user_id, status='invited'):
+@db_write
+def add_event_participant(conn, event_id, user_id, status='invited'):
     """
     Добавить участника к мероприятию
     
@@ -1851,15 +2262,14 @@ def add_event_participant(event_id, user_id, status='invited'):
         user_id (int): ID пользователя
         status (str): Статус участника (invited, confirmed, declined)
     """
-    with get_db_connection() as conn:
-        conn.execute("""
-            INSERT OR REPLACE INTO event_participants (event_id, user_id, status)
-            VALUES (?, ?, ?)
-        """, (event_id, user_id, status))
-        conn.commit()
+    conn.execute("""
+        INSERT OR REPLACE INTO event_participants (event_id, user_id, status)
+        VALUES (?, ?, ?)
+    """, (event_id, user_id, status))
 
 
-def remove_event_participant(event_id, user_id):
+@db_write
+def remove_event_participant(conn, event_id, user_id):
     """
     Удалить участника из мероприятия
     
@@ -1867,14 +2277,13 @@ def remove_event_participant(event_id, user_id):
         event_id (int): ID мероприятия
         user_id (int): ID пользователя
     """
-    with get_db_connection() as conn:
-        conn.execute("""
-            DELETE FROM event_participants WHERE event_id = ? AND user_id = ?
-        """, (event_id, user_id))
-        conn.commit()
+    conn.execute("""
+        DELETE FROM event_participants WHERE event_id = ? AND user_id = ?
+    """, (event_id, user_id))
 
 
-def update_participant_status(event_id, user_id, status):
+@db_write
+def update_participant_status(conn, event_id, user_id, status):
     """
     Обновить статус участника мероприятия
     
@@ -1883,12 +2292,10 @@ def update_participant_status(event_id, user_id, status):
         user_id (int): ID пользователя
         status (str): Новый статус участника
     """
-    with get_db_connection() as conn:
-        conn.execute("""
-            UPDATE event_participants SET status = ?
-            WHERE event_id = ? AND user_id = ?
-        """, (status, event_id, user_id))
-        conn.commit()
+    conn.execute("""
+        UPDATE event_participants SET status = ?
+        WHERE event_id = ? AND user_id = ?
+    """, (status, event_id, user_id))
 
 
 def get_event_participants(event_id):
@@ -1931,4 +2338,17 @@ def get_upcoming_events(limit=10):
             ORDER BY e.event_date ASC
             LIMIT ?
         """, (limit,)).fetchall()
-        return [dict(event) for event in events]
\ No newline at end of file
+        return [dict(event) for event in events]
+
+
+# === Режим gevent: запросы к базе не блокируют цикл событий ===
+# Публичные функции модуля выполняются через пул потоков ОС из db_offload; пока вынос
+# не включён (режим threading), обёртка просто вызывает функцию.
+_NOT_OFFLOADED = {'get_db_connection', 'db_write', 'after_commit', 'hash_password', 'verify_password',
+                  'next_history_cursor', 'get_feed_cached', 'get_user_by_username', 'get_group_by_name',
+                  'get_channel_by_name', 'get_channel_members', 'get_user_channel_role', 'get_pinned_message'}
+
+for _name, _func in list(globals().items()):
+    if (callable(_func) and getattr(_func, '__module__', None) == __name__ and not _name.startswith('_')
+            and _name not in _NOT_OFFLOADED):
+        globals()[_name] = offloaded(_func)